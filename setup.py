@@ -11,7 +11,17 @@ setup(
         install_requires=['setuptools', 'zc.buildout'],
         namespace_packages=['zerokspot'],
         packages=find_packages(exclude=['ez_setup']),
-        entry_points={'zc.buildout': ['default = zerokspot.recipe.git:Recipe']},
+        entry_points={
+            'zc.buildout': ['default = zerokspot.recipe.git:Recipe'],
+            'console_scripts': [
+                'zerokspot-git-benchmark = zerokspot.recipe.git.benchmark:main',
+                'zerokspot-git-gc = zerokspot.recipe.git.maintenance:main',
+                'zerokspot-git-bundle = zerokspot.recipe.git.bundle:main',
+                'zerokspot-git-lock = zerokspot.recipe.git.versions:main',
+                'zerokspot-git-proxy = zerokspot.recipe.git.proxy:main',
+                'zerokspot-git-plan = zerokspot.recipe.git.plan:main',
+                ],
+            },
         test_suite = 'zerokspot.recipe.git.tests.all_tests',
         classifiers=[
             'Development Status :: 3 - Alpha',
@@ -7,6 +7,7 @@ subversion repositories::
     recipe = zerokspot.recipe.git
     repository = <url-of-repository>
     paths = <relative-paths-to-packages-inside-repository>
+    sparse = [true|false] # default: false, only check out paths
     branch = <name-of-branch> # default: "master"
     rev = <name-of-revision> # default: None
     newest = [true|false] # default: false, stay up to date even when
@@ -14,33 +15,134 @@ subversion repositories::
     as_egg = [true|false] # default: false, install the fetched repo as
                           # egg
     cache-name = <name-in-download-cache> # default: None
+    depth = <number> # default: None, only fetch that many commits
+    single-branch = [true|false] # default: false, only fetch the branch
+    filter = <filter-spec> # default: None, e.g. blob:none or tree:0
+    cache-strategy = [clone|reference|worktree|hardlink] # default: clone
+    update-mode = [pull|fetch-reset|fetch-only] # default: pull
+    submodule-jobs = <number> # default: 1, fetch that many submodules at
+                              # the same time
+    shallow-submodules = [true|false] # default: false
+    checkout-mode = [clone|export] # default: clone, export only unpacks
+                                   # the tree without a .git directory
+    tree-store = [true|false] # default: false, materialize exported parts
+                              # from unpacked trees in the download cache
+    read-only = [true|false] # default: false, hardlink the files of
+                             # the tree store into the part
+    maintain = [true|false] # default: false, write commit-graphs and a
+                            # multi-pack-index after cloning or updating
+    frozen = [true|false] # default: false, install the commit of the part
+                          # in the git-versions lockfile
+    retries = <number> # default: 0, retry failed transfers that many times
+    retry-delay = <seconds> # default: 1, wait that long before the first
+                            # retry, twice as long before every further one
+
+    [buildout]
+    git-parallel-jobs = <number> # default: 1, fetch that many git parts
+                                 # at the same time
+    cache-layout = [checkout|mirror] # default: checkout, how repositories
+                                     # are stored in the download-cache
+    git-proxy = [true|false] # default: false, only fetch upstream through
+                             # the mirrors and multiplex SSH connections
+    git-proxy-persist = <seconds> # default: 600, keep idle SSH connections
+                                  # open that long
+    ref-cache-ttl = <seconds> # default: 0, trust the refs other buildouts
+                              # listed for that long (needs download-cache)
+    git-cache-max-size = <size> # default: None, e.g. 20G, evict least
+                                # recently used download cache entries
+    git-cache-max-age = <age> # default: None, e.g. 30d, evict entries that
+                              # weren't used for that long
+    git-cache-gc-interval = <seconds> # default: 86400
+    git-bundle-directory = <directories> # default: None, exports made by
+                                         # zerokspot-git-bundle to restore
+                                         # missing cache entries from
+    git-trace = <path> # default: None, write the timing of every part
+                       # and git call as JSON
+    git-chrome-trace = <path> # default: None, the same in Chrome's trace
+                              # event format
+    git-trace-hook = <module>:<function> # default: None, called with the
+                                         # spans of every finished part
+    git-versions = <path> # default: git-versions.cfg, the lockfile written
+                          # by zerokspot-git-lock
 
 This would store the cloned repository in ${buildout:directory}/parts/myapp.
 """
 
-import subprocess
+import functools
+import hashlib
 import os.path
+import re
+import shutil
+import tarfile
+import tempfile
+import time
 import zc.buildout
 
+from zerokspot.recipe.git.cache import ARCHIVE_DIRECTORY, \
+        MIRROR_DIRECTORY, CacheUsage, MirrorIndex, RefCache, ls_remote, \
+        mirror_name, normalize_url, resolve_ref, resolve_url
+from zerokspot.recipe.git.bundle import restore
+from zerokspot.recipe.git.maintenance import collect_if_due, parse_age, \
+        parse_size
+from zerokspot.recipe.git.proxy import ssh_environment
+from zerokspot.recipe.git.runner import GitRunner, retry
+from zerokspot.recipe.git.scheduler import FetchScheduler, get_scheduler
+from zerokspot.recipe.git.state import FileLock, State
+from zerokspot.recipe.git.tasks import background, spawn, wait_all
+from zerokspot.recipe.git.trace import TracingRunner, get_tracer, \
+        has_commit_graph, traced
+from zerokspot.recipe.git.trees import materialize, store, tree_path
+from zerokspot.recipe.git.versions import VERSIONS_FILE, VERSIONS_SECTION, \
+        read_versions
+from zerokspot.recipe.git.plan import plan as plan_recipes
+
+
+CACHE_STRATEGIES = ('clone', 'reference', 'worktree', 'hardlink')
+CACHE_LAYOUTS = ('checkout', 'mirror')
+UPDATE_MODES = ('pull', 'fetch-reset', 'fetch-only')
+CHECKOUT_MODES = ('clone', 'export')
+SHA_RE = re.compile('^[0-9a-f]{40}$')
+# Files whose content decides whether a develop egg has to be set up again.
+EGG_METADATA_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
+# Run in the background on repositories that were cloned or updated, if
+# maintain is set.
+MAINTENANCE_COMMANDS = (
+    ('config', 'fetch.writeCommitGraph', 'true'),
+    ('commit-graph', 'write', '--reachable', '--split'),
+    ('multi-pack-index', 'write'),
+)
+ASYNC_STEPS = {
+    'fetch': '_fetch',
+    'clone_upstream': '_clone_upstream',
+    'clone_cache': '_clone_cache',
+    'update_cache': '_update_cache',
+    'update_part': '_update_part',
+    'update_submodules': '_update_part_submodules',
+    'install': 'install',
+    'update': 'update',
+}
 
-def git(operation, args, message, ignore_errnos=None, verbose=False):
+
+def git(operation, args, message, ignore_errnos=None, verbose=False,
+        cwd=None, runner=None, env=None):
     """
     Execute a git operation with the given arguments. If it fails, raise an
-    exception with the given message. If ignore_errnos is a list of status
-    codes, they will be not handled as errors if returned by git.
+    exception with the given message (and git's error output). If
+    ignore_errnos is a list of status codes, they will be not handled as
+    errors if returned by git. If message is None, failures are not raised
+    at all. If cwd is given, git is run inside of that directory, env
+    holds additional environment variables.
+
+    Returns the GitResult of the call.
     """
     if verbose:
         real_args = list(args)
     else:
         real_args = ['-q'] + list(args)
-    
-    command = r'git %s ' + ' '.join(('"%s"', ) * len(real_args))
-    command = command % ((operation, ) + tuple(real_args))
-    status = subprocess.call(command, shell=True)
-    if ignore_errnos is None:
-        ignore_errnos = []
-    if status != 0 and status not in ignore_errnos:
-        raise zc.buildout.UserError(message)
+    if runner is None:
+        runner = GitRunner()
+    return runner.run([operation] + real_args, message, cwd=cwd, env=env,
+                      ignore_errnos=ignore_errnos, echo=verbose)
 
 
 def get_reponame(url, branch = None, rev = None):
@@ -77,14 +179,127 @@ class Recipe(object):
         List of relative paths to packages to develop. Must be used together
         with as_egg=true.
 
+    sparse
+        Set to True to only check out the directories listed in paths
+        (cone-mode sparse checkout). Parts cloned from upstream are partial
+        clones that only download the blobs of those directories.
+
     as_egg
         Set to True if you want the checkout to be registered as a
         development egg in your buildout.
+        Paths are only developed again when their fingerprint changed.
+
+    maintain
+        Set to True to write commit-graphs and a multi-pack-index for the
+        download cache entry and the part after they were cloned or
+        updated, and to let later fetches keep the commit-graph up to date
+        (``fetch.writeCommitGraph``). This runs in the background, so the
+        part doesn't wait for it. Can also be set in the ``[buildout]``
+        section.
+
+    frozen
+        Set to True to install the commit the lockfile written by
+        ``zerokspot-git-lock`` has for the part (``git-versions`` in the
+        ``[buildout]`` section, ``git-versions.cfg`` by default) instead of
+        rev or branch. Refs are never listed, and updates don't run git at
+        all if the part is still at that commit. Can also be set in the
+        ``[buildout]`` section.
+
+    retries
+        How many times failed transfers from a remote are tried again. The
+        first retry waits retry-delay seconds (default: 1), every further
+        one twice as long. Clones from upstream are fetched into
+        ``.<name>.partial`` next to their destination, which is kept if
+        they fail, so that the next attempt continues where it stopped.
+        Both can also be set in the ``[buildout]`` section.
 
     recursive
         Set to True if you want the clone to be recursive, and the updates
-        to include submodule updates.
-        Do note that submodules are not cloned from the download cache!
+        to include submodule updates. With a download cache, every
+        submodule is fetched from its own mirror in the cache.
+
+    submodule-jobs
+        Number of submodules that are fetched at the same time.
+
+    shallow-submodules
+        Set to True to only fetch the commit of every submodule that is
+        checked out (without a download cache).
+
+    checkout-mode
+        ``clone`` (the default) leaves a git repository in the part.
+        ``export`` resolves rev or branch to a SHA and only unpacks that
+        tree into the part, from a tarball kept in the download cache
+        under ``git-archives/<sha>.tar``. Installing a SHA that has been
+        exported before doesn't run git at all.
+
+    tree-store
+        Set to True to keep the exported trees unpacked in the download
+        cache under ``git-trees/<sha>`` and to copy them into parts with
+        copy-on-write clones where the file system supports them (see
+        zerokspot.recipe.git.trees). Only used by exported parts with a
+        download cache. Can also be set in the ``[buildout]`` section.
+
+    read-only
+        Set to True if the files of an exported part are never changed.
+        With tree-store, they are then hardlinked from the store.
+
+    depth
+        Only fetch the given number of commits (a shallow clone). If rev is
+        set as well, only that commit is fetched. Updates keep the clone
+        shallow.
+
+    single-branch
+        Set to True to only fetch the history of the requested branch.
+
+    filter
+        Partial clone filter (e.g. ``blob:none`` or ``tree:0``). Missing
+        objects are fetched by git when they are needed.
+
+    cache-layout
+        Set to ``mirror`` in the ``[buildout]`` section to store the
+        repositories in the download cache as bare mirrors named after a
+        hash of their normalized URL, instead of checkouts named after the
+        repository (``checkout``, the default).
+
+    git-proxy
+        Set to True in the ``[buildout]`` section to fetch from upstream
+        only into the mirrors of the download cache (it implies
+        ``cache-layout = mirror``) and to multiplex SSH connections over
+        one OpenSSH master per host for all git calls and buildouts, see
+        zerokspot.recipe.git.proxy. HTTP(S) and ``git://`` connections
+        aren't shared.
+
+    cache-strategy
+        How a part is created from the download cache: ``clone`` (a clone
+        with its own copy of the objects), ``hardlink`` (a local clone that
+        hardlinks the objects), ``reference`` (a clone that borrows the objects of the
+        cache through git alternates) or ``worktree`` (a worktree of the
+        cache repository). Can also be set in the ``[buildout]`` section.
+
+    update-mode
+        How updates are applied: ``pull`` (the default) merges the branch,
+        ``fetch-reset`` fetches only the branch and hard resets onto it
+        (refusing to touch a checkout with local changes), ``fetch-only``
+        fetches without touching the checkout. With ``fetch-reset``, parts
+        pinned to a rev are only checked to still be at that rev. Can also
+        be set in the ``[buildout]`` section.
+
+    When updating with ``newest``, a single ``git ls-remote`` per repository
+    tells whether anything changed since the last run. The SHA every part
+    was left at is kept in ``.zerokspot.recipe.git.json`` in the buildout
+    directory, and parts whose branch didn't move are not pulled at all.
+
+    The network part of install and update (cloning or pulling the download
+    cache, or the part itself if there is no download cache) can be run for
+    all parts at the same time by setting ``git-parallel-jobs`` in the
+    ``[buildout]`` section to the number of fetches that may run at once.
+
+    plan() tells whether installing or updating the part would use the
+    network, the download cache or do nothing, without doing it.
+
+    The recipe never changes the working directory of the process; every
+    git call gets the directory it works in. Recipe instances can therefore
+    be installed and updated from several threads at the same time.
     """
 
     def __init__(self, buildout, name, options):
@@ -92,26 +307,112 @@ class Recipe(object):
         self.repository = options['repository']
         self.branch = options.get('branch', 'master')
         self.rev = options.get('rev', None)
+        # What the configuration asks for, even if frozen replaces it.
+        self.requested_rev = self.rev
+        self.frozen = options.get('frozen',
+                buildout['buildout'].get('frozen', 'false')).lower() == 'true'
+        if self.frozen:
+            self.rev = self._locked_revision()
         self.newest = options.get('newest',
                 buildout['buildout'].get('newest', "false")).lower() == 'true'
         self.offline = options.get('offline', 'false').lower() == 'true'
         self.cache_install = self.offline or options.get('install-from-cache',
                 buildout['buildout'].get('install-from-cache', 'false')) \
                         .lower() == 'true'
-        self.cache_name = options.get('cache-name',
-                get_reponame(self.repository))
+        self.proxy = buildout['buildout'].get('git-proxy',
+                'false').lower() == 'true'
+        self.cache_layout = buildout['buildout'].get('cache-layout',
+                self.proxy and 'mirror' or 'checkout')
+        if self.cache_layout not in CACHE_LAYOUTS:
+            raise zc.buildout.UserError("Unknown cache-layout %r, use one "
+                    "of %s" % (self.cache_layout, ', '.join(CACHE_LAYOUTS)))
+        if self.proxy and (self.cache_layout != 'mirror' or
+                not buildout['buildout'].get('download-cache')):
+            raise zc.buildout.UserError("git-proxy needs a download-cache "
+                                        "with cache-layout = mirror")
+        self.mirror = self.cache_layout == 'mirror'
+        if self.mirror:
+            self.cache_name = options.get('cache-name',
+                    mirror_name(self.repository))
+        else:
+            self.cache_name = options.get('cache-name',
+                    get_reponame(self.repository))
         self.download_cache = self.buildout['buildout'] \
                 .get('download-cache', None)
-        if self.download_cache:
+        if self.download_cache and self.mirror:
+            self.cache_path = os.path.join(
+                    buildout['buildout']['download-cache'],
+                    MIRROR_DIRECTORY, self.cache_name)
+        elif self.download_cache:
             self.cache_path = os.path.join(
                     buildout['buildout']['download-cache'],
                     self.cache_name)
         else:
             self.cache_path = None
+        self.ref_cache_ttl = int(options.get('ref-cache-ttl',
+                buildout['buildout'].get('ref-cache-ttl', 0)))
+        if self.download_cache:
+            self.ref_cache = RefCache(self.download_cache)
+            self.cache_usage = CacheUsage(self.download_cache)
+        else:
+            self.ref_cache = None
+            self.cache_usage = None
+        try:
+            self.cache_max_size = buildout['buildout'].get(
+                    'git-cache-max-size') and parse_size(
+                            buildout['buildout']['git-cache-max-size'])
+            self.cache_max_age = buildout['buildout'].get(
+                    'git-cache-max-age') and parse_age(
+                            buildout['buildout']['git-cache-max-age'])
+        except ValueError, e:
+            raise zc.buildout.UserError(str(e))
+        self.cache_gc_interval = int(buildout['buildout'].get(
+                'git-cache-gc-interval', 86400))
+        self.bundle_directories = buildout['buildout'].get(
+                'git-bundle-directory', '').split()
         options['location'] = os.path.join(
                 buildout['buildout']['parts-directory'], name)
         self.as_egg = options.get('as_egg', 'false').lower() == 'true'
         self.recursive = options.get('recursive', 'false').lower() == 'true'
+        self.submodule_jobs = int(options.get('submodule-jobs',
+                buildout['buildout'].get('submodule-jobs', 1)))
+        self.shallow_submodules = options.get('shallow-submodules',
+                'false').lower() == 'true'
+        self.checkout_mode = options.get('checkout-mode', 'clone')
+        if self.checkout_mode not in CHECKOUT_MODES:
+            raise zc.buildout.UserError("Unknown checkout-mode %r, use one "
+                    "of %s" % (self.checkout_mode, ', '.join(CHECKOUT_MODES)))
+        self.export = self.checkout_mode == 'export'
+        if self.export and self.recursive:
+            raise zc.buildout.UserError("checkout-mode = export can't be "
+                                        "used for recursive parts")
+        self.export_sha = None
+        self.tree_store = self.export and bool(self.download_cache) and \
+                options.get('tree-store', buildout['buildout'].get(
+                        'tree-store', 'false')).lower() == 'true'
+        self.read_only = options.get('read-only', 'false').lower() == 'true'
+        self.maintain = options.get('maintain',
+                buildout['buildout'].get('maintain', 'false')).lower() \
+                        == 'true'
+        self.retries = int(options.get('retries',
+                buildout['buildout'].get('retries', 0)))
+        self.retry_delay = float(options.get('retry-delay',
+                buildout['buildout'].get('retry-delay', 1)))
+        self.depth = options.get('depth', None)
+        self.single_branch = options.get('single-branch',
+                'false').lower() == 'true'
+        self.filter = options.get('filter', None)
+        self.cache_strategy = options.get('cache-strategy',
+                buildout['buildout'].get('cache-strategy', 'clone'))
+        if self.cache_strategy not in CACHE_STRATEGIES:
+            raise zc.buildout.UserError("Unknown cache-strategy %r, use one "
+                    "of %s" % (self.cache_strategy,
+                               ', '.join(CACHE_STRATEGIES)))
+        self.update_mode = options.get('update-mode',
+                buildout['buildout'].get('update-mode', 'pull'))
+        if self.update_mode not in UPDATE_MODES:
+            raise zc.buildout.UserError("Unknown update-mode %r, use one "
+                    "of %s" % (self.update_mode, ', '.join(UPDATE_MODES)))
         self.root_dir = self.buildout['buildout']['directory']
         self.cache_created = False
         self.cache_updated = False
@@ -119,7 +420,30 @@ class Recipe(object):
         self.cache_cloned = False
         self.installed_from_cache = False
         self.paths = options.get('paths', None)
+        self.sparse = options.get('sparse', 'false').lower() == 'true'
+        if self.sparse and not self.paths:
+            raise zc.buildout.UserError("sparse = true needs paths")
+        if self.sparse and self.export:
+            raise zc.buildout.UserError("sparse = true can't be used with "
+                                        "checkout-mode = export")
         self.verbose = int(buildout['buildout'].get('verbosity', 0)) > 0
+        self.tracer = get_tracer(buildout)
+        env = {}
+        if self.proxy:
+            env = ssh_environment(self.download_cache, int(
+                    buildout['buildout'].get('git-proxy-persist', 600)))
+        self.runner = TracingRunner(self.tracer, name, env=env)
+        self.state = State(self.root_dir)
+        self.scheduler = get_scheduler(buildout)
+        self.scheduler.add_part()
+        if not self.cache_install:
+            self.scheduler.register(self._fetch_key(), self._do_fetch)
+        if self.cache_path is not None:
+            # Entries of this buildout count as used even if the part is
+            # already up to date, see _traced. Nothing is written before
+            # a part is installed or updated, see plan().
+            self.scheduler.defer(('use', self.cache_path),
+                    functools.partial(self._use_cache_entry, self.cache_path))
 
     def install(self):
         """
@@ -129,120 +453,1074 @@ class Recipe(object):
 
         Returns the path to the part's directory.
         """
-        if self.cache_install:
-            if not self.download_cache:
-                raise zc.buildout.UserError("Offline mode requested and no "
-                                            "download-cache specified")
-            if os.path.exists(self.cache_path):
+        return self._traced('install', self._install)
+
+    def update(self):
+        """
+        Called when the buildout is called again without the local
+        configuration having been altered. If no revision was
+        requested and the newest-option enabled it tries to update the
+        requested branch.
+        """
+        return self._traced('update', self._update)
+
+    def plan(self):
+        """
+        What install or update would do, worked out without changing
+        anything. See zerokspot.recipe.git.plan.
+        """
+        return plan_recipes([self])[0]
+
+    def _traced(self, phase, func):
+        """
+        Run install or update as a span of the part and hand the part's
+        spans to the tracer once it is done.
+        """
+        span = self.tracer.start(self.name, phase,
+                                 commit_graph=self._uses_commit_graph())
+        try:
+            self.scheduler.run_deferred()
+            result = func()
+            self._collect_garbage()
+            return result
+        finally:
+            span.attributes.update(cache_created=self.cache_created,
+                    cache_updated=self.cache_updated,
+                    cache_cloned=self.cache_cloned,
+                    part_updated=self.part_updated,
+                    installed_from_cache=self.installed_from_cache)
+            self.tracer.finish(span)
+            self.tracer.flush(self.name)
+            self.scheduler.part_done()
+
+    def _collect_garbage(self):
+        """
+        Evict old download cache entries if a budget is configured, once
+        per buildout run and at most every git-cache-gc-interval seconds.
+        This runs in the background once all parts are done, see
+        zerokspot.recipe.git.maintenance.
+        """
+        if self.download_cache is None or (self.cache_max_size is None
+                                           and self.cache_max_age is None):
+            return
+        def log(message):
+            if self.verbose:
+                print message
+        def collect():
+            collect_if_due(self.download_cache, self.cache_max_size,
+                           self.cache_max_age, self.cache_gc_interval, log)
+        self.scheduler.after_parts(lambda: self.scheduler.once(
+                ('gc', self.download_cache), lambda: background(collect)))
+
+    def _uses_commit_graph(self):
+        """
+        True if the download cache entry or the part already has a
+        commit-graph, to tell maintained runs apart in the trace.
+        """
+        return any(path is not None and os.path.exists(path)
+                   and has_commit_graph(path)
+                   for path in (self.cache_path, self.options['location']))
+
+    def _schedule_maintenance(self, path):
+        """
+        Maintain the repository at ``path`` in the background if maintain
+        is set, at most once per buildout run. Download cache entries are
+        maintained under their lock, which parts need to clone from them,
+        so that only starts once all parts of the buildout are done.
+        """
+        if not self.maintain:
+            return
+        def maintain():
+            try:
+                self._maintain(path)
+            finally:
+                # The part was flushed before its maintain span finished.
+                self.tracer.write()
+        def start():
+            self.scheduler.once(('maintain', path),
+                                lambda: background(maintain))
+        if path == self.options['location']:
+            start()
+        else:
+            self.scheduler.after_parts(start)
+
+    @traced('maintain')
+    def _maintain(self, path):
+        """
+        Run MAINTENANCE_COMMANDS on the repository at ``path``. Download
+        cache entries are maintained under their lock.
+        """
+        self.tracer.annotate(path=path)
+        lock = None
+        if path == self.cache_path:
+            lock = FileLock(path + '.lock')
+            lock.acquire()
+        try:
+            for args in MAINTENANCE_COMMANDS:
+                self.runner.run(args, cwd=path)
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _locked_revision(self):
+        """
+        The commit of this part in the lockfile.
+        """
+        options = self.buildout['buildout']
+        path = os.path.join(options['directory'],
+                            options.get('git-versions', VERSIONS_FILE))
+        versions = read_versions(path)
+        if self.name not in versions:
+            raise zc.buildout.UserError("The [%s] section of %s has no "
+                    "commit for %s, run zerokspot-git-lock again" % (
+                            VERSIONS_SECTION, path, self.name))
+        return versions[self.name]
+
+    def _install(self):
+        """
+        Install the part. If that fails, the part directory is removed
+        again, so that the next run starts with a clean install.
+        """
+        location = self.options['location']
+        if os.path.exists(location):
+            return self._do_install()
+        try:
+            return self._do_install()
+        except:
+            if os.path.exists(location):
+                shutil.rmtree(location, ignore_errors=True)
+            raise
+
+    def _do_install(self):
+        if self.cache_install and not self.download_cache:
+            raise zc.buildout.UserError("Offline mode requested and no "
+                                        "download-cache specified")
+        if self.export:
+            self._install_export()
+        elif self.cache_install:
+            if os.path.exists(self.cache_path) or \
+                    self._restore_from_bundles(self.cache_path):
                 self._clone_cache()
                 self.installed_from_cache = True
             else:
                 raise zc.buildout.UserError("No repository in the download "
                                             "cache directory.")
         else:
+            self._fetch()
             if self.download_cache:
-                if not os.path.exists(self.cache_path):
-                    self._clone_upstream()
-                if self.newest:
-                    # Update the cache first
-                    self._update_cache()
-                else:
+                if not self.newest:
                     self.installed_from_cache = True
                 self._clone_cache()
-            else:
-                self._clone(self.repository, self.options['location'])
+        self._record_part()
         if self.as_egg:
             self._install_as_egg()
         return self.options['location']
 
-    def update(self):
-        """
-        Called when the buildout is called again without the local
-        configuration having been altered. If no revision was
-        requested and the newest-option enabled it tries to update the
-        requested branch.
-        """
-        if self.rev is None and self.newest:
+    def _update(self):
+        if self.frozen:
+            self._update_frozen()
+        elif self.rev is None and self.newest:
+            if not self.cache_install and self._part_unchanged():
+                if self.verbose:
+                    print "Branch unchanged since the last update"
+                return
             # Do an update of the current branch
             if self.verbose:
                 print "Pulling updates from origin"
-            if not self.cache_install and self.download_cache:
-                self._update_cache()
-            self._update_part()
+            if self.export:
+                self._install_export()
+            else:
+                if not self.cache_install:
+                    self._fetch()
+                if self.download_cache or self.cache_install:
+                    self._update_part()
+            self._record_part()
             if self.recursive:
                 self._update_part_submodules()
-            os.chdir(self.options['location'])
             if self.as_egg:
                 self._install_as_egg()
+        elif self.rev is not None and self.update_mode == 'fetch-reset' \
+                and not self.export:
+            self._verify_revision()
         else:
             # "newest" is also automatically disabled if "offline"
             # is set.
             if self.verbose:
                 print "Pulling disable for this part"
 
-    def _clone(self, from_, to):
+    def _update_frozen(self):
         """
-        Clone a repository located at ``from_`` to ``to``.
+        Move the part to its locked commit. Nothing happens at all if it is
+        there already, and refs are never listed.
         """
+        if os.path.exists(self.options['location']) and \
+                self.state.get('parts', self.name) == self.rev:
+            if self.verbose:
+                print "Part is at its locked commit"
+            return
+        if self.export:
+            self._install_export()
+        else:
+            if not self.cache_install:
+                # Brings the locked commit into the download cache.
+                self._fetch()
+                if self.download_cache:
+                    self._fetch_revision_into_cache()
+            self._verify_revision()
+        self._record_part()
+        if self.recursive:
+            self._update_part_submodules()
+        if self.as_egg:
+            self._install_as_egg()
+
+    def run_async(self, step):
+        """
+        Run a step of the recipe in the background and return a Future for
+        its result. ``step`` is one of the keys of ASYNC_STEPS. Steps that
+        depend on each other (e.g. update_cache and update_part) have to be
+        chained by the caller.
+        """
+        if step not in ASYNC_STEPS:
+            raise ValueError("Unknown step %r" % (step, ))
+        return spawn(getattr(self, ASYNC_STEPS[step]))
+
+    def _git(self, operation, args, message, **kwargs):
+        """
+        Run a git operation through this part's runner. See git().
+        """
+        return git(operation, args, message, runner=self.runner, **kwargs)
+
+    def _transfer(self, operation, args, message, **kwargs):
+        """
+        Run a git operation that talks to a remote, see git(). If it fails,
+        it is tried again up to retries times, with exponential backoff
+        starting at retry-delay seconds.
+        """
+        attempts = []
+        def log(error, wait):
+            attempts.append(error)
+            print "%s\nRetrying in %s seconds" % (error, wait)
         try:
-            args = ('--recursive', from_, to,) if self.recursive \
-                                               else (from_, to,)
-            git('clone', args, "Couldn't clone %s into %s" % (
-                    from_, to, ), verbose=True)
-            os.chdir(to)
+            return retry(lambda: self._git(operation, args, message,
+                                           **kwargs),
+                         self.retries, self.retry_delay, log)
+        finally:
+            if attempts:
+                self.tracer.annotate(retries=len(attempts))
 
-            if not '[branch "%s"]' % self.branch in open(os.path.join('.git', 'config')).read():
-                git('branch', ('--track', self.branch, 'origin/%s' % self.branch),
-                    "Failed to set up to track remote branch", verbose=True)
-            if not "ref: refs/heads/%s" % self.branch in open(os.path.join('.git', 'HEAD')).read():
-                git('checkout', (self.branch,), "Failed to switch to branch '%s'" % self.branch,
-                    ignore_errnos=[128])
+    def _fetch_key(self):
+        """
+        Key of this part's fetch in the scheduler. Parts sharing a download
+        cache entry share a single fetch. Without a download cache every
+        part fetches into its own clone.
+        """
+        if self.download_cache and not self.export:
+            return ('cache', self.cache_path)
+        return ('part', self.options['location'])
 
-            if self.rev is not None:
-                git('checkout', (self.rev, ), "Failed to checkout revision")
+    def _fetch(self):
+        """
+        Run the network part of install and update, or wait for the
+        scheduler to finish it if it is already running. Returns what
+        _do_fetch returned.
+        """
+        return self.scheduler.wait(self._fetch_key())
+
+    @traced('fetch')
+    def _do_fetch(self):
+        """
+        Bring the download cache up to date or, if there is no download
+        cache, clone or update the part directly from upstream. In export
+        mode, prepare the archive instead (see _prepare_export).
+        """
+        if self.export:
+            return self._prepare_export()
+        if self.download_cache:
+            if not os.path.exists(self.cache_path):
+                # Only what is newer than the bundles has to be fetched.
+                self._restore_from_bundles(self.cache_path)
+            lock, fetched = self._lock_cache()
+            try:
+                if not os.path.exists(self.cache_path):
+                    self._clone_upstream()
+                elif fetched:
+                    # Another buildout fetched the entry while this one was
+                    # waiting for the lock.
+                    self.tracer.annotate(cache_hit=True)
+                elif self.frozen:
+                    # Only the locked commit is fetched, if the entry
+                    # doesn't have it yet.
+                    present = self._git('rev-parse', ('--verify',
+                            '%s^{commit}' % self.rev), None,
+                            cwd=self.cache_path).ok
+                    self.tracer.annotate(cache_hit=present)
+                    if not present:
+                        self._pin_revision()
+                        self._mark_fetched()
+                        self.cache_updated = True
+                elif self.newest:
+                    remote = self._remote_cache_state()
+                    unchanged = remote is not None and \
+                            remote == self.state.get('caches', self.cache_path)
+                    self.tracer.annotate(cache_hit=unchanged)
+                    if not unchanged:
+                        self._update_cache()
+                        if remote is not None:
+                            self.state.set('caches', self.cache_path, remote)
+                else:
+                    self.tracer.annotate(cache_hit=True)
+            finally:
+                lock.release()
+        elif not os.path.exists(self.options['location']):
+            self._clone_into(self.options['location'], self.repository,
+                             lambda to: self._clone(self.repository, to))
+            self._schedule_maintenance(self.options['location'])
+        elif self.rev is None and self.newest and not self._part_unchanged():
+            self._update_part()
+
+    @traced('resolve')
+    def _remote_refs(self):
+        """
+        Return the refs of the upstream repository as a dictionary mapping
+        ref names to SHAs, or None if they can't be listed. ls-remote runs
+        only once per repository and buildout run, and not at all if the
+        ref cache has refs younger than ref-cache-ttl.
+        """
+        listed = []
+        def list_refs():
+            if self.ref_cache is not None:
+                refs = self.ref_cache.get(self.repository, self.ref_cache_ttl)
+                if refs is not None:
+                    return refs
+            listed.append(True)
+            refs = ls_remote(self.repository, self.runner)
+            if refs is not None and self.ref_cache is not None:
+                self.ref_cache.set(self.repository, refs)
+            return refs
+        refs = self.scheduler.once(
+                ('ls-remote', normalize_url(self.repository)), list_refs)
+        self.tracer.annotate(cache_hit=not listed)
+        return refs
+
+    def _remote_cache_state(self):
+        """
+        What the download cache entry has to match to be up to date: all
+        refs for a mirror, the branch otherwise. None if unknown.
+        """
+        refs = self._remote_refs()
+        if refs is None:
+            return None
+        if self.mirror:
+            return hashlib.sha1(repr(sorted(refs.items()))).hexdigest()
+        return refs.get('refs/heads/%s' % self.branch)
+
+    def _part_unchanged(self):
+        """
+        True if the part is still at the SHA the branch points to upstream.
+        """
+        if not os.path.exists(self.options['location']):
+            return False
+        refs = self._remote_refs()
+        if refs is None:
+            return False
+        remote = refs.get('refs/heads/%s' % self.branch)
+        return remote is not None and \
+                remote == self.state.get('parts', self.name)
+
+    def _record_part(self):
+        """
+        Remember the SHA the part is at for the next update.
+        """
+        if self.export:
+            self.state.set('parts', self.name, self.export_sha)
+            return
+        result = self._git('rev-parse', ('HEAD',), None,
+                           cwd=self.options['location'])
+        if result.ok:
+            self.state.set('parts', self.name, result.output)
+
+    def _install_export(self):
+        """
+        Unpack the tree of the requested revision into the part.
+        """
+        if self.cache_install:
+            sha, archive, temporary = self._prepare_export()
+        else:
+            sha, archive, temporary = self._fetch()
+        try:
+            if self.tree_store:
+                self._materialize(sha, archive)
+            else:
+                self._extract(archive)
         finally:
-            os.chdir(self.root_dir)
+            if temporary:
+                shutil.rmtree(os.path.dirname(archive))
+        self.export_sha = sha
+
+    @traced('resolve')
+    def _resolve_sha(self):
+        """
+        Resolve rev or branch to a SHA without fetching anything: a full
+        SHA is used as it is, otherwise the upstream refs are asked (or the
+        download cache when installing from it). Returns None if that is
+        not possible.
+        """
+        ref = self.rev or self.branch
+        if SHA_RE.match(ref):
+            return ref
+        if self.cache_install:
+            if not os.path.exists(self.cache_path):
+                return None
+            for name in ('origin/%s' % ref, ref):
+                result = self._git('rev-parse', ('--verify',
+                        '%s^{commit}' % name), None, cwd=self.cache_path)
+                if result.ok:
+                    return result.output
+            return None
+        return resolve_ref(self._remote_refs() or {}, ref)
+
+    def _archive_path(self, sha):
+        return os.path.join(self.download_cache, ARCHIVE_DIRECTORY,
+                            '%s.tar' % sha)
+
+    def _prepare_export(self):
+        """
+        Make sure there is a tarball of the requested revision and return
+        its SHA, the path of the tarball and whether it is a temporary
+        file (without a download cache) that has to be removed after use.
+        """
+        sha = self._resolve_sha()
+        if sha is not None and self.tree_store \
+                and os.path.exists(tree_path(self.download_cache, sha)):
+            # The part is materialized from the tree, see _materialize.
+            self.tracer.annotate(cache_hit=True)
+            return sha, None, False
+        if sha is not None and self.download_cache \
+                and os.path.exists(self._archive_path(sha)):
+            self.tracer.annotate(cache_hit=True)
+            self.cache_usage.touch(self._archive_path(sha))
+            return sha, self._archive_path(sha), False
+        self.tracer.annotate(cache_hit=False)
+
+        ref = sha or self.rev or self.branch
+        if self.download_cache:
+            if not os.path.exists(self.cache_path):
+                if self.cache_install:
+                    raise zc.buildout.UserError("No repository in the "
+                            "download cache directory.")
+                self._clone_upstream_once()
+            source = self.cache_path
+            # Other buildouts may fetch into the entry at the same time.
+            lock, fetched = self._lock_cache()
+            try:
+                if not self._git('rev-parse',
+                        ('--verify', '%s^{commit}' % ref), None,
+                        cwd=source).ok:
+                    if sha is None and not SHA_RE.match(ref):
+                        ref = 'origin/%s' % ref
+                    if not self.cache_install and not self._git('rev-parse',
+                            ('--verify', '%s^{commit}' % ref), None,
+                            cwd=source).ok:
+                        self._transfer('fetch', ('origin', sha or self.rev or
+                                                 self.branch),
+                                       "Couldn't fetch %s" % ref,
+                                       verbose=True, cwd=source)
+                        # FETCH_HEAD is only ours while holding the lock.
+                        ref = self._git('rev-parse',
+                                ('--verify', 'FETCH_HEAD^{commit}'),
+                                "Couldn't resolve %s" % ref,
+                                cwd=source).output
+            finally:
+                lock.release()
+            directory = os.path.join(self.download_cache, ARCHIVE_DIRECTORY)
+        else:
+            source = directory = tempfile.mkdtemp(prefix='zerokspot.recipe.git-')
+            self._git('init', ('--bare', source), "Couldn't create %s" % source)
+            self._transfer('fetch', ('--depth', '1', self.repository, ref),
+                           "Couldn't fetch %s from %s" % (
+                                   ref, self.repository),
+                           verbose=True, cwd=source)
+            ref = 'FETCH_HEAD'
+        sha = self._git('rev-parse', ('--verify', '%s^{commit}' % ref),
+                        "Couldn't resolve %s" % ref, cwd=source).output
+
+        archive = os.path.join(directory, '%s.tar' % sha)
+        if not os.path.exists(archive):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            fd, temp = tempfile.mkstemp(dir=directory, prefix='.%s' % sha)
+            fp = os.fdopen(fd, 'wb')
+            try:
+                self.runner.run(['archive', '--format=tar', sha],
+                                "Couldn't export %s" % sha, cwd=source,
+                                stdout=fp)
+            except:
+                fp.close()
+                os.unlink(temp)
+                raise
+            fp.close()
+            os.rename(temp, archive)
+        if self.download_cache:
+            self.cache_usage.touch(archive)
+        return sha, archive, not self.download_cache
+
+    @traced('checkout')
+    def _extract(self, archive):
+        """
+        Unpack the tarball into the part.
+        """
+        def extract(temp):
+            tar = tarfile.open(archive, 'r|')
+            try:
+                tar.extractall(temp)
+            finally:
+                tar.close()
+        self._replace_part(extract)
+
+    @traced('checkout')
+    def _materialize(self, sha, archive):
+        """
+        Copy the tree of ``sha`` from the tree store into the part, after
+        unpacking ``archive`` into the store if it isn't there yet.
+        """
+        tree = tree_path(self.download_cache, sha)
+        if archive is not None:
+            store(self.download_cache, sha, archive)
+        self.cache_usage.touch(tree)
+        methods = []
+        self._replace_part(lambda temp: methods.append(
+                materialize(tree, temp, self.read_only)))
+        self.tracer.annotate(materialized=methods[0])
+
+    def _replace_part(self, fill):
+        """
+        Call ``fill`` with a new directory next to the part and move that
+        into place once it is done, replacing what was there.
+        """
+        location = self.options['location']
+        parent = os.path.dirname(location)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        temp = tempfile.mkdtemp(dir=parent, prefix='.%s-' % self.name)
+        try:
+            fill(temp)
+            os.chmod(temp, 0755)
+            if os.path.exists(location):
+                shutil.rmtree(location)
+            os.rename(temp, location)
+        except:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+
+    def _clone_args(self):
+        """
+        Arguments for clone and fetch that limit what is transferred.
+        """
+        args = []
+        if self.depth is not None:
+            args.extend(('--depth', self.depth))
+        if self.filter is not None:
+            args.append('--filter=%s' % self.filter)
+        return args
+
+    @traced('clone')
+    def _clone(self, from_, to, extra_args=(), submodules=True):
+        """
+        Clone a repository located at ``from_`` to ``to``. Submodules are
+        fetched too if the part is recursive, unless submodules is False.
+        Upstream repositories are fetched into ``to`` instead (see
+        _fetch_checkout), so that a retry can continue where a failed
+        attempt stopped.
+        """
+        if self.rev is not None and self.depth is not None:
+            return self._clone_revision(from_, to, submodules)
+        self.tracer.annotate(cache_hit=from_ == self.cache_path)
+
+        sparse = self._is_sparse(to)
+        if from_ == self.repository:
+            self._fetch_checkout(from_, to, sparse)
+        else:
+            args = self._clone_args() + list(extra_args)
+            if sparse:
+                args.append('--sparse')
+            if self.single_branch or self.depth is not None:
+                args.extend(('--single-branch', '--branch', self.branch))
+            args.extend((from_, to))
+            self._git('clone', args, "Couldn't clone %s into %s" % (
+                    from_, to, ), verbose=True)
+            if sparse:
+                self._set_sparse(to)
+
+        if not self._git('rev-parse', ('--verify', 'refs/heads/%s' % self.branch),
+                         None, cwd=to).ok:
+            self._git('branch', ('--track', self.branch, 'origin/%s' % self.branch),
+                "Failed to set up to track remote branch", verbose=True,
+                cwd=to)
+        if self._git('symbolic-ref', ('HEAD',), None, cwd=to).output \
+                != 'refs/heads/%s' % self.branch:
+            self._git('checkout', (self.branch,), "Failed to switch to branch '%s'" % self.branch,
+                ignore_errnos=[128], cwd=to)
+
+        if self.rev is not None:
+            self._git('checkout', (self.rev, ), "Failed to checkout revision",
+                cwd=to)
+        if self.recursive and submodules:
+            self._update_submodules(to)
+
+    def _fetch_checkout(self, from_, to, sparse=False):
+        """
+        What clone does, as separate steps that can be repeated: create
+        (or reuse) the repository at ``to``, fetch ``from_`` into it and
+        check out the branch. A fetch that is repeated only transfers the
+        objects that are still missing.
+        """
+        message = "Couldn't clone %s into %s" % (from_, to)
+        self._git('init', (to,), message)
+        self.runner.run(['config', 'remote.origin.url', from_], message,
+                        cwd=to)
+        if self.single_branch or self.depth is not None:
+            refspec = '+refs/heads/%s:refs/remotes/origin/%s' % (
+                    self.branch, self.branch)
+        else:
+            refspec = '+refs/heads/*:refs/remotes/origin/*'
+        self.runner.run(['config', 'remote.origin.fetch', refspec], message,
+                        cwd=to)
+        args = self._clone_args()
+        if sparse:
+            args.extend(self._sparse_filter(from_))
+            self._set_sparse(to)
+        first = None
+        if '*' in refspec:
+            first = '+refs/heads/%s:refs/remotes/origin/%s' % (self.branch,
+                                                               self.branch)
+        self._fetch_stages(to, args, first, message)
+        self._git('checkout', ('-B', self.branch, '--track',
+                               'origin/%s' % self.branch),
+                  "Failed to switch to branch '%s'" % self.branch, cwd=to)
+
+    def _fetch_stages(self, path, args, first, message):
+        """
+        Fetch origin into the repository at ``path``. If ``first`` is a
+        refspec (usually the branch of the part), it is fetched on its own
+        before everything else, so that a failure while fetching the rest
+        doesn't lose it: git drops the objects of a fetch that didn't
+        finish.
+        """
+        args = list(args)
+        # Keep what was fetched as a pack, like clone does, instead of
+        # unpacking small fetches into loose objects.
+        env = {'GIT_CONFIG_COUNT': '1',
+               'GIT_CONFIG_KEY_0': 'fetch.unpackLimit',
+               'GIT_CONFIG_VALUE_0': '1'}
+        if first is not None:
+            # Failures are left to the complete fetch.
+            self._git('fetch', args + ['origin', first], None, verbose=True,
+                      cwd=path, env=env)
+        self._transfer('fetch', args + ['origin'], message, verbose=True,
+                       cwd=path, env=env)
+
+    @traced('clone')
+    def _clone_revision(self, from_, to, submodules=True):
+        """
+        Fetch only the requested revision from ``from_`` into a new
+        repository at ``to`` and check it out.
+        """
+        self.tracer.annotate(cache_hit=from_ == self.cache_path)
+        message = "Couldn't fetch %s from %s into %s" % (self.rev, from_, to)
+        self._git('init', (to,), message)
+        self.runner.run(['config', 'remote.origin.url', from_], message,
+                        cwd=to)
+        args = self._clone_args()
+        if self._is_sparse(to):
+            self._set_sparse(to)
+            args.extend(self._sparse_filter(from_))
+        self._transfer('fetch', args + ['origin', self.rev],
+                       message, verbose=True, cwd=to)
+        self._git('checkout', ('FETCH_HEAD',), "Failed to checkout revision",
+                  cwd=to)
+        if self.recursive and submodules:
+            self._update_submodules(to)
+
+    def _sparse_paths(self):
+        """
+        The directories listed in paths, relative to the repository.
+        """
+        return [path.strip().strip('/') for path in self.paths.split()]
+
+    def _is_sparse(self, to):
+        """
+        Only the part is a sparse checkout, never the download cache.
+        """
+        location = self.options['location']
+        return self.sparse and to in (location, self._partial_path(location))
+
+    def _sparse_filter(self, from_):
+        """
+        Make clones from upstream partial, so that only the blobs of the
+        sparse directories are downloaded. Clones from the download cache
+        don't download anything.
+        """
+        if from_ == self.repository and self.filter is None:
+            return ['--filter=blob:none']
+        return []
+
+    def _set_sparse(self, path):
+        """
+        Limit the checkout at ``path`` to the directories in paths.
+        """
+        # sparse-checkout doesn't know -q, so it isn't run through _git.
+        self.runner.run(['sparse-checkout', 'set', '--cone'] +
+                        self._sparse_paths(),
+                        "Failed to set up the sparse checkout of %s" % path,
+                        cwd=path, echo=self.verbose)
 
     def _clone_cache(self):
         """
         Clone the cache into the parts directory.
         """
-        if not os.path.exists(self.cache_path):
-            self._clone_upstream()
-        self._clone(self.cache_path, self.options['location'])
+        if not os.path.exists(self.cache_path) and \
+                not self._restore_from_bundles(self.cache_path):
+            self._clone_upstream_once()
+        self._fetch_revision_into_cache()
+        if self.cache_strategy == 'worktree':
+            self._add_worktree()
+        else:
+            if self.cache_strategy == 'reference':
+                # The part keeps using the objects of the cache, so the
+                # cache must not be pruned or removed while the part exists
+                # (see _use_cache_entry).
+                args = ('--shared',)
+            elif self.cache_strategy == 'hardlink':
+                args = ('--local',)
+            else:
+                # git would hardlink the objects of a local repository.
+                args = ('--no-hardlinks',)
+            # A local clone copies the lock files of a maintenance running
+            # on the entry (see _maintain), which would keep the part from
+            # being maintained.
+            lock, fetched = self._lock_cache()
+            try:
+                self._clone(self.cache_path, self.options['location'], args,
+                            submodules=False)
+            finally:
+                lock.release()
+            if self.recursive:
+                self._update_submodules(self.options['location'])
+        if self.cache_strategy != 'worktree':
+            # Worktrees share the repository of the cache.
+            self._schedule_maintenance(self.options['location'])
         self.cache_cloned = True
 
+    @traced('clone')
+    def _add_worktree(self):
+        """
+        Check out the part as a detached worktree of the cache repository.
+        """
+        to = self.options['location']
+        # Worktrees are registered in the repository of the cache entry,
+        # and so is the configuration of sparse worktrees.
+        lock, fetched = self._lock_cache()
+        try:
+            # Forget worktrees whose directories were removed by an
+            # uninstall.
+            self._git('worktree', ('prune',), "Failed to prune worktrees",
+                      verbose=True, cwd=self.cache_path)
+            args = ['add', '--detach', to, self.rev or self.branch]
+            if self.sparse:
+                args.insert(1, '--no-checkout')
+            self._git('worktree', args,
+                      "Couldn't add a worktree of %s at %s" % (
+                            self.cache_path, to), verbose=True,
+                      cwd=self.cache_path)
+            if self.sparse:
+                self._set_sparse(to)
+        finally:
+            lock.release()
+        if self.sparse:
+            self._git('reset', ('--hard', 'HEAD'),
+                      "Failed to check out %s" % to, cwd=to)
+        if self.recursive:
+            self._update_submodules(to)
+
+    def _lock_cache(self, path=None):
+        """
+        Take the lock of the download cache entry at ``path`` (the part's
+        by default), which is shared with other processes. Returns the lock
+        and whether the entry was fetched by someone else while waiting for
+        it, in which case it doesn't have to be fetched again.
+        """
+        path = path or self.cache_path
+        lock = FileLock(path + '.lock')
+        waiting = time.time()
+        lock.acquire()
+        marker = path + '.fetched'
+        return lock, os.path.exists(marker) \
+                and os.path.getmtime(marker) >= waiting
+
+    def _use_cache_entry(self, path):
+        """
+        Record that this buildout uses the download cache entry at
+        ``path``, for garbage collection and bundle exports. Parts that
+        borrow the objects of the entry are recorded as well, so that it
+        isn't removed under them.
+        """
+        self.cache_usage.touch(path)
+        if self.cache_strategy == 'reference' and path == self.cache_path:
+            self.cache_usage.add_reference(path, self.options['location'])
+        name = os.path.relpath(path, self.download_cache)
+        if self.state.get('cache-entries', name) is None:
+            self.state.set('cache-entries', name, True)
+
+    def _restore_from_bundles(self, path):
+        """
+        Create the download cache entry at ``path`` from the exports in
+        git-bundle-directory. Returns False if they don't have it.
+        """
+        if not self.bundle_directories:
+            return False
+        return restore(self.download_cache,
+                       os.path.relpath(path, self.download_cache),
+                       self.bundle_directories, self.runner)
+
+    def _mark_fetched(self, path=None):
+        """
+        Record that the download cache entry at ``path`` (the part's by
+        default) was just fetched, for processes waiting for its lock.
+        """
+        fp = open((path or self.cache_path) + '.fetched', 'w')
+        fp.close()
+
+    def _partial_path(self, path):
+        """
+        Where clones for ``path`` are made, see _clone_into.
+        """
+        parent, name = os.path.split(path)
+        return os.path.join(parent, '.%s.partial' % name)
+
+    def _clone_into(self, path, url, clone):
+        """
+        Call ``clone`` with a directory next to ``path`` and move that to
+        ``path`` once it succeeded, so that nobody ever sees a partial clone
+        at ``path``. If ``clone`` fails, the directory is kept and the next
+        attempt continues with what it already fetched, as long as that
+        still clones ``url``. The caller must make sure that nobody else
+        clones into ``path`` at the same time.
+        """
+        partial = self._partial_path(path)
+        if os.path.exists(partial) and self._origin_url(partial) != url:
+            # Its refs and objects are those of another repository.
+            shutil.rmtree(partial)
+        if not os.path.exists(partial):
+            os.makedirs(partial)
+        clone(partial)
+        os.chmod(partial, 0755)
+        os.rename(partial, path)
+
+    def _origin_url(self, path):
+        """
+        The URL of origin of the repository at ``path``, or None. Unlike
+        git itself, this never looks at a repository above ``path``.
+        """
+        for config in (os.path.join(path, '.git', 'config'),
+                       os.path.join(path, 'config')):
+            if os.path.isfile(config):
+                result = self.runner.run(['config', '-f', config, '--get',
+                                          'remote.origin.url'])
+                return result.ok and result.output or None
+        return None
+
+    def _fetch_mirror(self, url, to, branch=None, args=()):
+        """
+        What clone --mirror does, as separate steps that can be repeated
+        (see _fetch_checkout). ``branch`` is fetched first and becomes HEAD,
+        ``args`` are passed on to fetch.
+        """
+        message = "Couldn't mirror %s into %s" % (url, to)
+        self._git('init', ('--bare', to), message)
+        for key, value in (('remote.origin.url', url),
+                           ('remote.origin.fetch', '+refs/*:refs/*'),
+                           ('remote.origin.mirror', 'true')):
+            self.runner.run(['config', key, value], message, cwd=to)
+        first = branch and '+refs/heads/%s:refs/heads/%s' % (branch, branch)
+        self._fetch_stages(to, args, first, message)
+        if branch and not self._git('rev-parse', ('--verify', 'HEAD'), None,
+                                    cwd=to).ok:
+            # clone points HEAD at the default branch of the remote.
+            self._git('symbolic-ref', ('HEAD', 'refs/heads/%s' % branch),
+                      message, cwd=to)
+
+    def _clone_upstream_once(self):
+        """
+        Clone the upstream repository into the cache, unless someone else
+        did so while waiting for the lock of the cache entry.
+        """
+        lock, fetched = self._lock_cache()
+        try:
+            if not os.path.exists(self.cache_path):
+                self._clone_upstream()
+        finally:
+            lock.release()
+
     def _clone_upstream(self):
         """
-        Clone the upstream repository into the cache
+        Clone the upstream repository into the cache. The caller must hold
+        the lock of the cache entry (see _lock_cache).
         """
-        self._clone(self.repository, self.cache_path)
+        def clone(to):
+            if self.mirror:
+                self._fetch_mirror(self.repository, to, self.branch,
+                                   self._clone_args())
+                self._pin_revision(to)
+            else:
+                # Submodules are kept in mirrors of their own.
+                self._clone(self.repository, to, submodules=False)
+        self._clone_into(self.cache_path, self.repository, clone)
+        if self.mirror:
+            self._touch_mirror()
+        self._mark_fetched()
+        self._schedule_maintenance(self.cache_path)
         self.cache_created = True
 
     def _update_cache(self):
         """
-        Updates the cached repository.
+        Updates the cached repository. The caller must hold the lock of the
+        cache entry (see _lock_cache).
         """
-        self._update_repository(self.cache_path)
+        if self.mirror:
+            # One fetch updates every branch of the mirror.
+            if self.depth is None:
+                self._transfer('remote', ('update',),
+                               "Failed to update mirror", verbose=True,
+                               cwd=self.cache_path)
+            else:
+                self._transfer('fetch', self._clone_args() + ['origin'],
+                               "Failed to update mirror", verbose=True,
+                               cwd=self.cache_path)
+            self._pin_revision()
+            self._touch_mirror()
+        elif self.update_mode == 'pull':
+            self._update_repository(self.cache_path)
+        else:
+            # Parts fetch from the cache's branch, so it has to move even
+            # with fetch-only.
+            self._update_repository(self.cache_path, 'fetch-reset')
+        self._mark_fetched()
+        self._schedule_maintenance(self.cache_path)
         self.cache_updated = True
 
+    def _fetch_revision_into_cache(self):
+        """
+        Make sure the download cache entry has the requested revision
+        before the part is made from it. The entry is shared by all parts
+        of the repository and was fetched for the first of them, which
+        might have asked for another rev or depth.
+        """
+        if self.rev is None or self.cache_install or \
+                self._git('rev-parse', ('--verify', '%s^{commit}' % self.rev),
+                          None, cwd=self.cache_path).ok:
+            return
+        lock, fetched = self._lock_cache()
+        try:
+            self._pin_revision()
+        finally:
+            lock.release()
+
+    def _pin_revision(self, path=None):
+        """
+        Make sure the requested revision is in the download cache entry (at
+        ``path`` or the cache path), even if none of its branches contains
+        it (e.g. in a shallow entry). It is kept under refs/pinned/ so that
+        parts can fetch it from the entry.
+        """
+        path = path or self.cache_path
+        if self.rev is None or self._git('rev-parse',
+                ('--verify', '%s^{commit}' % self.rev), None,
+                cwd=path).ok:
+            return
+        self._transfer('fetch', self._clone_args() + ['origin',
+                         '%s:refs/pinned/%s' % (self.rev, self.rev)],
+                       "Couldn't fetch %s into %s" % (self.rev, path),
+                       verbose=True, cwd=path)
+
+    def _touch_mirror(self):
+        """
+        Record the fetch of the mirror in the cache's index.
+        """
+        MirrorIndex(self.download_cache).touch(self.cache_name,
+                                               self.repository)
+
+    @traced('checkout')
     def _update_part(self):
         """
         Updates the repository in the buildout's parts directory.
         """
-        self._update_repository(self.options['location'])
+        if self.cache_strategy == 'worktree' and self.download_cache:
+            # The worktree shares its refs with the cache, which has been
+            # updated already.
+            self._move_to(self.options['location'], self.branch)
+        else:
+            self._update_repository(self.options['location'])
+            self._schedule_maintenance(self.options['location'])
         self.part_updated = True
 
-    def _update_repository(self, path):
+    def _update_repository(self, path, mode=None):
         """
-        Update the repository from the given path
+        Update the repository from the given path, using the given
+        update-mode or the one of the part.
         """
-        try:
-            os.chdir(path)
-            git('pull', ('origin', self.branch, ),
-                    "Failed to update repository", verbose=True)
-        finally:
-            os.chdir(self.root_dir)
+        mode = mode or self.update_mode
+        if self.depth is None and mode == 'pull':
+            self._transfer('pull', ('origin', self.branch, ),
+                           "Failed to update repository", verbose=True,
+                           cwd=path)
+            return
+
+        # Only fetch the tracked branch and move onto it. For shallow
+        # clones a pull would deepen the history or fail to merge it.
+        self._transfer('fetch', self._clone_args() + ['origin',
+                         self.rev or self.branch],
+                       "Failed to update repository", verbose=True, cwd=path)
+        self._move_to(path, 'FETCH_HEAD', mode)
+
+    def _move_to(self, path, target, mode=None):
+        """
+        Move the checkout at ``path`` onto ``target`` as the given
+        update-mode (or the one of the part) asks for.
+        """
+        mode = mode or self.update_mode
+        if mode == 'fetch-only':
+            return
+        if mode == 'fetch-reset':
+            status = self.runner.run(['status', '--porcelain',
+                                      '--untracked-files=no'], cwd=path)
+            if status.output:
+                raise zc.buildout.UserError("Refusing to reset %s, it has "
+                        "local changes:\n%s" % (path, status.output))
+            self._git('reset', ('--hard', target),
+                      "Failed to update repository", cwd=path)
+        else:
+            self._git('reset', ('--keep', target),
+                      "Failed to update repository", cwd=path)
+
+    @traced('checkout')
+    def _verify_revision(self):
+        """
+        Make sure a part pinned to a rev still has it checked out. Nothing
+        but two rev-parse calls happens if it does.
+        """
+        location = self.options['location']
+        head = self._git('rev-parse', ('HEAD',), None, cwd=location)
+        wanted = self._git('rev-parse', ('--verify', '%s^{commit}' % self.rev),
+                           None, cwd=location)
+        if head.ok and wanted.ok and head.output == wanted.output:
+            return
+        target = self.rev
+        if not wanted.ok:
+            self._transfer('fetch', self._clone_args() + ['origin', self.rev],
+                           "Couldn't fetch revision %s" % self.rev,
+                           verbose=True, cwd=location)
+            target = 'FETCH_HEAD'
+        self._move_to(location, target)
 
     def _update_part_submodules(self):
         """
@@ -250,29 +1528,173 @@ class Recipe(object):
         """
         self._update_submodules(self.options['location'])
 
+    def _submodule_args(self):
+        """
+        Arguments for submodule update that control how submodules are
+        fetched.
+        """
+        args = []
+        if self.submodule_jobs > 1:
+            args.extend(('--jobs', str(self.submodule_jobs)))
+        if self.shallow_submodules:
+            args.append('--depth=1')
+        return args
+
+    @traced('submodules')
     def _update_submodules(self, path):
         """
         Update the submodules from the given path
         """
+        if self.download_cache:
+            self._update_cached_submodules(path, self.repository)
+            return
+        self._transfer('submodule', ['update', '--init', '--recursive'] +
+                         self._submodule_args(),
+                       "Failed to update submodules", cwd=path)
+
+    def _update_cached_submodules(self, path, upstream):
+        """
+        Update the submodules of the repository at ``path`` (cloned from
+        ``upstream``) from mirrors in the download cache, one per submodule
+        URL, and recurse into them.
+        """
+        submodules = self._read_submodules(path, upstream)
+        if not submodules:
+            return
+        self._git('submodule', ('init',), "Failed to update submodules",
+                  cwd=path)
+        pool = FetchScheduler(self.submodule_jobs)
+        keys = []
+        for name, subpath, url in submodules:
+            mirror = os.path.join(self.download_cache, MIRROR_DIRECTORY,
+                                  mirror_name(url))
+            commit = self.runner.run(['rev-parse', 'HEAD:%s' % subpath],
+                                     cwd=path).output
+            key = (mirror, commit)
+            pool.register(key, functools.partial(self._ensure_mirror, url,
+                                                 mirror, commit))
+            keys.append(key)
+            self.runner.run(['config', 'submodule.%s.url' % name, mirror],
+                            "Failed to configure submodule %s" % name,
+                            cwd=path)
+        pool.start()
+        for key in keys:
+            pool.wait(key)
+        # Since git 2.38.1 submodules can't be cloned from local paths
+        # unless this is allowed explicitly.
+        self._git('submodule', ['update'] + self._submodule_args(),
+                  "Failed to update submodules", cwd=path,
+                  env={'GIT_CONFIG_COUNT': '1',
+                       'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+                       'GIT_CONFIG_VALUE_0': 'always'})
+        for name, subpath, url in submodules:
+            self._update_cached_submodules(os.path.join(path, subpath), url)
+
+    def _read_submodules(self, path, upstream):
+        """
+        Return (name, path, url) for every submodule in the .gitmodules of
+        the repository at ``path``. Relative URLs are resolved against
+        ``upstream``.
+        """
+        result = self.runner.run(['config', '-f', '.gitmodules',
+                                  '--get-regexp', r'^submodule\..*\.(path|url)$'],
+                                 cwd=path)
+        if not result.ok:
+            return []
+        entries = {}
+        for line in result.stdout.splitlines():
+            key, value = line.split(' ', 1)
+            name, field = key[len('submodule.'):].rsplit('.', 1)
+            entries.setdefault(name, {})[field] = value
+        return [(name, entry['path'], resolve_url(entry['url'], upstream))
+                for name, entry in sorted(entries.items())
+                if 'path' in entry and 'url' in entry]
+
+    def _ensure_mirror(self, url, path, commit):
+        """
+        Make sure the download cache holds a mirror of ``url`` at ``path``
+        that contains ``commit``.
+        """
+        self._use_cache_entry(path)
+        lock = self.scheduler.lock(('mirror', path))
+        lock.acquire()
         try:
-            os.chdir(path)
-            git('submodule', ('update', '--init', '--recursive',),
-                    "Failed to update submodules")
+            if not os.path.exists(path):
+                self._restore_from_bundles(path)
+            if not self.cache_install:
+                file_lock, fetched = self._lock_cache(path)
+            try:
+                if not os.path.exists(path):
+                    if self.cache_install:
+                        raise zc.buildout.UserError("No mirror of %s in the "
+                                "download cache directory." % url)
+                    self._clone_into(path, url, lambda to: self._fetch_mirror(
+                            url, to))
+                elif self.cache_install or self._git('rev-parse',
+                        ('--verify', '%s^{commit}' % commit), None,
+                        cwd=path).ok:
+                    return
+                else:
+                    self._transfer('remote', ('update',), "Failed to update "
+                                   "mirror", verbose=True, cwd=path)
+                MirrorIndex(self.download_cache).touch(
+                        os.path.basename(path), url)
+                self._mark_fetched(path)
+            finally:
+                if not self.cache_install:
+                    file_lock.release()
         finally:
-            os.chdir(self.root_dir)
+            lock.release()
 
 
+    @traced('develop')
     def _install_as_egg(self):
         """
-        Install clone as development egg.
+        Install clone as development egg. Paths whose fingerprint (see
+        _egg_fingerprint) didn't change since their last develop and whose
+        .egg-link still exists are skipped, the others are set up in
+        parallel.
         """
-        def _install(path, target):
-            zc.buildout.easy_install.develop(path, target)
-
         target = self.buildout['buildout']['develop-eggs-directory']
         if self.paths:
-            for path in self.paths.split():
-                path = os.path.join(self.options['location'], path.strip())
-                _install(path, target)
+            paths = []
+            for path in self._sparse_paths():
+                path = os.path.join(self.options['location'], path)
+                if self.sparse and not os.path.isdir(path):
+                    raise zc.buildout.UserError("%s is not in the sparse "
+                                                "checkout" % path)
+                paths.append(path)
         else:
-            _install(self.options['location'], target)
+            paths = [self.options['location']]
+
+        pending = []
+        for path in paths:
+            fingerprint = self._egg_fingerprint(path)
+            installed = self.state.get('eggs', path) or {}
+            if installed.get('fingerprint') == fingerprint \
+                    and installed.get('egg-link') \
+                    and os.path.exists(installed['egg-link']):
+                continue
+            pending.append((path, fingerprint))
+        self.tracer.annotate(cache_hit=not pending, developed=len(pending))
+        futures = [spawn(zc.buildout.easy_install.develop, path, target)
+                   for path, fingerprint in pending]
+        for (path, fingerprint), egg_link in zip(pending, wait_all(futures)):
+            self.state.set('eggs', path, {'fingerprint': fingerprint,
+                                          'egg-link': egg_link})
+
+    def _egg_fingerprint(self, path):
+        """
+        Hash of the commit the part is at and the packaging metadata of the
+        develop egg at ``path``.
+        """
+        digest = hashlib.sha1(self.state.get('parts', self.name) or '')
+        for filename in EGG_METADATA_FILES:
+            filename = os.path.join(path, filename)
+            if os.path.exists(filename):
+                fp = open(filename, 'rb')
+                try:
+                    digest.update('%s\0%s\0' % (filename, fp.read()))
+                finally:
+                    fp.close()
+        return digest.hexdigest()
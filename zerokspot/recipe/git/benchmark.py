@@ -0,0 +1,463 @@
+"""
+Benchmarks for the install and update latency of the recipe.
+
+Synthetic repositories of a given size are generated with git fast-import,
+served over ``file://`` and a local ``git daemon``, and installed into
+throwaway buildouts under different cache and clone configurations. For
+every combination the time of a cold install, an install from a warm
+download cache, a no-op update and an update after an upstream commit is
+measured and written as a JSON report. A previous report can be given as
+a baseline, in which case results that got slower than the threshold are
+listed and the exit status is 1::
+
+    zerokspot-git-benchmark --size small --size medium -o report.json
+    zerokspot-git-benchmark --size medium --baseline report.json
+"""
+
+import json
+import logging
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import zc.buildout.buildout
+
+from zerokspot.recipe.git.runner import GitRunner
+from zerokspot.recipe.git.tasks import wait_background
+
+
+SIZES = {
+    'small': dict(commits=10, files=20, blob_size=1024, branches=2,
+                  submodules=0),
+    'medium': dict(commits=200, files=1000, blob_size=4096, branches=10,
+                   submodules=2),
+    'large': dict(commits=2000, files=20000, blob_size=16384, branches=50,
+                  submodules=5),
+}
+
+# name, whether a download cache is used, [buildout] options, part options
+SCENARIOS = [
+    ('no-cache', False, {}, {}),
+    ('no-cache-shallow', False, {}, {'depth': '1'}),
+    ('no-cache-blobless', False, {}, {'filter': 'blob:none'}),
+    ('checkout-clone', True, {'cache-layout': 'checkout'}, {}),
+    ('checkout-reference', True, {'cache-layout': 'checkout'},
+     {'cache-strategy': 'reference'}),
+    ('checkout-worktree', True, {'cache-layout': 'checkout'},
+     {'cache-strategy': 'worktree'}),
+    ('mirror-clone', True, {'cache-layout': 'mirror'}, {}),
+    ('mirror-hardlink', True, {'cache-layout': 'mirror'},
+     {'cache-strategy': 'hardlink'}),
+    ('mirror-export', True, {'cache-layout': 'mirror'},
+     {'checkout-mode': 'export'}),
+    ('no-cache-maintained', False, {}, {'maintain': 'true'}),
+    ('mirror-clone-maintained', True, {'cache-layout': 'mirror'},
+     {'maintain': 'true'}),
+]
+
+TRANSPORTS = ('file', 'daemon')
+
+METRICS = ('install', 'warm-install', 'noop-update', 'update')
+
+# Differences below this many seconds are never reported as regressions.
+NOISE = 0.05
+
+
+def parse_size(spec):
+    """
+    Turn a preset name or a list like ``commits=100,files=50`` (applied on
+    top of the small preset) into the name and parameters of a size.
+    """
+    if spec in SIZES:
+        return spec, dict(SIZES[spec])
+    params = dict(SIZES['small'])
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip().replace('-', '_')
+        if key not in params:
+            raise ValueError("Unknown size parameter %r" % key)
+        params[key] = int(value)
+    return spec, params
+
+
+class _Commit(object):
+    """
+    Writes a single commit in the git fast-import format.
+    """
+
+    def __init__(self, ref, message, when, parent=None):
+        self.ref = ref
+        self.message = message
+        self.when = when
+        self.parent = parent
+        self.changes = []
+
+    def add(self, path, content):
+        self.changes.append('M 100644 inline %s\ndata %d\n%s\n' % (
+                path, len(content), content))
+
+    def add_gitlink(self, path, sha):
+        self.changes.append('M 160000 %s %s\n' % (sha, path))
+
+    def __str__(self):
+        lines = ['commit %s\n' % self.ref,
+                 'committer Benchmark <benchmark@example.com> %d +0000\n'
+                    % self.when,
+                 'data %d\n%s\n' % (len(self.message), self.message)]
+        if self.parent:
+            lines.append('from %s\n' % self.parent)
+        return ''.join(lines + self.changes) + '\n'
+
+
+def _fast_import(path, commits):
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                               stdin=subprocess.PIPE)
+    for commit in commits:
+        process.stdin.write(str(commit))
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("git fast-import failed in %s" % path)
+
+
+def _content(rng, size):
+    # Random printable data, so that git can't compress it away.
+    return ''.join(chr(rng.randint(33, 126)) for i in xrange(size))
+
+
+def make_repository(path, commits=10, files=20, blob_size=1024, branches=2,
+                    submodules=0, seed=0):
+    """
+    Create a bare repository at ``path`` whose master has ``commits``
+    commits: the first adds ``files`` files of ``blob_size`` bytes, every
+    later one changes one of them. ``branches`` branches fork off master
+    with one commit each. With ``submodules``, as many small repositories
+    are created next to ``path`` and added by a last commit on master,
+    with URLs relative to the superproject.
+    """
+    rng = random.Random(seed)
+    runner = GitRunner()
+    runner.run(['init', '--bare', '-q', path], "Couldn't create %s" % path)
+    when = 1500000000
+    stream = []
+    first = _Commit('refs/heads/master', 'Initial commit', when)
+    for i in xrange(files):
+        first.add('dir%03d/file%05d.txt' % (i % 100, i),
+                  _content(rng, blob_size))
+    stream.append(first)
+    for n in xrange(1, commits):
+        # Commits on the same branch of one stream follow each other.
+        commit = _Commit('refs/heads/master', 'Commit %d' % n, when + n)
+        i = n % max(files, 1)
+        commit.add('dir%03d/file%05d.txt' % (i % 100, i),
+                   _content(rng, blob_size))
+        stream.append(commit)
+    for n in xrange(branches):
+        commit = _Commit('refs/heads/branch-%d' % n, 'Branch %d' % n,
+                         when + commits + n, 'refs/heads/master')
+        commit.add('branch-%d.txt' % n, _content(rng, blob_size))
+        stream.append(commit)
+    _fast_import(path, stream)
+
+    if submodules:
+        base = os.path.dirname(path)
+        name = os.path.basename(path)
+        commit = _Commit('refs/heads/master', 'Add submodules',
+                         when + commits + branches, 'refs/heads/master^0')
+        gitmodules = []
+        for n in xrange(submodules):
+            sub_name = '%s-sub%d.git' % (name[:-4] if name.endswith('.git')
+                                         else name, n)
+            sub_path = os.path.join(base, sub_name)
+            make_repository(sub_path, commits=2, files=5,
+                            blob_size=blob_size, branches=0, seed=seed + n + 1)
+            sha = runner.run(['rev-parse', 'master'], "Couldn't resolve "
+                             "master", cwd=sub_path).output
+            commit.add_gitlink('sub%d' % n, sha)
+            gitmodules.append('[submodule "sub%d"]\n\tpath = sub%d\n'
+                              '\turl = ../%s\n' % (n, n, sub_name))
+        commit.add('.gitmodules', ''.join(gitmodules))
+        _fast_import(path, [commit])
+    return path
+
+
+def add_commit(path, message='Upstream change', seed=0):
+    """
+    Add a commit changing one file to master of the repository at
+    ``path``.
+    """
+    commit = _Commit('refs/heads/master', message, int(time.time()),
+                     'refs/heads/master^0')
+    commit.add('upstream.txt', '%s %s\n' % (message, seed))
+    _fast_import(path, [commit])
+
+
+class Daemon(object):
+    """
+    A ``git daemon`` serving every repository below ``base`` on a free
+    local port.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.process = None
+
+    def url(self, path):
+        return 'git://127.0.0.1:%d/%s' % (self.port,
+                                          os.path.relpath(path, self.base))
+
+    def start(self, timeout=10):
+        self.process = subprocess.Popen(['git', 'daemon', '--reuseaddr',
+                '--export-all', '--listen=127.0.0.1',
+                '--port=%d' % self.port, '--base-path=%s' % self.base,
+                self.base])
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("git daemon exited with status %d"
+                                   % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("git daemon didn't start listening")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def _write_config(directory, url, cache, buildout_options, part_options):
+    lines = ['[buildout]', 'parts = benchmark',
+             'log-level = WARNING']
+    if cache:
+        lines.append('download-cache = %s' % cache)
+    for key, value in sorted(buildout_options.items()):
+        lines.append('%s = %s' % (key, value))
+    lines.extend(['', '[benchmark]', 'recipe = zerokspot.recipe.git',
+                  'repository = %s' % url, 'newest = true'])
+    for key, value in sorted(part_options.items()):
+        lines.append('%s = %s' % (key, value))
+    fp = open(os.path.join(directory, 'buildout.cfg'), 'w')
+    try:
+        fp.write('\n'.join(lines) + '\n')
+    finally:
+        fp.close()
+
+
+def _run_buildout(directory):
+    """
+    Run the buildout in ``directory`` and return how long it took and the
+    git calls the recipe made.
+    """
+    cwd = os.getcwd()
+    os.chdir(directory)
+    # Keep the output of the recipe out of a report written to stdout.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        start = time.time()
+        build = zc.buildout.buildout.Buildout(
+                os.path.join(directory, 'buildout.cfg'), [])
+        build.init(None)
+        build.install(None)
+        duration = time.time() - start
+        # Don't let the maintenance of one run slow down the next.
+        wait_background()
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+    recipe = getattr(build['benchmark'], 'recipe', None)
+    calls = recipe and len(recipe.runner.results) or 0
+    return duration, calls
+
+
+def run_scenario(url, upstream, cache, buildout_options, part_options, work):
+    """
+    Measure the metrics of one configuration. ``work`` is an empty
+    directory the buildouts are created in, ``cache`` the download cache
+    (or None).
+    """
+    result = {}
+    calls = {}
+    first = os.path.join(work, 'first')
+    os.mkdir(first)
+    _write_config(first, url, cache, buildout_options, part_options)
+    result['install'], calls['install'] = _run_buildout(first)
+    if cache:
+        second = os.path.join(work, 'second')
+        os.mkdir(second)
+        _write_config(second, url, cache, buildout_options, part_options)
+        result['warm-install'], calls['warm-install'] = _run_buildout(second)
+    result['noop-update'], calls['noop-update'] = _run_buildout(first)
+    add_commit(upstream, seed=time.time())
+    result['update'], calls['update'] = _run_buildout(first)
+    return result, calls
+
+
+def run(sizes, transports=TRANSPORTS, scenarios=None, repeat=1, log=None):
+    """
+    Run the benchmarks for the given sizes (see parse_size) and return the
+    report.
+    """
+    log = log or (lambda message: None)
+    scenarios = [scenario for scenario in SCENARIOS
+                 if scenarios is None or scenario[0] in scenarios]
+    results = []
+    for size_name, params in sizes:
+        for transport in transports:
+            for name, use_cache, buildout_options, part_options in scenarios:
+                part_options = dict(part_options)
+                if params['submodules']:
+                    if part_options.get('checkout-mode') == 'export':
+                        continue
+                    part_options['recursive'] = 'true'
+                timings = dict((metric, []) for metric in METRICS)
+                for i in xrange(repeat):
+                    log('%s/%s/%s #%d' % (size_name, transport, name, i + 1))
+                    timing, calls = _measure(params, transport, use_cache,
+                                             buildout_options, part_options)
+                    for metric, value in timing.items():
+                        timings[metric].append(value)
+                results.append({
+                    'size': size_name,
+                    'params': params,
+                    'transport': transport,
+                    'scenario': name,
+                    'seconds': dict((metric, _median(values))
+                                    for metric, values in timings.items()
+                                    if values),
+                    'git-calls': calls,
+                })
+    return {'created': time.time(), 'git': _git_version(),
+            'results': results}
+
+
+def _measure(params, transport, use_cache, buildout_options, part_options):
+    base = tempfile.mkdtemp(prefix='zerokspot.recipe.git-benchmark-')
+    daemon = None
+    try:
+        upstream = make_repository(os.path.join(base, 'repos', 'repo.git'),
+                                   **params)
+        url = 'file://%s' % upstream
+        if transport == 'daemon':
+            daemon = Daemon(os.path.join(base, 'repos'))
+            daemon.start()
+            url = daemon.url(upstream)
+        cache = None
+        if use_cache:
+            cache = os.path.join(base, 'cache')
+            os.mkdir(cache)
+        work = os.path.join(base, 'work')
+        os.mkdir(work)
+        return run_scenario(url, upstream, cache, buildout_options,
+                            part_options, work)
+    finally:
+        if daemon is not None:
+            daemon.stop()
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _git_version():
+    return GitRunner().run(['--version']).output
+
+
+def compare(report, baseline, threshold=1.25):
+    """
+    Return the results of ``report`` that are more than ``threshold``
+    times slower than the same result in ``baseline``, as tuples of the
+    result's key, the metric, the baseline and the new time.
+    """
+    def key(result):
+        return (result['size'], result['transport'], result['scenario'])
+    previous = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for metric, seconds in sorted(result['seconds'].items()):
+            before = old['seconds'].get(metric)
+            if before is None:
+                continue
+            if seconds > before * threshold and seconds - before > NOISE:
+                regressions.append((key(result), metric, before, seconds))
+    return regressions
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option('-s', '--size', action='append', default=[],
+            help="preset (%s) or parameters like commits=100,files=50; "
+                 "can be given more than once" % ', '.join(sorted(SIZES)))
+    parser.add_option('-t', '--transport', action='append', default=[],
+            choices=TRANSPORTS, help="file or daemon (default: both)")
+    parser.add_option('--scenario', action='append', default=[],
+            choices=[scenario[0] for scenario in SCENARIOS],
+            help="only run this configuration (default: all)")
+    parser.add_option('-n', '--repeat', type='int', default=1,
+            help="runs per configuration, the median is reported")
+    parser.add_option('-o', '--output', help="write the report to this file")
+    parser.add_option('-b', '--baseline',
+            help="report to compare the results with")
+    parser.add_option('--threshold', type='float', default=1.25,
+            help="slowdown factor reported as a regression (default: 1.25)")
+    options, args = parser.parse_args(args)
+
+    try:
+        sizes = [parse_size(spec) for spec in options.size or ['small']]
+    except ValueError, e:
+        parser.error(str(e))
+    logging.getLogger('zc.buildout').setLevel(logging.WARNING)
+    def log(message):
+        sys.stderr.write(message + '\n')
+    report = run(sizes, options.transport or TRANSPORTS,
+                 options.scenario or None, options.repeat, log)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        fp = open(options.output, 'w')
+        try:
+            fp.write(data + '\n')
+        finally:
+            fp.close()
+    else:
+        print data
+
+    if options.baseline:
+        fp = open(options.baseline)
+        try:
+            baseline = json.load(fp)
+        finally:
+            fp.close()
+        regressions = compare(report, baseline, options.threshold)
+        for key, metric, before, after in regressions:
+            log('REGRESSION %s %s: %.3fs -> %.3fs' % ('/'.join(key), metric,
+                                                      before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""
+Export of download cache entries as git bundles and seeding of a download
+cache from them.
+
+Copying a download cache between machines means copying a lot of small
+files. An export instead holds one ``git bundle`` per repository entry and
+a ``manifest.json`` describing the entries (their refs, HEAD and upstream
+URL). An export can be incremental, relative to a previous one, in which
+case its bundles only contain the objects that are new since then. Seeding
+applies one or more exports, oldest first, to a download cache::
+
+    zerokspot-git-bundle export /path/to/download-cache /media/full
+    zerokspot-git-bundle export --incremental /media/full \\
+        /path/to/download-cache /media/week1
+    zerokspot-git-bundle seed /path/to/new-cache /media/full /media/week1
+
+``export --buildout <directory>`` only exports the entries that buildout
+used. With ``git-bundle-directory`` (a list of export directories, oldest
+first) in the ``[buildout]`` section, the recipe restores missing entries
+from the exports itself, e.g. for offline installs.
+
+Tarballs of ``checkout-mode = export`` parts are not exported, they are
+made again from the repositories when needed.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import zc.buildout
+
+from zerokspot.recipe.git.cache import MIRROR_DIRECTORY, CacheUsage, \
+        MirrorIndex
+from zerokspot.recipe.git.maintenance import find_entries
+from zerokspot.recipe.git.runner import GitRunner
+from zerokspot.recipe.git.state import STATE_FILE, FileLock, JSONFile
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _list_refs(path, runner):
+    result = runner.run(['for-each-ref', '--format=%(objectname) %(refname)'],
+                        "Couldn't list the refs of %s" % path, cwd=path)
+    refs = {}
+    for line in result.stdout.splitlines():
+        sha, ref = line.split(' ', 1)
+        refs[ref] = sha
+    return refs
+
+
+def _repository_entries(download_cache):
+    return [entry.name for entry in find_entries(download_cache)
+            if entry.repository]
+
+
+def used_entries(buildout_directory):
+    """
+    Names of the download cache entries the buildout in the given directory
+    used, as recorded in its state file.
+    """
+    state = JSONFile(os.path.join(buildout_directory, STATE_FILE)).read()
+    return sorted(state.get('cache-entries', {}))
+
+
+def _bundle_name(name):
+    return name.replace(os.sep, '--') + '.bundle'
+
+
+def export(download_cache, destination, names=None, previous=None,
+           runner=None, log=None):
+    """
+    Write a bundle of each repository entry of the download cache (or of
+    the ones named) and a manifest to ``destination``. With the directory
+    of a ``previous`` export, the bundles only contain what is new since
+    then and entries that didn't change are left out. Returns the
+    manifest.
+    """
+    runner = runner or GitRunner()
+    log = log or (lambda message: None)
+    if names is None:
+        names = _repository_entries(download_cache)
+    base = {}
+    if previous is not None:
+        base = read_manifest(previous)['entries']
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+
+    entries = {}
+    for name in names:
+        path = os.path.join(download_cache, name)
+        if not os.path.exists(path):
+            log('Skipping %s, it is not in the download cache' % name)
+            continue
+        lock = FileLock(path + '.lock')
+        lock.acquire()
+        try:
+            refs = _list_refs(path, runner)
+            known = base.get(name, {}).get('refs', {})
+            if refs and refs == known:
+                log('%s is unchanged' % name)
+                continue
+            head = runner.run(['symbolic-ref', 'HEAD'], cwd=path).output
+            url = runner.run(['config', 'remote.origin.url'], cwd=path).output
+            # Commits the previous export has and that are still there.
+            prerequisites = sorted(set(sha for sha in known.values()
+                    if runner.run(['cat-file', '-e', sha], cwd=path).ok))
+            if set(refs.values()) <= set(prerequisites):
+                # Nothing new, refs were only removed or moved back. git
+                # refuses to create an empty bundle, so bundle everything.
+                prerequisites = []
+            bundle = _bundle_name(name)
+            log('Bundling %s' % name)
+            runner.run(['bundle', 'create', '-q',
+                        os.path.join(os.path.abspath(destination), bundle),
+                        '--all'] + ['^%s' % sha for sha in prerequisites],
+                       "Couldn't bundle %s" % name, cwd=path)
+        finally:
+            lock.release()
+        entries[name] = {
+            'bundle': bundle,
+            'refs': refs,
+            'head': head or None,
+            'url': url,
+            'mirror': os.path.dirname(name) == MIRROR_DIRECTORY,
+            'prerequisites': prerequisites,
+        }
+    manifest = {'created': time.time(), 'entries': entries,
+                'previous': previous and os.path.abspath(previous)}
+    JSONFile(os.path.join(destination, MANIFEST_FILE)).write(manifest)
+    return manifest
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        raise zc.buildout.UserError("%s is not a bundle export, it has no %s"
+                                    % (directory, MANIFEST_FILE))
+    return JSONFile(path).read()
+
+
+def bundles_for(directories, name):
+    """
+    The bundles of the entry ``name`` in the given exports (oldest first),
+    starting from the last complete one, together with their manifest
+    entries. Empty if none of them has a complete bundle of the entry.
+    """
+    chain = []
+    for directory in directories:
+        entry = read_manifest(directory)['entries'].get(name)
+        if entry is None:
+            continue
+        if not entry['prerequisites']:
+            chain = []
+        chain.append((os.path.join(directory, entry['bundle']), entry))
+    if chain and chain[0][1]['prerequisites']:
+        return []
+    return chain
+
+
+def restore(download_cache, name, directories, runner=None):
+    """
+    Create or update the entry ``name`` of the download cache from the
+    bundles in the given exports. Returns False if they don't have it.
+    """
+    runner = runner or GitRunner()
+    path = os.path.join(download_cache, name)
+    lock = FileLock(path + '.lock')
+    lock.acquire()
+    try:
+        if os.path.exists(path):
+            chain = [(bundle, entry) for bundle, entry
+                     in bundles_for(directories, name)
+                     if _needs(path, entry, runner)]
+            if not chain:
+                return bool(bundles_for(directories, name))
+            for bundle, entry in chain:
+                _apply(path, bundle, entry, runner)
+        else:
+            chain = bundles_for(directories, name)
+            if not chain:
+                return False
+            _create(path, chain, runner)
+        entry = chain[-1][1]
+        if entry['mirror'] and entry['url']:
+            MirrorIndex(download_cache).touch(os.path.basename(name),
+                                              entry['url'])
+        fp = open(path + '.fetched', 'w')
+        fp.close()
+    finally:
+        lock.release()
+    CacheUsage(download_cache).touch(path)
+    return True
+
+
+def _needs(path, entry, runner):
+    # True unless the repository already has every ref of the entry.
+    refs = _list_refs(path, runner)
+    return any(refs.get(ref) != sha for ref, sha in entry['refs'].items())
+
+
+def _apply(path, bundle, entry, runner):
+    bare = entry['mirror']
+    runner.run(['fetch', '-q', '--update-head-ok', bundle, '+refs/*:refs/*'],
+               "Couldn't fetch %s into %s" % (bundle, path), cwd=path)
+    if not bare:
+        runner.run(['reset', '-q', '--hard'],
+                   "Couldn't check out %s" % path, cwd=path)
+
+
+def _create(path, chain, runner):
+    entry = chain[-1][1]
+    bare = entry['mirror']
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    temp = tempfile.mkdtemp(dir=parent,
+                            prefix='.%s-' % os.path.basename(path))
+    try:
+        runner.run(['init', '-q'] + (bare and ['--bare'] or []) + [temp],
+                   "Couldn't create %s" % path)
+        for bundle, step in chain:
+            _apply(temp, bundle, dict(step, mirror=True), runner)
+        if entry['url']:
+            runner.run(['remote', 'add', 'origin', entry['url']],
+                       "Couldn't configure %s" % path, cwd=temp)
+            if bare:
+                runner.run(['config', 'remote.origin.fetch', '+refs/*:refs/*'],
+                           "Couldn't configure %s" % path, cwd=temp)
+                runner.run(['config', 'remote.origin.mirror', 'true'],
+                           "Couldn't configure %s" % path, cwd=temp)
+        if entry['head']:
+            runner.run(['symbolic-ref', 'HEAD', entry['head']],
+                       "Couldn't configure %s" % path, cwd=temp)
+            branch = entry['head'][len('refs/heads/'):]
+            if not bare and entry['url']:
+                runner.run(['config', 'branch.%s.remote' % branch, 'origin'],
+                           "Couldn't configure %s" % path, cwd=temp)
+                runner.run(['config', 'branch.%s.merge' % branch,
+                            entry['head']],
+                           "Couldn't configure %s" % path, cwd=temp)
+        if not bare:
+            runner.run(['reset', '-q', '--hard'],
+                       "Couldn't check out %s" % path, cwd=temp)
+        os.chmod(temp, 0755)
+        os.rename(temp, path)
+    except:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+
+
+def seed(download_cache, directories, runner=None, log=None):
+    """
+    Create or update every entry of the given exports (oldest first) in
+    the download cache. Returns the names of the entries.
+    """
+    log = log or (lambda message: None)
+    names = set()
+    for directory in directories:
+        names.update(read_manifest(directory)['entries'])
+    seeded = []
+    for name in sorted(names):
+        log('Seeding %s' % name)
+        if restore(download_cache, name, directories, runner):
+            seeded.append(name)
+        else:
+            log('No complete bundle of %s' % name)
+    return seeded
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+            usage='%prog export [options] DOWNLOAD-CACHE DESTINATION\n'
+                  '       %prog seed DOWNLOAD-CACHE EXPORT [EXPORT...]',
+            description=__doc__.split('\n\n')[0])
+    parser.add_option('-i', '--incremental', metavar='EXPORT',
+            help="only bundle what is new since this export")
+    parser.add_option('-b', '--buildout', metavar='DIRECTORY',
+            help="only export the entries this buildout used")
+    options, args = parser.parse_args(args)
+    if len(args) < 3 or args[0] not in ('export', 'seed') \
+            or (args[0] == 'export' and len(args) != 3):
+        parser.error("Give a command, the download cache and the exports")
+    def log(message):
+        print message
+    try:
+        if args[0] == 'export':
+            names = None
+            if options.buildout:
+                names = used_entries(options.buildout)
+            export(args[1], args[2], names, options.incremental, log=log)
+        else:
+            seed(args[1], args[2:], log=log)
+    except zc.buildout.UserError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
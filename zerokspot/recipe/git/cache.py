@@ -0,0 +1,294 @@
+"""
+Helpers for the ``mirror`` layout of the download cache.
+
+In this layout every repository is stored as a bare ``--mirror`` clone in
+``<download-cache>/git/<hash>``, where the hash is computed from the
+normalized repository URL. Different spellings of the same URL therefore
+share one mirror. ``<download-cache>/git/index.json`` records the source
+URL and the time of the last fetch of every mirror.
+
+``<download-cache>/git/refs.json`` is shared by all layouts: it keeps the
+refs ``ls-remote`` last listed for every repository, so that buildouts on
+the same host can resolve branches without asking the remote again for a
+while (see RefCache). ``<download-cache>/git/usage.json`` records when each
+git entry of the download cache was last used (see CacheUsage and
+zerokspot.recipe.git.maintenance).
+"""
+
+import hashlib
+import os
+import time
+import urlparse
+
+from zerokspot.recipe.git.runner import GitRunner
+from zerokspot.recipe.git.state import JSONFile
+from zerokspot.recipe.git.tasks import spawn, wait_all
+
+
+MIRROR_DIRECTORY = 'git'
+INDEX_FILE = 'index.json'
+REF_CACHE_FILE = 'refs.json'
+USAGE_FILE = 'usage.json'
+ARCHIVE_DIRECTORY = 'git-archives'
+TREE_DIRECTORY = 'git-trees'
+
+
+def normalize_url(url):
+    """
+    Reduce a repository URL to ``<host>/<path>`` so that different spellings
+    of the same repository (scheme, user, port, trailing slashes, a ".git"
+    suffix and scp-like ``user@host:path`` URLs) compare equal. Local paths
+    are made absolute.
+    """
+    url = url.strip()
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme and parsed.scheme != 'file' and parsed.netloc:
+        host = parsed.hostname or ''
+        path = parsed.path
+    elif parsed.scheme == 'file':
+        host = ''
+        path = os.path.abspath(parsed.path)
+    elif ':' in url.split('/')[0]:
+        # scp-like syntax: [user@]host:path
+        host, path = url.split(':', 1)
+        host = host.split('@')[-1]
+    else:
+        host = ''
+        path = os.path.abspath(url)
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-4]
+    return '%s/%s' % (host.lower(), path.strip('/'))
+
+
+def resolve_url(url, base):
+    """
+    Resolve a relative submodule URL (starting with ``./`` or ``../``)
+    against the URL of its superproject, like git does. Other URLs are
+    returned unchanged.
+    """
+    if not (url.startswith('./') or url.startswith('../')):
+        return url
+    base = base.rstrip('/')
+    separator = '/'
+    for part in url.split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            cut = max(base.rfind('/'), base.rfind(':'))
+            if cut < 0:
+                base, separator = '', ''
+            else:
+                base, separator = base[:cut], base[cut]
+        else:
+            base = base + separator + part
+            separator = '/'
+    return base
+
+
+def mirror_name(url):
+    """
+    Name of the mirror of the given repository URL in the cache.
+    """
+    return hashlib.sha1(normalize_url(url)).hexdigest()
+
+
+class MirrorIndex(JSONFile):
+    """
+    The index file of the mirrors in a download cache.
+    """
+
+    def __init__(self, download_cache):
+        JSONFile.__init__(self, os.path.join(download_cache,
+                                             MIRROR_DIRECTORY, INDEX_FILE))
+
+    def get(self, name):
+        return self.read().get(name)
+
+    def touch(self, name, url):
+        """
+        Record that the mirror ``name`` of ``url`` was fetched just now.
+        """
+        self.update(name, url=url, last_fetch=time.time())
+
+    def update(self, name, **values):
+        """
+        Set the given values in the entry of the mirror ``name``.
+        """
+        def change(index):
+            entry = index.setdefault(name, {})
+            for key, value in values.items():
+                entry[key.replace('_', '-')] = value
+        self.modify(change)
+
+    def remove(self, names):
+        def change(index):
+            for name in names:
+                index.pop(name, None)
+        self.modify(change)
+
+
+def ls_remote(url, runner=None):
+    """
+    Return the refs of the repository at ``url`` as a dictionary mapping
+    ref names to SHAs, or None if they can't be listed.
+    """
+    result = (runner or GitRunner()).run(['ls-remote', url])
+    if not result.ok:
+        return None
+    refs = {}
+    for line in result.stdout.splitlines():
+        sha, ref = line.split('\t', 1)
+        refs[ref] = sha
+    return refs
+
+
+def ls_remote_all(urls, runner=None):
+    """
+    List the refs of all given repositories at the same time, with one
+    ls-remote per normalized URL. Returns a dictionary mapping each URL to
+    its refs (or None, see ls_remote).
+    """
+    remotes = {}
+    for url in urls:
+        remotes.setdefault(normalize_url(url), url)
+    keys = remotes.keys()
+    results = dict(zip(keys, wait_all([spawn(ls_remote, remotes[key], runner)
+                                       for key in keys])))
+    return dict((url, results[normalize_url(url)]) for url in urls)
+
+
+def resolve_ref(refs, ref):
+    """
+    The SHA of the branch or tag ``ref`` in ``refs`` (as returned by
+    ls_remote), or None if it isn't there.
+    """
+    for name in ('refs/heads/%s', 'refs/tags/%s^{}', 'refs/tags/%s'):
+        if name % ref in refs:
+            return refs[name % ref]
+    return None
+
+
+class RefCache(JSONFile):
+    """
+    The refs of upstream repositories as they were last listed, keyed by
+    the normalized URL.
+    """
+
+    def __init__(self, download_cache):
+        JSONFile.__init__(self, os.path.join(download_cache,
+                                             MIRROR_DIRECTORY, REF_CACHE_FILE))
+
+    def get(self, url, ttl):
+        """
+        The refs of ``url`` if they were listed less than ``ttl`` seconds
+        ago, None otherwise.
+        """
+        entry = self.read().get(normalize_url(url))
+        if entry is None or time.time() - entry['listed'] >= ttl:
+            return None
+        return entry['refs']
+
+    def set(self, url, refs):
+        def change(data):
+            data[normalize_url(url)] = {'url': url, 'listed': time.time(),
+                                        'refs': refs}
+        self.modify(change)
+
+    def refresh(self, urls=None, runner=None):
+        """
+        List the refs of the given repositories (or of all that are in the
+        cache) with one ls-remote per repository, all at the same time, and
+        store them. Returns the URLs that couldn't be listed.
+        """
+        if urls is None:
+            urls = [entry['url'] for entry in self.read().values()]
+        remotes = {}
+        for url in urls:
+            remotes.setdefault(normalize_url(url), url)
+        urls = remotes.values()
+        listed = dict((url, refs) for url, refs
+                      in ls_remote_all(urls, runner).items()
+                      if refs is not None)
+        def change(data):
+            for url, refs in listed.items():
+                data[normalize_url(url)] = {'url': url, 'listed': time.time(),
+                                            'refs': refs}
+        self.modify(change)
+        return [url for url in urls if url not in listed]
+
+
+class CacheUsage(JSONFile):
+    """
+    When each git entry of a download cache was last used. Entries are
+    named by their path relative to the download cache.
+    """
+
+    def __init__(self, download_cache):
+        JSONFile.__init__(self, os.path.join(download_cache,
+                                             MIRROR_DIRECTORY, USAGE_FILE))
+        self.download_cache = download_cache
+
+    def entries(self):
+        """
+        A dictionary mapping entry names to the time they were last used.
+        """
+        return self.read().get('entries', {})
+
+    def touch(self, path):
+        """
+        Record that the entry at ``path`` is being used.
+        """
+        name = os.path.relpath(path, self.download_cache)
+        def change(data):
+            data.setdefault('entries', {})[name] = time.time()
+        try:
+            self.modify(change)
+        except (IOError, OSError):
+            # Only garbage collection needs this, a read-only download
+            # cache is fine otherwise.
+            pass
+
+    def references(self):
+        """
+        A dictionary mapping entry names to the parts that were cloned from
+        them with ``cache-strategy = reference``.
+        """
+        return self.read().get('references', {})
+
+    def add_reference(self, path, part):
+        """
+        Record that the part at ``part`` borrows the objects of the entry
+        at ``path``.
+        """
+        name = os.path.relpath(path, self.download_cache)
+        def change(data):
+            parts = data.setdefault('references', {}).setdefault(name, [])
+            if part not in parts:
+                parts.append(part)
+        try:
+            self.modify(change)
+        except (IOError, OSError):
+            pass
+
+    def remove(self, names):
+        def change(data):
+            entries = data.setdefault('entries', {})
+            references = data.setdefault('references', {})
+            for name in names:
+                entries.pop(name, None)
+                references.pop(name, None)
+        self.modify(change)
+
+    def start_gc(self, interval):
+        """
+        Record the start of a garbage collection and return True, unless
+        the last one started less than ``interval`` seconds ago.
+        """
+        started = []
+        def change(data):
+            if time.time() - data.get('last-gc', 0) >= interval:
+                data['last-gc'] = time.time()
+                started.append(True)
+        self.modify(change)
+        return bool(started)
@@ -0,0 +1,309 @@
+"""
+Garbage collection of the git entries in a download cache.
+
+Entries are the clones of the ``checkout`` layout, the mirrors in ``git/``,
+the tarballs in ``git-archives/`` and the trees in ``git-trees/``. The
+recipe records when it last used each of them in ``git/usage.json``.
+collect() removes the entries that were not used for longer than a maximum
+age and then the least recently used ones until the cache fits into a
+maximum size. Entries used within the last hour, repositories with
+worktrees and repositories whose objects parts borrow (``cache-strategy =
+reference``, recorded in ``usage.json``) are never removed. The
+repositories that are kept get ``git gc --auto`` and a fresh commit-graph.
+Borrowed objects are never pruned.
+
+This runs from the command line::
+
+    zerokspot-git-gc --max-size 20G --max-age 30d /path/to/download-cache
+
+or, with ``git-cache-max-size`` and/or ``git-cache-max-age`` in the
+``[buildout]`` section, in the background once all git parts of a buildout
+are done, at most once every ``git-cache-gc-interval`` seconds (default: a
+day).
+"""
+
+import optparse
+import os
+import re
+import shutil
+import sys
+import time
+
+from zerokspot.recipe.git.cache import ARCHIVE_DIRECTORY, MIRROR_DIRECTORY, \
+        TREE_DIRECTORY, CacheUsage, MirrorIndex
+from zerokspot.recipe.git.runner import GitRunner
+from zerokspot.recipe.git.state import FileLock
+
+
+# Entries used more recently than this many seconds are always kept.
+KEEP_RECENT = 3600
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_size(value):
+    """
+    Parse a size like ``500M`` or ``20G`` into bytes.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', value, re.I)
+    if match is None:
+        raise ValueError("Invalid size %r" % value)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_age(value):
+    """
+    Parse an age like ``12h`` or ``30d`` into seconds.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', value)
+    if match is None:
+        raise ValueError("Invalid age %r" % value)
+    return int(float(match.group(1)) * AGE_UNITS[match.group(2)])
+
+
+class Entry(object):
+    """
+    A single entry of the download cache. ``name`` is its path relative to
+    the download cache.
+    """
+
+    def __init__(self, download_cache, name, repository):
+        self.name = name
+        self.path = os.path.join(download_cache, name)
+        self.repository = repository
+        self.last_used = None
+        self.referenced = False
+        self._size = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = disk_usage(self.path)
+        return self._size
+
+    def has_worktrees(self, runner):
+        """
+        True if parts were checked out as worktrees of this repository.
+        """
+        if not self.repository:
+            return False
+        lock = FileLock(self.path + '.lock')
+        lock.acquire()
+        try:
+            runner.run(['worktree', 'prune'], cwd=self.path)
+        finally:
+            lock.release()
+        for worktrees in (os.path.join(self.path, '.git', 'worktrees'),
+                          os.path.join(self.path, 'worktrees')):
+            if os.path.isdir(worktrees) and os.listdir(worktrees):
+                return True
+        return False
+
+    def has_references(self, parts):
+        """
+        True if any of ``parts`` still borrows the objects of this
+        repository through its alternates.
+        """
+        if not self.repository:
+            return False
+        objects = [os.path.realpath(os.path.join(self.path, path))
+                   for path in (os.path.join('.git', 'objects'), 'objects')]
+        for part in parts:
+            alternates = os.path.join(part, '.git', 'objects', 'info',
+                                      'alternates')
+            if not os.path.isfile(alternates):
+                continue
+            for line in open(alternates).read().splitlines():
+                if os.path.realpath(line.strip()) in objects:
+                    return True
+        return False
+
+
+def disk_usage(path):
+    """
+    Bytes used by the file or directory tree at ``path``.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def find_entries(download_cache):
+    """
+    All git entries in the download cache. Other content of the download
+    cache (e.g. the distributions buildout downloads) is left alone.
+    """
+    entries = []
+    for name in sorted(os.listdir(download_cache)):
+        path = os.path.join(download_cache, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        if name == MIRROR_DIRECTORY:
+            for mirror in sorted(os.listdir(path)):
+                if not mirror.startswith('.') and os.path.exists(
+                        os.path.join(path, mirror, 'HEAD')):
+                    entries.append(Entry(download_cache,
+                            os.path.join(name, mirror), True))
+        elif name == ARCHIVE_DIRECTORY:
+            for archive in sorted(os.listdir(path)):
+                if archive.endswith('.tar') and not archive.startswith('.'):
+                    entries.append(Entry(download_cache,
+                            os.path.join(name, archive), False))
+        elif name == TREE_DIRECTORY:
+            for tree in sorted(os.listdir(path)):
+                if not tree.startswith('.'):
+                    entries.append(Entry(download_cache,
+                            os.path.join(name, tree), False))
+        elif os.path.isdir(os.path.join(path, '.git')):
+            entries.append(Entry(download_cache, name, True))
+    return entries
+
+
+def collect(download_cache, max_size=None, max_age=None, maintain=True,
+            dry_run=False, runner=None, log=None):
+    """
+    Remove entries from the download cache as described in the module
+    documentation and maintain the repositories that are kept. Returns the
+    names of the removed entries.
+    """
+    runner = runner or GitRunner()
+    log = log or (lambda message: None)
+    usage = CacheUsage(download_cache)
+    used = usage.entries()
+    now = time.time()
+    entries = find_entries(download_cache)
+    references = usage.references()
+    for entry in entries:
+        entry.last_used = used.get(entry.name) or os.path.getmtime(entry.path)
+        entry.referenced = entry.has_references(
+                references.get(entry.name, []))
+    entries.sort(key=lambda entry: entry.last_used)
+
+    def removable(entry):
+        return now - entry.last_used > KEEP_RECENT \
+                and not entry.referenced and not entry.has_worktrees(runner)
+
+    removed = []
+    if max_age is not None:
+        for entry in entries:
+            if now - entry.last_used > max_age and removable(entry):
+                removed.append(entry)
+    if max_size is not None:
+        total = sum(entry.size for entry in entries if entry not in removed)
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry not in removed and removable(entry):
+                removed.append(entry)
+                total -= entry.size
+
+    for entry in removed:
+        log('Removing %s (%d bytes, last used %s)' % (entry.name, entry.size,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(
+                        entry.last_used))))
+        if not dry_run:
+            _remove(entry)
+    if not dry_run and removed:
+        names = [entry.name for entry in removed]
+        usage.remove(names)
+        mirrors = [os.path.basename(name) for name in names
+                   if os.path.dirname(name) == MIRROR_DIRECTORY]
+        if mirrors:
+            MirrorIndex(download_cache).remove(mirrors)
+
+    if maintain:
+        for entry in entries:
+            if entry.repository and entry not in removed:
+                log('Maintaining %s' % entry.name)
+                if not dry_run:
+                    _maintain(entry, runner)
+    return [entry.name for entry in removed]
+
+
+def _remove(entry):
+    # Move the entry out of the way under its lock, so that no buildout
+    # ever sees it half removed.
+    lock = FileLock(entry.path + '.lock')
+    lock.acquire()
+    try:
+        if not os.path.exists(entry.path):
+            return
+        parent, name = os.path.split(entry.path)
+        trash = os.path.join(parent, '.%s-removed-%d' % (name, os.getpid()))
+        os.rename(entry.path, trash)
+        fetched = entry.path + '.fetched'
+        if os.path.exists(fetched):
+            os.remove(fetched)
+    finally:
+        lock.release()
+    if os.path.isdir(trash):
+        shutil.rmtree(trash, ignore_errors=True)
+    else:
+        os.remove(trash)
+
+
+def _maintain(entry, runner):
+    lock = FileLock(entry.path + '.lock')
+    lock.acquire()
+    try:
+        args = ['gc', '--auto', '--quiet']
+        if entry.referenced:
+            # Parts may need objects that are unreachable in the entry.
+            args.append('--no-prune')
+        runner.run(args, cwd=entry.path)
+        runner.run(['commit-graph', 'write', '--reachable'], cwd=entry.path)
+    finally:
+        lock.release()
+
+
+def collect_if_due(download_cache, max_size=None, max_age=None,
+                   interval=86400, log=None):
+    """
+    Run collect() unless that happened less than ``interval`` seconds ago.
+    """
+    usage = CacheUsage(download_cache)
+    if not usage.start_gc(interval):
+        return []
+    return collect(download_cache, max_size, max_age, log=log)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] DOWNLOAD-CACHE',
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option('-s', '--max-size',
+            help="remove least recently used entries until the cache is "
+                 "smaller than this (e.g. 500M or 20G)")
+    parser.add_option('-a', '--max-age',
+            help="remove entries that were not used for this long "
+                 "(e.g. 12h or 30d)")
+    parser.add_option('--no-maintenance', dest='maintain',
+            action='store_false', default=True,
+            help="don't run git gc and commit-graph on the kept entries")
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+            help="only show what would be done")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Give the path of the download cache")
+    try:
+        max_size = options.max_size and parse_size(options.max_size)
+        max_age = options.max_age and parse_age(options.max_age)
+    except ValueError, e:
+        parser.error(str(e))
+    def log(message):
+        print message
+    collect(args[0], max_size, max_age, options.maintain, options.dry_run,
+            log=log)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+Dry runs: what installing or updating the git parts of a buildout would do.
+
+Whether a part is cloned from upstream, cloned from the download cache,
+pulled or left alone depends on ``newest``, ``offline``,
+``install-from-cache``, ``download-cache``, ``rev``, ``frozen`` and what is
+already in the download cache and the part. plan() works that out for
+every part without changing anything: upstream refs are only listed (with
+a single ``git ls-remote`` per repository, or from the ref cache) and the
+local repositories are only read::
+
+    zerokspot-git-plan -c buildout.cfg
+    zerokspot-git-plan -c buildout.cfg --json
+    zerokspot-git-plan -c buildout.cfg --prefetch
+
+Every part gets a dictionary with the ``operation`` buildout would call
+(``install`` or ``update``), the ``steps`` it would take, where its data
+comes from (``source``: ``network``, ``cache`` or ``none``), the ``sha``
+the part would end up at if it is known, and rough sizes: the number of
+``objects`` and ``bytes`` of the local repository the part is made from or
+fetched into, and how many upstream refs it is missing (``changed_refs``).
+
+With ``--prefetch`` the download cache entries of the parts that need the
+network are fetched right away, e.g. to warm the cache before a long
+buildout.
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import sys
+
+import zc.buildout
+
+from zerokspot.recipe.git.cache import ls_remote_all, resolve_ref
+from zerokspot.recipe.git.tasks import prefetch
+from zerokspot.recipe.git.trees import tree_path
+from zerokspot.recipe.git.versions import git_parts
+
+
+def _git(recipe, args, cwd):
+    return recipe.runner.run(args, cwd=cwd)
+
+
+def _has_commit(recipe, path, sha):
+    return sha is not None and os.path.exists(path) and _git(recipe,
+            ['cat-file', '-e', '%s^{commit}' % sha], path).ok
+
+
+def _local_refs(recipe, path):
+    result = _git(recipe, ['for-each-ref', '--format=%(objectname) %(refname)'],
+                  path)
+    refs = {}
+    for line in result.stdout.splitlines():
+        sha, ref = line.split(' ', 1)
+        refs[ref] = sha
+    return refs
+
+
+def count_objects(recipe, path):
+    """
+    The number of objects and the bytes they take in the repository at
+    ``path``, or (None, None) if there is none.
+    """
+    if path is None or not os.path.exists(path):
+        return None, None
+    result = _git(recipe, ['count-objects', '-v'], path)
+    if not result.ok:
+        return None, None
+    values = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition(':')
+        values[key.strip()] = value.strip()
+    objects = int(values.get('count', 0)) + int(values.get('in-pack', 0))
+    kib = int(values.get('size', 0)) + int(values.get('size-pack', 0))
+    return objects, kib * 1024
+
+
+def _changed_refs(recipe, path, refs):
+    # How many upstream refs the repository at path doesn't have yet.
+    if refs is None or not os.path.exists(path):
+        return None
+    local = _local_refs(recipe, path)
+    if recipe.mirror and path == recipe.cache_path:
+        wanted = dict((ref, sha) for ref, sha in refs.items()
+                      if not ref.endswith('^{}') and ref != 'HEAD')
+    else:
+        branch = 'refs/heads/%s' % recipe.branch
+        wanted = {}
+        if branch in refs:
+            wanted[branch] = refs[branch]
+    return len([ref for ref, sha in wanted.items()
+                if local.get(ref) != sha and local.get(
+                        ref.replace('refs/heads/', 'refs/remotes/origin/'))
+                    != sha])
+
+
+def _target(recipe, refs):
+    # The commit the part would end up at, None if unknown.
+    from zerokspot.recipe.git import SHA_RE
+    ref = recipe.rev or recipe.branch
+    if SHA_RE.match(ref):
+        return ref
+    if refs is None:
+        return None
+    return resolve_ref(refs, ref)
+
+
+def _cache_outdated(recipe, refs):
+    # Whether _do_fetch would update the download cache entry with newest,
+    # see Recipe._remote_cache_state.
+    if refs is None:
+        return True
+    if recipe.mirror:
+        remote = hashlib.sha1(repr(sorted(refs.items()))).hexdigest()
+    else:
+        remote = refs.get('refs/heads/%s' % recipe.branch)
+    return remote is None or \
+            remote != recipe.state.get('caches', recipe.cache_path)
+
+
+def _export_steps(recipe, sha):
+    extract = recipe.tree_store and 'materialize' or 'extract'
+    if not recipe.download_cache:
+        if recipe.cache_install:
+            return ['error'], 'none'
+        return ['fetch', 'archive', extract], 'network'
+    if sha is not None:
+        if recipe.tree_store and os.path.exists(
+                tree_path(recipe.download_cache, sha)):
+            return ['materialize'], 'cache'
+        if os.path.exists(recipe._archive_path(sha)):
+            return ['extract'], 'cache'
+    cache = recipe.cache_path
+    if not os.path.exists(cache):
+        if recipe.cache_install:
+            return ['error'], 'none'
+        return ['clone-upstream', 'archive', extract], 'network'
+    if recipe.cache_install or _has_commit(recipe, cache, sha):
+        return ['archive', extract], 'cache'
+    return ['fetch-cache', 'archive', extract], 'network'
+
+
+def _install_steps(recipe, refs, sha):
+    if recipe.export:
+        return _export_steps(recipe, sha)
+    if not recipe.download_cache:
+        if recipe.cache_install:
+            return ['error'], 'none'
+        return ['clone-upstream'], 'network'
+    cache = recipe.cache_path
+    if recipe.cache_install:
+        if not os.path.exists(cache):
+            return ['error'], 'none'
+        return ['clone-cache'], 'cache'
+    if not os.path.exists(cache):
+        return ['clone-upstream', 'clone-cache'], 'network'
+    if recipe.frozen:
+        if _has_commit(recipe, cache, recipe.rev):
+            return ['clone-cache'], 'cache'
+        return ['fetch-cache', 'clone-cache'], 'network'
+    if recipe.newest and _cache_outdated(recipe, refs):
+        return ['fetch-cache', 'clone-cache'], 'network'
+    return ['clone-cache'], 'cache'
+
+
+def _update_steps(recipe, refs, sha):
+    location = recipe.options['location']
+    recorded = recipe.state.get('parts', recipe.name)
+    if recipe.frozen:
+        if recorded == recipe.rev:
+            return [], 'none'
+        if recipe.export:
+            return _export_steps(recipe, sha)
+        if recipe.cache_install or _has_commit(recipe, location, sha) or \
+                (recipe.download_cache and _has_commit(recipe,
+                        recipe.cache_path, sha)):
+            return ['checkout'], 'cache'
+        return ['fetch', 'checkout'], 'network'
+    if recipe.rev is None and recipe.newest:
+        if not recipe.cache_install and sha is not None and sha == recorded:
+            return [], 'none'
+        if recipe.export:
+            return _export_steps(recipe, sha)
+        if recipe.cache_install:
+            return ['update-part'], 'cache'
+        if recipe.download_cache:
+            if not os.path.exists(recipe.cache_path) or \
+                    _cache_outdated(recipe, refs):
+                return ['fetch-cache', 'update-part'], 'network'
+            return ['update-part'], 'cache'
+        return ['fetch'], 'network'
+    if recipe.rev is not None and recipe.update_mode == 'fetch-reset' \
+            and not recipe.export:
+        head = _git(recipe, ['rev-parse', 'HEAD'], location).output
+        wanted = _git(recipe, ['rev-parse', '--verify',
+                               '%s^{commit}' % recipe.rev], location)
+        if wanted.ok and head == wanted.output:
+            return [], 'none'
+        if wanted.ok:
+            return ['checkout'], 'cache'
+        return ['fetch', 'checkout'], 'network'
+    return [], 'none'
+
+
+def plan_part(recipe, refs=None):
+    """
+    What installing or updating the part of ``recipe`` would do, as
+    described in the module documentation. ``refs`` are the upstream refs
+    of its repository, None if they are unknown.
+    """
+    location = recipe.options['location']
+    sha = _target(recipe, refs)
+    if os.path.exists(location):
+        operation = 'update'
+        steps, source = _update_steps(recipe, refs, sha)
+    else:
+        operation = 'install'
+        steps, source = _install_steps(recipe, refs, sha)
+    if steps and 'error' not in steps:
+        if recipe.recursive:
+            steps.append('submodules')
+        if recipe.as_egg:
+            steps.append('develop')
+    repository = recipe.cache_path or (os.path.exists(location)
+                                       and not recipe.export and location
+                                       or None)
+    objects, size = count_objects(recipe, repository)
+    changed = None
+    if source == 'network' and repository is not None:
+        changed = _changed_refs(recipe, repository, refs)
+    return {
+        'part': recipe.name,
+        'repository': recipe.repository,
+        'operation': operation,
+        'steps': steps,
+        'source': source,
+        'sha': sha,
+        'objects': objects,
+        'bytes': size,
+        'changed_refs': changed,
+    }
+
+
+def _needs_refs(recipe):
+    from zerokspot.recipe.git import SHA_RE
+    return not recipe.cache_install and not recipe.frozen and \
+            not SHA_RE.match(recipe.rev or recipe.branch)
+
+
+def plan(recipes, runner=None):
+    """
+    Plan every recipe (see plan_part). The upstream refs are taken from
+    the ref cache if it has them, otherwise they are listed with one
+    ls-remote per repository, all at the same time.
+    """
+    refs = {}
+    missing = []
+    for recipe in recipes:
+        if not _needs_refs(recipe) or recipe.repository in refs:
+            continue
+        cached = recipe.ref_cache is not None and recipe.ref_cache.get(
+                recipe.repository, recipe.ref_cache_ttl)
+        if cached:
+            refs[recipe.repository] = cached
+        else:
+            missing.append(recipe.repository)
+    refs.update(ls_remote_all(missing, runner))
+    return [plan_part(recipe, refs.get(recipe.repository))
+            for recipe in recipes]
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option('-c', '--config', default='buildout.cfg',
+            help="the buildout configuration (default: %default)")
+    parser.add_option('--json', action='store_true', default=False,
+            help="print the plan as JSON")
+    parser.add_option('--prefetch', action='store_true', default=False,
+            help="fetch the download cache entries that need the network")
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error("Unexpected arguments: %s" % ' '.join(args))
+    try:
+        recipes = git_parts(os.path.abspath(options.config))
+        planned = plan(recipes)
+    except zc.buildout.UserError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    if options.json:
+        print json.dumps(planned, indent=2, sort_keys=True)
+    else:
+        for entry in planned:
+            print '%-20s %-8s %-8s %-40s %s' % (entry['part'],
+                    entry['operation'], entry['source'],
+                    ', '.join(entry['steps']) or 'nothing',
+                    entry['sha'] and entry['sha'][:12] or '?')
+    if options.prefetch:
+        fetching = [recipe for recipe, entry in zip(recipes, planned)
+                    if entry['source'] == 'network' and recipe.download_cache]
+        for future in prefetch(fetching):
+            if future.exception() is not None:
+                sys.stderr.write('%s\n' % future.exception())
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+SSH multiplexing for the mirrors of the download cache.
+
+With ``git-proxy = true`` in the ``[buildout]`` section, parts are only
+ever cloned and updated from the mirrors in ``<download-cache>/git`` (the
+``mirror`` layout), every mirror is refreshed at most once per buildout run
+and SSH connections to every upstream host are kept open by a master
+connection (OpenSSH's ``ControlMaster``) that all git calls of all
+buildouts sharing the download cache reuse. A master stays open for
+``git-proxy-persist`` seconds (default: 600) after its last use, so the
+next buildout doesn't have to set up SSH again either.
+
+No proxy process is started. git can't share connections between its
+processes for the other transports, ``git://`` and HTTP(S) upstreams only
+profit from the single refresh per mirror.
+
+The masters can be listed and closed from the command line::
+
+    zerokspot-git-proxy status /path/to/download-cache
+    zerokspot-git-proxy stop /path/to/download-cache
+"""
+
+import hashlib
+import optparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+from zerokspot.recipe.git.cache import MIRROR_DIRECTORY
+
+
+CONTROL_DIRECTORY = 'ssh'
+# Unix socket paths can't be longer than this on some systems.
+MAX_SOCKET_PATH = 100
+
+
+def control_directory(download_cache):
+    """
+    The directory with the control sockets of the SSH masters of the
+    download cache. If the download cache is nested too deep for socket
+    paths, a directory in the temporary directory named after it is used.
+    """
+    path = os.path.join(os.path.abspath(download_cache), MIRROR_DIRECTORY,
+                        CONTROL_DIRECTORY)
+    # ssh names the sockets after a 40 character hash (%C).
+    if len(path) + 41 > MAX_SOCKET_PATH:
+        path = os.path.join(tempfile.gettempdir(), 'zerokspot-git-%s' %
+                hashlib.sha1(os.path.abspath(download_cache)).hexdigest()[:12])
+    return path
+
+
+def ssh_command():
+    """
+    The command git runs for SSH.
+    """
+    return os.environ.get('GIT_SSH_COMMAND', 'ssh')
+
+
+def ssh_environment(download_cache, persist=600):
+    """
+    Environment variables that make git's SSH connections go through the
+    masters of the download cache. Empty if GIT_SSH names a program, which
+    might not understand OpenSSH's options.
+    """
+    if os.environ.get('GIT_SSH') and not os.environ.get('GIT_SSH_COMMAND'):
+        return {}
+    directory = control_directory(download_cache)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+        os.chmod(directory, 0700)
+    command = ssh_command()
+    return {'GIT_SSH_COMMAND': '%s -o ControlMaster=auto -o ControlPath=%s '
+                               '-o ControlPersist=%d' % (command,
+                                       os.path.join(directory, '%C'),
+                                       persist)}
+
+
+def _control(socket, command):
+    # With a ControlPath without tokens ssh doesn't need the real host.
+    process = subprocess.Popen(shlex.split(ssh_command()) +
+                               ['-o', 'ControlPath=%s' % socket,
+                                '-O', command, 'proxy'],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+    return process.returncode == 0
+
+
+def masters(download_cache):
+    """
+    The control sockets of the masters of the download cache that are
+    still running.
+    """
+    directory = control_directory(download_cache)
+    if not os.path.isdir(directory):
+        return []
+    sockets = [os.path.join(directory, name)
+               for name in sorted(os.listdir(directory))]
+    return [socket for socket in sockets if _control(socket, 'check')]
+
+
+def stop(download_cache):
+    """
+    Close all masters of the download cache. Returns their sockets.
+    """
+    stopped = []
+    for socket in masters(download_cache):
+        if _control(socket, 'exit'):
+            stopped.append(socket)
+    return stopped
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+            usage='%prog status|stop DOWNLOAD-CACHE',
+            description=__doc__.split('\n\n')[0])
+    options, args = parser.parse_args(args)
+    if len(args) != 2 or args[0] not in ('status', 'stop'):
+        parser.error("Give a command and the download cache")
+    if args[0] == 'status':
+        sockets = masters(args[1])
+    else:
+        sockets = stop(args[1])
+    for socket in sockets:
+        print socket
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Runs git without a shell, capturing its output and how long it took.
+"""
+
+import os
+import sys
+import subprocess
+import threading
+import time
+import zc.buildout
+
+
+class GitResult(object):
+    """
+    Outcome of a single git call.
+    """
+
+    def __init__(self, args, cwd, status, stdout, stderr, duration,
+                 timed_out=False):
+        self.args = args
+        self.cwd = cwd
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.status == 0 and not self.timed_out
+
+    @property
+    def output(self):
+        """
+        The stripped stdout of the call.
+        """
+        return self.stdout.strip()
+
+    def __repr__(self):
+        return '<GitResult %s: %d in %.3fs>' % (
+                ' '.join(self.args), self.status, self.duration)
+
+
+class GitRunner(object):
+    """
+    Calls git with an argument list. ``env`` is merged into the environment
+    of every call and ``timeout`` (in seconds) is the default for calls that
+    don't set their own. Every result is kept in ``results``.
+    """
+
+    def __init__(self, executable='git', env=None, timeout=None):
+        self.executable = executable
+        self.env = env or {}
+        self.timeout = timeout
+        self.results = []
+
+    def run(self, args, message=None, cwd=None, env=None, timeout=None,
+            ignore_errnos=None, echo=False, stdout=None):
+        """
+        Run git with the given arguments and return a GitResult. If message
+        is given, a failing call raises a UserError with that message and
+        git's error output, unless its status is in ignore_errnos. With
+        echo, the captured output is passed on to stdout and stderr. If
+        stdout is a file, git's output is written to it instead of being
+        captured.
+        """
+        args = [self.executable] + list(args)
+        call_env = None
+        if self.env or env:
+            call_env = dict(os.environ)
+            call_env.update(self.env)
+            call_env.update(env or {})
+        if timeout is None:
+            timeout = self.timeout
+
+        start = time.time()
+        try:
+            process = subprocess.Popen(args, cwd=cwd, env=call_env,
+                                       stdout=stdout or subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError, e:
+            raise zc.buildout.UserError("Couldn't run %s: %s" % (
+                    self.executable, e))
+        timer = None
+        timed_out = []
+        if timeout:
+            def kill():
+                timed_out.append(True)
+                process.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            output, stderr = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        result = GitResult(args, cwd, process.returncode, output or '', stderr,
+                           time.time() - start, bool(timed_out))
+        self.results.append(result)
+
+        if echo:
+            sys.stdout.write(result.stdout)
+            sys.stderr.write(stderr)
+        if message is not None and not result.ok \
+                and result.status not in (ignore_errnos or []):
+            if result.timed_out:
+                message = '%s (timed out after %s seconds)' % (
+                        message, timeout)
+            details = stderr.strip()
+            if details:
+                message = '%s:\n%s' % (message, details)
+            raise zc.buildout.UserError(message)
+        return result
+
+
+def retry(func, retries=0, delay=1.0, log=None, sleep=time.sleep):
+    """
+    Call ``func`` until it doesn't raise a UserError, at most ``retries``
+    more times after the first failure. The first retry waits ``delay``
+    seconds, every further one twice as long as the one before. ``log`` is
+    called with the error and the delay before every retry. Returns what
+    ``func`` returned.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except zc.buildout.UserError, e:
+            if attempt >= retries:
+                raise
+            wait = delay * 2 ** attempt
+            if log is not None:
+                log(e, wait)
+            sleep(wait)
+            attempt += 1
@@ -0,0 +1,247 @@
+"""
+Process-wide scheduler that runs the network part of all git parts of a
+buildout on a bounded pool of worker threads.
+
+zc.buildout initializes every recipe before it installs or updates the
+first part. Each Recipe registers its fetch with the scheduler in its
+constructor, the first part that actually needs its fetch starts all of
+them and every part then only waits for its own result. With a single job
+(the default) fetches run one after another when they are needed, but are
+still only run once per key. Work that would get in the way of the parts
+(like maintaining the download cache entries they clone from) can be put
+off until all of them are done.
+"""
+
+import threading
+import weakref
+
+from zerokspot.recipe.git.tasks import Future
+
+
+# Maps id(buildout) to a weak reference to the buildout and its scheduler.
+# Buildout objects are not hashable, so a WeakKeyDictionary can't be used.
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(buildout):
+    """
+    Return the scheduler of the given buildout. It runs up to
+    ``git-parallel-jobs`` fetches at the same time.
+    """
+    jobs = int(buildout['buildout'].get('git-parallel-jobs', 1))
+    _schedulers_lock.acquire()
+    try:
+        key = id(buildout)
+        if key not in _schedulers:
+            def forget(ref):
+                _schedulers.pop(key, None)
+            _schedulers[key] = (weakref.ref(buildout, forget),
+                                FetchScheduler(jobs))
+        return _schedulers[key][1]
+    finally:
+        _schedulers_lock.release()
+
+
+class _Task(Future):
+    """
+    A single fetch together with its outcome.
+    """
+
+    def __init__(self, func):
+        Future.__init__(self)
+        self.func = func
+
+    def run(self):
+        self.call(self.func)
+
+
+class FetchScheduler(object):
+    """
+    Runs registered fetches on at most ``jobs`` worker threads, or in the
+    waiting thread if ``jobs`` is 1. Fetches are identified by a key and a
+    key that is registered more than once is only fetched once.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._once = {}
+        self._locks = {}
+        self._deferred = {}
+        self._parts = 0
+        self._after_parts = []
+        self._queue = []
+        self._workers = 0
+        self._started = False
+
+    def register(self, key, func):
+        """
+        Register ``func`` as the fetch for ``key``. If the key is already
+        known, the call is ignored.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._tasks:
+                return
+            task = self._tasks[key] = _Task(func)
+            self._queue.append(task)
+            if self._started:
+                self._spawn()
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """
+        Start the worker threads. Calling this more than once is harmless.
+        wait() does so by itself unless ``jobs`` is 1.
+        """
+        self._lock.acquire()
+        try:
+            if self._started:
+                return
+            self._started = True
+            self._spawn()
+        finally:
+            self._lock.release()
+
+    def wait(self, key):
+        """
+        Start fetching if that has not happened yet and block until the
+        fetch for ``key`` is done. Exceptions raised by the fetch are
+        re-raised here.
+        """
+        task = self._tasks[key]
+        if self.jobs > 1:
+            self.start()
+        else:
+            self._lock.acquire()
+            try:
+                pending = task in self._queue
+                if pending:
+                    self._queue.remove(task)
+            finally:
+                self._lock.release()
+            if pending:
+                task.run()
+        return task.result()
+
+    def future(self, key):
+        """
+        The Future of the fetch for ``key``. It only completes once the
+        scheduler was started or someone waited for the key.
+        """
+        return self._tasks[key]
+
+    def once(self, key, func):
+        """
+        Run ``func`` in the calling thread and return its result, unless it
+        already ran (or is running) for ``key``, in which case its result
+        is returned once it is available.
+        """
+        self._lock.acquire()
+        try:
+            task = self._once.get(key)
+            owner = task is None
+            if owner:
+                task = self._once[key] = _Task(func)
+        finally:
+            self._lock.release()
+        if owner:
+            task.run()
+        return task.result()
+
+    def defer(self, key, func):
+        """
+        Remember ``func`` to be called by run_deferred(), once per key.
+        """
+        self._lock.acquire()
+        try:
+            self._deferred.setdefault(key, func)
+        finally:
+            self._lock.release()
+
+    def run_deferred(self):
+        """
+        Call and forget the functions given to defer() so far.
+        """
+        self._lock.acquire()
+        try:
+            deferred, self._deferred = self._deferred, {}
+        finally:
+            self._lock.release()
+        for func in deferred.values():
+            func()
+
+    def add_part(self):
+        """
+        Count a part that is going to be installed or updated, see
+        after_parts().
+        """
+        self._lock.acquire()
+        try:
+            self._parts += 1
+        finally:
+            self._lock.release()
+
+    def part_done(self):
+        """
+        A part counted by add_part() is done. Once the last one is, the
+        functions given to after_parts() are called.
+        """
+        self._lock.acquire()
+        try:
+            self._parts -= 1
+            if self._parts > 0:
+                return
+            after, self._after_parts = self._after_parts, []
+        finally:
+            self._lock.release()
+        for func in after:
+            func()
+
+    def after_parts(self, func):
+        """
+        Call ``func`` once every part counted by add_part() is done, right
+        away if they already are. Nothing is called for parts that never
+        finish, e.g. because another part failed.
+        """
+        self._lock.acquire()
+        try:
+            if self._parts > 0:
+                self._after_parts.append(func)
+                return
+        finally:
+            self._lock.release()
+        func()
+
+    def lock(self, key):
+        """
+        A lock that is shared by everyone asking for the same key.
+        """
+        self._lock.acquire()
+        try:
+            return self._locks.setdefault(key, threading.Lock())
+        finally:
+            self._lock.release()
+
+    def _spawn(self):
+        # Must be called with self._lock held.
+        while self._workers < min(self.jobs, len(self._queue)):
+            self._workers += 1
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _work(self):
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._queue:
+                    self._workers -= 1
+                    return
+                task = self._queue.pop(0)
+            finally:
+                self._lock.release()
+            task.run()
@@ -0,0 +1,132 @@
+"""
+Small JSON files the recipe keeps next to a buildout and in the download
+cache to remember what it fetched.
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; only threads are kept apart there.
+    fcntl = None
+
+
+STATE_FILE = '.zerokspot.recipe.git.json'
+
+_lock = threading.Lock()
+
+
+class FileLock(object):
+    """
+    An exclusive lock on ``path`` that is shared between processes. The
+    file is created if necessary and left behind on release.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._fp = open(self.path, 'a')
+        fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        if self._fp is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = None
+
+
+class JSONFile(object):
+    """
+    A JSON object stored in a file. Changes are written atomically by
+    writing a temporary file and renaming it over the old one, and are
+    serialized between threads and processes by a lock file next to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """
+        Return the content of the file or an empty dictionary if the file
+        does not exist or is broken.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        fp = open(self.path)
+        try:
+            try:
+                return json.load(fp)
+            except ValueError:
+                return {}
+        finally:
+            fp.close()
+
+    def modify(self, func):
+        """
+        Call ``func`` with the current content and write the result back.
+        """
+        _lock.acquire()
+        lock = FileLock(self.path + '.lock')
+        try:
+            lock.acquire()
+            data = self.read()
+            func(data)
+            self._write(data)
+        finally:
+            lock.release()
+            _lock.release()
+
+    def write(self, data):
+        """
+        Replace the content of the file.
+        """
+        _lock.acquire()
+        lock = FileLock(self.path + '.lock')
+        try:
+            lock.acquire()
+            self._write(data)
+        finally:
+            lock.release()
+            _lock.release()
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory,
+                prefix='.%s' % os.path.basename(self.path))
+        fp = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+        os.rename(temp, self.path)
+
+
+class State(JSONFile):
+    """
+    What the recipe last fetched in a buildout: the SHA every part was left
+    at and the remote refs each download cache entry was last updated to.
+    """
+
+    def __init__(self, buildout_directory):
+        JSONFile.__init__(self, os.path.join(buildout_directory, STATE_FILE))
+
+    def get(self, section, key):
+        return self.read().get(section, {}).get(key)
+
+    def set(self, section, key, value):
+        def change(data):
+            data.setdefault(section, {})[key] = value
+        self.modify(change)
@@ -0,0 +1,162 @@
+"""
+Asynchronous API for the recipe's git operations.
+
+The recipe has to run on the Python 2 interpreters zc.buildout supports,
+so there is no asyncio here. Operations are run on threads instead and
+return a Future, which can be waited for, combined with wait_all() or
+given callbacks. The synchronous entry points zc.buildout uses
+(Recipe.install and Recipe.update) are unaffected.
+"""
+
+import atexit
+import sys
+import threading
+
+
+# Futures of background() that the interpreter waits for before it exits.
+_background = []
+_background_lock = threading.Lock()
+
+
+class Future(object):
+    """
+    The eventual result of an operation running in the background.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self):
+        """
+        Wait for the operation and return its result. Exceptions raised by
+        the operation are raised here.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        """
+        Wait for the operation and return the exception it raised, if any.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, func):
+        """
+        Call ``func`` with the future once it is done (right away if it
+        already is).
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run ``func`` in the calling thread and use its outcome as the
+        result of the future.
+        """
+        try:
+            self._result = func(*args, **kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+
+def spawn(func, *args, **kwargs):
+    """
+    Run ``func`` on a new thread and return a Future for its result.
+    """
+    future = Future()
+    thread = threading.Thread(target=future.call, args=(func, ) + args,
+                              kwargs=kwargs)
+    thread.setDaemon(True)
+    thread.start()
+    return future
+
+
+def background(func, *args, **kwargs):
+    """
+    Like spawn(), for work nobody waits for (e.g. repository maintenance).
+    The interpreter waits for it before it exits, see wait_background().
+    """
+    future = spawn(func, *args, **kwargs)
+    _background_lock.acquire()
+    try:
+        _background.append(future)
+    finally:
+        _background_lock.release()
+    return future
+
+
+def wait_background():
+    """
+    Wait for everything started with background(). Failures are ignored.
+    """
+    while True:
+        _background_lock.acquire()
+        try:
+            if not _background:
+                return
+            future = _background.pop(0)
+        finally:
+            _background_lock.release()
+        future.exception()
+
+
+atexit.register(wait_background)
+
+
+def wait_all(futures):
+    """
+    Wait for all futures and return their results in order. If any of them
+    failed, the first failure is raised once all of them are done.
+    """
+    futures = list(futures)
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
+
+
+def git_async(operation, args, message, **kwargs):
+    """
+    Asynchronous version of zerokspot.recipe.git.git().
+    """
+    from zerokspot.recipe.git import git
+    return spawn(git, operation, args, message, **kwargs)
+
+
+def prefetch(recipes, jobs=4):
+    """
+    Start the fetches (see Recipe.run_async('fetch')) of many recipes, even
+    of different buildouts, on at most ``jobs`` threads. Recipes sharing a
+    download cache entry share one fetch. Returns a Future per recipe.
+    """
+    from zerokspot.recipe.git.scheduler import FetchScheduler
+    scheduler = FetchScheduler(jobs)
+    for recipe in recipes:
+        scheduler.register(recipe._fetch_key(), recipe._do_fetch)
+    scheduler.start()
+    return [scheduler.future(recipe._fetch_key()) for recipe in recipes]
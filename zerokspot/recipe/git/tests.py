@@ -62,6 +62,363 @@ class UtilsTests(unittest.TestCase):
             'test@1234', get_reponame('http://domain.com/test.git', 'cool-feature', '1234'))
 
 
+    def testNormalizeUrl(self):
+        """
+        Spellings of the same repository URL are normalized to one.
+        """
+        from zerokspot.recipe.git.cache import normalize_url, mirror_name
+        tests = (
+                'https://Domain.com/test/repo.git',
+                'https://user@domain.com:443/test/repo/',
+                'ssh://git@domain.com/test/repo.git',
+                'git@domain.com:test/repo',
+                'domain.com:test/repo.git',
+                )
+        for t in tests:
+            self.assertEqual('domain.com/test/repo', normalize_url(t))
+        self.assertEqual(normalize_url('/tmp/repo.git'),
+                         normalize_url('file:///tmp/repo'))
+        self.assertNotEqual(mirror_name('https://a.com/x.git'),
+                            mirror_name('git@b.com:x'))
+
+
+    def testResolveUrl(self):
+        """
+        Relative submodule URLs are resolved against the superproject.
+        """
+        from zerokspot.recipe.git.cache import resolve_url
+        self.assertEqual('https://domain.com/org/other.git',
+                resolve_url('../other.git', 'https://domain.com/org/repo.git'))
+        self.assertEqual('git@domain.com:org/other',
+                resolve_url('../other', 'git@domain.com:org/repo/'))
+        self.assertEqual('/repos/repo/sub',
+                resolve_url('./sub', '/repos/repo'))
+        self.assertEqual('https://other.com/x',
+                resolve_url('https://other.com/x', '/repos/repo'))
+
+
+class SchedulerTests(unittest.TestCase):
+    """
+    Test cases for the fetch scheduler.
+    """
+
+    def testDeduplicate(self):
+        """
+        A key registered twice is only fetched once.
+        """
+        from zerokspot.recipe.git.scheduler import FetchScheduler
+        calls = []
+        scheduler = FetchScheduler(2)
+        scheduler.register('a', lambda: calls.append('a') or 'A')
+        scheduler.register('a', lambda: calls.append('a2'))
+        scheduler.register('b', lambda: calls.append('b') or 'B')
+        self.assertEqual('A', scheduler.wait('a'))
+        self.assertEqual('B', scheduler.wait('b'))
+        self.assertEqual(['a', 'b'], sorted(calls))
+
+    def testError(self):
+        """
+        Errors of a fetch are raised when waiting for it.
+        """
+        from zerokspot.recipe.git.scheduler import FetchScheduler
+        def fail():
+            raise zc.buildout.UserError('fail')
+        scheduler = FetchScheduler(2)
+        scheduler.register('a', fail)
+        self.assertRaises(zc.buildout.UserError, scheduler.wait, 'a')
+
+    def testSerial(self):
+        """
+        With a single job fetches run in the waiting thread, once per key.
+        """
+        import threading
+        from zerokspot.recipe.git.scheduler import FetchScheduler
+        threads = []
+        scheduler = FetchScheduler(1)
+        scheduler.register('a', lambda: threads.append(threading.currentThread()))
+        scheduler.wait('a')
+        scheduler.wait('a')
+        self.assertEqual([threading.currentThread()], threads)
+
+    def testAfterParts(self):
+        """
+        Functions given to after_parts() are called once the last part is
+        done.
+        """
+        from zerokspot.recipe.git.scheduler import FetchScheduler
+        calls = []
+        scheduler = FetchScheduler(1)
+        scheduler.add_part()
+        scheduler.add_part()
+        scheduler.after_parts(lambda: calls.append('a'))
+        scheduler.part_done()
+        self.assertEqual([], calls)
+        scheduler.part_done()
+        self.assertEqual(['a'], calls)
+        scheduler.after_parts(lambda: calls.append('b'))
+        self.assertEqual(['a', 'b'], calls)
+
+
+class TasksTests(unittest.TestCase):
+    """
+    Test cases for the asynchronous API.
+    """
+
+    def testFuture(self):
+        """
+        Results, errors and callbacks of spawned operations.
+        """
+        from zerokspot.recipe.git.tasks import spawn, wait_all
+        done = []
+        future = spawn(lambda x: x * 2, 21)
+        future.add_done_callback(done.append)
+        self.assertEqual([42, 'a'], wait_all([future, spawn(lambda: 'a')]))
+        self.assertEqual([future], done)
+        def fail():
+            raise zc.buildout.UserError('fail')
+        failing = spawn(fail)
+        self.assertRaises(zc.buildout.UserError, wait_all, [failing, future])
+        self.assertTrue(isinstance(failing.exception(), zc.buildout.UserError))
+
+    def testGitAsync(self):
+        from zerokspot.recipe.git.tasks import git_async
+        future = git_async('version', (), 'Failed', verbose=True)
+        self.assertTrue(future.result().output.startswith('git version'))
+
+
+class RunnerTests(unittest.TestCase):
+    """
+    Test cases for the git runner.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        testing.system('cd %s && git init' % self.tempdir)
+
+    def tearDown(self):
+        testing.rmdir(self.tempdir)
+
+    def testCapture(self):
+        """
+        Output, status and duration are recorded, arguments with quotes are
+        passed on unchanged.
+        """
+        from zerokspot.recipe.git.runner import GitRunner
+        runner = GitRunner()
+        runner.run(['config', 'test.value', 'a "quoted" value'],
+                   cwd=self.tempdir)
+        result = runner.run(['config', 'test.value'], cwd=self.tempdir)
+        self.assertTrue(result.ok)
+        self.assertEqual('a "quoted" value', result.output)
+        self.assertEqual(2, len(runner.results))
+        self.assertTrue(result.duration >= 0)
+
+    def testError(self):
+        """
+        Failing calls include git's error output in the UserError.
+        """
+        from zerokspot.recipe.git.runner import GitRunner
+        runner = GitRunner()
+        try:
+            runner.run(['checkout', 'does-not-exist'], 'Failed',
+                       cwd=self.tempdir)
+        except zc.buildout.UserError, e:
+            self.assertTrue('does-not-exist' in str(e))
+        else:
+            self.fail('No UserError raised')
+        result = runner.run(['checkout', 'does-not-exist'], cwd=self.tempdir)
+        self.assertFalse(result.ok)
+
+    def testEnvAndTimeout(self):
+        """
+        Environment overrides are passed to git and calls can time out.
+        """
+        from zerokspot.recipe.git.runner import GitRunner
+        runner = GitRunner(env={'GIT_AUTHOR_NAME': 'Runner Test'})
+        result = runner.run(['var', 'GIT_AUTHOR_IDENT'], cwd=self.tempdir)
+        self.assertTrue(result.output.startswith('Runner Test'))
+        runner = GitRunner(executable='sleep')
+        result = runner.run(['5'], timeout=0.1)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+
+    def testRetry(self):
+        """
+        Failures are retried with exponential backoff until the retries are
+        used up.
+        """
+        from zerokspot.recipe.git.runner import retry
+        calls = []
+        waits = []
+        def flaky():
+            calls.append(True)
+            if len(calls) < 3:
+                raise zc.buildout.UserError('flaky')
+            return 'done'
+        self.assertEqual('done', retry(flaky, 3, 0.5, sleep=waits.append))
+        self.assertEqual([0.5, 1.0], waits)
+        del calls[:]
+        self.assertRaises(zc.buildout.UserError, retry, flaky, 1, 0.5,
+                          sleep=waits.append)
+        self.assertEqual(2, len(calls))
+
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Test cases for the benchmark harness.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        testing.rmdir(self.tempdir)
+
+    def testParseSize(self):
+        from zerokspot.recipe.git.benchmark import parse_size, SIZES
+        self.assertEqual(('medium', SIZES['medium']), parse_size('medium'))
+        name, params = parse_size('commits=3,blob-size=10')
+        self.assertEqual(3, params['commits'])
+        self.assertEqual(10, params['blob_size'])
+        self.assertEqual(SIZES['small']['files'], params['files'])
+        self.assertRaises(ValueError, parse_size, 'colors=3')
+
+    def testMakeRepository(self):
+        from zerokspot.recipe.git.benchmark import make_repository, \
+                add_commit
+        path = make_repository(os.path.join(self.tempdir, 'repo.git'),
+                               commits=3, files=4, blob_size=10, branches=2,
+                               submodules=1)
+        def git(command, path=path):
+            return os.popen('cd %s && git %s' % (path, command)).read().strip()
+        self.assertEqual('4', git('rev-list --count master'))
+        self.assertEqual(['branch-0', 'branch-1', 'master'],
+                         git('for-each-ref "--format=%(refname:short)" refs/heads').split())
+        self.assertTrue('../repo-sub0.git' in git('show master:.gitmodules'))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'repo-sub0.git')))
+        add_commit(path)
+        self.assertEqual('5', git('rev-list --count master'))
+
+    def testScenario(self):
+        from zerokspot.recipe.git.benchmark import make_repository, \
+                run_scenario
+        upstream = make_repository(os.path.join(self.tempdir, 'repo.git'),
+                                   commits=2, files=2, blob_size=10)
+        cache = os.path.join(self.tempdir, 'cache')
+        work = os.path.join(self.tempdir, 'work')
+        os.mkdir(cache)
+        os.mkdir(work)
+        cwd = os.getcwd()
+        seconds, calls = run_scenario('file://%s' % upstream, upstream,
+                cache, {'cache-layout': 'mirror'}, {}, work)
+        self.assertEqual(cwd, os.getcwd())
+        self.assertEqual(['install', 'noop-update', 'update', 'warm-install'],
+                         sorted(seconds))
+        self.assertEqual(1, calls['noop-update'])
+
+    def testCompare(self):
+        from zerokspot.recipe.git.benchmark import compare
+        def report(install, update):
+            return {'results': [{'size': 'small', 'transport': 'file',
+                                 'scenario': 'no-cache',
+                                 'seconds': {'install': install,
+                                             'update': update}}]}
+        self.assertEqual([(('small', 'file', 'no-cache'), 'install', 1.0, 2.0)],
+                         compare(report(2.0, 0.03), report(1.0, 0.01)))
+        self.assertEqual([], compare(report(1.1, 0.01), report(1.0, 0.01)))
+
+
+class MaintenanceTests(unittest.TestCase):
+    """
+    Test cases for the garbage collection of the download cache.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tempdir, 'cache')
+        self.repo = os.path.join(self.tempdir, 'repo')
+        testing.system('git init -q %s && cd %s && echo 1 > file && git add file && git commit -q -m init' % (self.repo, self.repo))
+        os.makedirs(os.path.join(self.cache, 'git'))
+        os.makedirs(os.path.join(self.cache, 'git-archives'))
+        os.makedirs(os.path.join(self.cache, 'dist'))
+        testing.system('git clone -q %s %s' % (self.repo, os.path.join(self.cache, 'old')))
+        testing.system('git clone -q %s %s' % (self.repo, os.path.join(self.cache, 'new')))
+        testing.system('git clone -q --mirror %s %s' % (self.repo, os.path.join(self.cache, 'git', 'mirror')))
+        testing.write(self.cache, 'git-archives', 'abc.tar', 'x' * 100)
+        testing.write(self.cache, 'dist', 'egg.tar.gz', 'x')
+        import time
+        from zerokspot.recipe.git.cache import CacheUsage
+        usage = CacheUsage(self.cache)
+        def age(data):
+            now = time.time()
+            data['entries'] = {'old': now - 10 * 86400,
+                               'new': now - 2 * 3600,
+                               os.path.join('git', 'mirror'): now - 3 * 86400,
+                               os.path.join('git-archives', 'abc.tar'):
+                                    now - 20 * 86400}
+        usage.modify(age)
+
+    def tearDown(self):
+        testing.rmdir(self.tempdir)
+
+    def testParse(self):
+        from zerokspot.recipe.git.maintenance import parse_size, parse_age
+        self.assertEqual(1536, parse_size('1.5K'))
+        self.assertEqual(20 * 1024 ** 3, parse_size('20G'))
+        self.assertEqual(100, parse_size('100'))
+        self.assertEqual(2 * 86400, parse_age('2d'))
+        self.assertEqual(90, parse_age('90'))
+        self.assertRaises(ValueError, parse_size, '20X')
+        self.assertRaises(ValueError, parse_age, 'soon')
+
+    def testMaxAge(self):
+        from zerokspot.recipe.git.maintenance import collect
+        from zerokspot.recipe.git.cache import CacheUsage
+        removed = collect(self.cache, max_age=5 * 86400)
+        self.assertEqual(sorted(['git-archives/abc.tar', 'old']),
+                         sorted(removed))
+        self.assertEqual(sorted(['dist', 'git', 'git-archives', 'new']),
+                         sorted(name for name in os.listdir(self.cache)
+                                if not name.startswith('.')
+                                and not name.endswith('.lock')))
+        self.assertFalse('old' in CacheUsage(self.cache).entries())
+        self.assertTrue(os.path.exists(os.path.join(self.cache, 'new', '.git',
+                'objects', 'info', 'commit-graph')))
+
+    def testMaxSize(self):
+        from zerokspot.recipe.git.maintenance import collect
+        removed = collect(self.cache, max_size=0, maintain=False)
+        # Entries used within the last hour would be kept.
+        self.assertEqual(['git-archives/abc.tar', 'old', 'git/mirror', 'new'],
+                         removed)
+        self.assertTrue(os.path.exists(os.path.join(self.cache, 'dist',
+                                                    'egg.tar.gz')))
+
+    def testReferences(self):
+        """
+        Entries whose objects parts still borrow are kept, references of
+        parts that are gone are ignored.
+        """
+        from zerokspot.recipe.git.maintenance import collect
+        from zerokspot.recipe.git.cache import CacheUsage
+        old = os.path.join(self.cache, 'old')
+        part = os.path.join(self.tempdir, 'part')
+        gone = os.path.join(self.tempdir, 'gone')
+        testing.system('git clone -q --shared %s %s' % (old, part))
+        usage = CacheUsage(self.cache)
+        usage.add_reference(old, part)
+        usage.add_reference(os.path.join(self.cache, 'new'), gone)
+        removed = collect(self.cache, max_age=86400)
+        self.assertEqual(sorted(['git-archives/abc.tar', 'git/mirror']),
+                         sorted(removed))
+        testing.system('cd %s && git status -s && git fsck -q' % part)
+
+    def testDryRun(self):
+        from zerokspot.recipe.git.maintenance import main
+        main(['--max-age', '1d', '--dry-run', self.cache])
+        self.assertTrue(os.path.exists(os.path.join(self.cache, 'old')))
+
+
 class RecipeTests(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
@@ -179,74 +536,1305 @@ repository = %(repo)s
         self.assertTrue(os.path.exists(os.path.join(recipe.options['location'], 'test2.txt')))
         self._buildout()
 
-    def testSingleEgg(self):
-        repo = 'git://github.com/zerok/zerokspot.gitrecipe.git'
+    def testParallel(self):
+        """
+        Tests if parts sharing a repository are fetched in parallel.
+        """
         testing.write(self.tempdir, 'buildout.cfg', """
 [buildout]
-parts = gittest
+parts = gittest gittest2
+download-cache = %(cache)s
+git-parallel-jobs = 2
 
 [gittest]
 recipe = zerokspot.recipe.git
 repository = %(repo)s
-as_egg = true
-        """ % {'repo': repo})
-        buildout = self._buildout()
-        installs = os.listdir(buildout['buildout']['develop-eggs-directory'])
-        self.assertTrue('zerokspot.recipe.git.egg-link' in installs)
 
-    def testRecursive(self):
+[gittest2]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        build = self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest', 'test.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest2', 'test.txt')))
+        self.assertEqual(build['gittest'].recipe.scheduler,
+                         build['gittest2'].recipe.scheduler)
+        self._buildout()
+
+    def _git_output(self, path, command):
+        return os.popen('cd %s && git %s' % (path, command)).read().strip()
+
+    def testShallow(self):
         """
-        Tests if install works for recursive clone
+        Tests if shallow clones stay shallow when updated.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = file://%(repo)s
+depth = 1
+single-branch = true
+newest = true
+        """ % {'repo' : self.temprepo})
+        self._buildout()
+        location = os.path.join(self.tempdir, 'parts', 'gittest')
+        self.assertEqual('true', self._git_output(location,
+                'rev-parse --is-shallow-repository'))
+        self.assertEqual('1', self._git_output(location, 'rev-list --count HEAD'))
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(location, 'test3.txt')))
+        self.assertEqual('true', self._git_output(location,
+                'rev-parse --is-shallow-repository'))
+        self.assertEqual('1', self._git_output(location, 'rev-list --count HEAD'))
+
+    def testShallowRevision(self):
         """
+        Tests if only the pinned revision is fetched with depth and rev.
+        """
+        rev = self._git_output(self.temprepo, 'rev-list --max-parents=0 HEAD')
         testing.write(self.tempdir, 'buildout.cfg', """
 [buildout]
 parts = gittest
 download-cache = %(cache)s
-install-from-cache = false
 
 [gittest]
 recipe = zerokspot.recipe.git
-recursive = true
+repository = file://%(repo)s
+rev = %(rev)s
+depth = 1
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache, 'rev': rev})
+        build = self._buildout()
+        recipe = build['gittest'].recipe
+        for path in (recipe.cache_path, recipe.options['location']):
+            self.assertEqual(rev, self._git_output(path, 'rev-parse HEAD'))
+            self.assertEqual('1', self._git_output(path, 'rev-list --count --all'))
+        self.assertFalse(os.path.exists(os.path.join(recipe.options['location'], 'submodule')))
+
+    def testShallowSharedEntry(self):
+        """
+        Tests if a part pinned to a rev gets it from a shallow download
+        cache entry that was fetched for another part.
+        """
+        rev = self._git_output(self.temprepo, 'rev-parse HEAD~1')
+        for layout in ('checkout', 'mirror'):
+            testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = tip pinned
+download-cache = %(cache)s
+cache-layout = %(layout)s
+
+[tip]
+recipe = zerokspot.recipe.git
+repository = file://%(repo)s
+cache-name = shared-%(layout)s
+depth = 1
+
+[pinned]
+recipe = zerokspot.recipe.git
+repository = file://%(repo)s
+cache-name = shared-%(layout)s
+depth = 1
+rev = %(rev)s
+            """ % {'repo' : self.temprepo, 'cache': self.tempcache,
+                   'rev': rev, 'layout': layout})
+            build = self._buildout()
+            location = build['pinned'].recipe.options['location']
+            self.assertEqual(rev, self._git_output(location,
+                                                   'rev-parse HEAD'))
+            self.assertEqual('1', self._git_output(location,
+                                                   'rev-list --count HEAD'))
+
+    def testCacheStrategies(self):
+        """
+        Tests if parts can copy, hardlink or borrow the objects of the
+        download cache.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = reference worktree clone hardlink
+download-cache = %(cache)s
+
+[clone]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+cache-strategy = clone
+
+[hardlink]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+cache-strategy = hardlink
+
+[reference]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+cache-strategy = reference
+newest = true
+
+[worktree]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+cache-strategy = worktree
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        self._buildout()
+        reference = os.path.join(self.tempdir, 'parts', 'reference')
+        worktree = os.path.join(self.tempdir, 'parts', 'worktree')
+        self.assertTrue(os.path.exists(os.path.join(reference, '.git',
+                'objects', 'info', 'alternates')))
+        from zerokspot.recipe.git.cache import CacheUsage
+        self.assertEqual({self.repo_name: [reference]},
+                         CacheUsage(self.tempcache).references())
+        self.assertTrue(os.path.isfile(os.path.join(worktree, '.git')))
+        for part, linked in (('clone', False), ('hardlink', True)):
+            packs = os.path.join(self.tempdir, 'parts', part, '.git',
+                                 'objects', 'pack')
+            for name in os.listdir(packs):
+                self.assertEqual(linked, os.stat(os.path.join(packs,
+                        name)).st_nlink > 1, name)
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(reference, 'test3.txt')))
+        self.assertTrue(os.path.exists(os.path.join(worktree, 'test3.txt')))
+
+    def testSparse(self):
+        """
+        Tests if sparse parts only check out the directories in paths.
+        """
+        testing.system('cd %s && mkdir pkg other && echo 1 > pkg/a.txt && echo 2 > other/b.txt && git add pkg other && git commit -m "Dirs"' % self.temprepo)
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = direct
+
+[direct]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+paths = pkg/
+sparse = true
+        """ % {'repo' : self.temprepo})
+        self._buildout()
+        part = os.path.join(self.tempdir, 'parts', 'direct')
+        self.assertTrue(os.path.exists(os.path.join(part, 'pkg', 'a.txt')))
+        self.assertTrue(os.path.exists(os.path.join(part, 'test.txt')))
+        self.assertFalse(os.path.exists(os.path.join(part, 'other')))
+
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = clone worktree
+download-cache = %(cache)s
+
+[clone]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+paths = pkg
+sparse = true
+newest = true
+
+[worktree]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+paths = pkg
+sparse = true
+cache-strategy = worktree
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        self._buildout()
+        testing.system('cd %s && echo 3 > pkg/c.txt && echo 4 > other/d.txt && git add pkg other && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        for name in ('clone', 'worktree'):
+            part = os.path.join(self.tempdir, 'parts', name)
+            self.assertTrue(os.path.exists(os.path.join(part, 'pkg', 'c.txt')))
+            self.assertFalse(os.path.exists(os.path.join(part, 'other')))
+
+    def testMirror(self):
+        """
+        Tests if the mirror cache layout is shared between spellings of a URL.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest gittest2
+download-cache = %(cache)s
+cache-layout = mirror
+
+[gittest]
+recipe = zerokspot.recipe.git
 repository = %(repo)s
+newest = true
+
+[gittest2]
+recipe = zerokspot.recipe.git
+repository = file://%(repo)s/
+branch = test
+newest = true
         """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        import json
+        from zerokspot.recipe.git.cache import mirror_name
         build = self._buildout()
-        from glob import glob
-        path = os.path.join(self.tempdir, 'parts', 'gittest', 'submodule', '.git')
-        self.assertTrue(os.path.exists(path), "%s does not exist" % repr(path))
+        recipe = build['gittest'].recipe
+        self.assertEqual(recipe.cache_path, build['gittest2'].recipe.cache_path)
+        self.assertEqual(os.path.join(self.tempcache, 'git',
+                                      mirror_name(self.temprepo)),
+                         recipe.cache_path)
+        self.assertTrue(os.path.exists(os.path.join(recipe.cache_path, 'HEAD')))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest2', 'test2.txt')))
+        index = json.load(open(os.path.join(self.tempcache, 'git', 'index.json')))
+        self.assertEqual(self.temprepo, index[recipe.cache_name]['url'])
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest', 'test3.txt')))
 
-class MultiEggTests(unittest.TestCase):
-    def setUp(self):
-        self.projectdir = tempfile.mkdtemp()
-        self.temprepo = tempfile.mkdtemp()
-        os.chdir(self.projectdir)
-        for i in range(2):
-            base_dir = os.path.join(self.temprepo, 'project%d' % (i, ))
-            testing.mkdir(base_dir)
-            setup_py = '''from setuptools import setup
-setup(name='project%(num)d', version='1.0', py_modules=['test'])''' % {'num': i}
-            with open(os.path.join(base_dir, 'setup.py'), 'w+') as fp:
-                fp.write(setup_py)
-            with open(os.path.join(base_dir, 'test.py'), 'w+') as fp:
-                fp.write('# Dummy module')
-        testing.system('cd %s && git init && git add * && git commit -m "Test"' % self.temprepo)
+    def testCacheLocking(self):
+        """
+        Tests if worktrees are added to, exports fetch into and parts are
+        cloned from the download cache entry only while holding its lock.
+        """
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "New"'
+                       % self.temprepo)
+        rev = self._git_output(self.temprepo, 'rev-parse HEAD')
+        # Only reachable from a ref that clones don't fetch.
+        testing.system('cd %s && git update-ref refs/kept/new HEAD && '
+                       'git reset -q --hard HEAD~1' % self.temprepo)
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = worktree export clone
+download-cache = %(cache)s
 
-    def testBasic(self):
-        testing.write(self.projectdir, 'buildout.cfg', """
+[worktree]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+cache-strategy = worktree
+
+[export]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+checkout-mode = export
+cache-name = %(name)s
+rev = %(rev)s
+
+[clone]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache,
+               'name': self.repo_name, 'rev': rev})
+        build = zc.buildout.buildout.Buildout(
+                os.path.join(self.tempdir, 'buildout.cfg'), [])
+        held = []
+        unlocked = []
+        for name in ('worktree', 'export', 'clone'):
+            recipe = build[name].recipe
+            def lock_cache(path=None, lock_cache=recipe._lock_cache):
+                lock, fetched = lock_cache(path)
+                held.append(lock)
+                release = lock.release
+                def unlock():
+                    held.remove(lock)
+                    release()
+                lock.release = unlock
+                return lock, fetched
+            def run(args, message=None, cwd=None, run=recipe.runner.run,
+                    cache=recipe.cache_path, **kwargs):
+                reads = cwd == cache and args[0] in ('fetch', 'worktree') \
+                        or args[0] == 'clone' and cache in args
+                if reads and not held:
+                    unlocked.append(args)
+                return run(args, message, cwd=cwd, **kwargs)
+            recipe._lock_cache = lock_cache
+            recipe.runner.run = run
+            recipe.install()
+        self.assertEqual([], unlocked)
+        self.assertTrue(os.path.exists(os.path.join(
+                build['export'].recipe.options['location'], 'test3.txt')))
+
+    def testExport(self):
+        """
+        Tests if checkout-mode = export unpacks the tree from a cached tarball.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
 [buildout]
 parts = gittest
+download-cache = %(cache)s
 
 [gittest]
 recipe = zerokspot.recipe.git
 repository = %(repo)s
-as_egg = true
-paths = 
-    project0
-    project1
-""" % {'repo': self.temprepo})
-        buildout = do_buildout(os.path.join(self.projectdir, 'buildout.cfg'))
-        installs = os.listdir(buildout['buildout']['develop-eggs-directory'])
-        self.assertTrue('project0.egg-link' in installs)
-        self.assertTrue('project1.egg-link' in installs)
+checkout-mode = export
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        build = self._buildout()
+        part = os.path.join(self.tempdir, 'parts', 'gittest')
+        sha = build['gittest'].recipe.export_sha
+        self.assertEqual(sha, self._git_output(self.temprepo, 'rev-parse HEAD'))
+        self.assertTrue(os.path.exists(os.path.join(part, 'test.txt')))
+        self.assertFalse(os.path.exists(os.path.join(part, '.git')))
+        archive = os.path.join(self.tempcache, 'git-archives', '%s.tar' % sha)
+        self.assertTrue(os.path.exists(archive))
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(part, 'test3.txt')))
+        self.assertFalse(os.path.exists(os.path.join(part, '.git')))
+
+    def testTreeStore(self):
+        """
+        Tests if exported parts are materialized from the tree store,
+        hardlinked if they are read-only and copied otherwise.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest gitlinked
+download-cache = %(cache)s
+tree-store = true
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+checkout-mode = export
+
+[gitlinked]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+checkout-mode = export
+read-only = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        build = self._buildout()
+        sha = build['gittest'].recipe.export_sha
+        tree = os.path.join(self.tempcache, 'git-trees', sha, 'test.txt')
+        import stat
+        self.assertFalse(os.stat(tree).st_mode & stat.S_IWUSR)
+        copied = os.path.join(self.tempdir, 'parts', 'gittest', 'test.txt')
+        linked = os.path.join(self.tempdir, 'parts', 'gitlinked', 'test.txt')
+        self.assertEqual('TEST', open(copied).read())
+        self.assertTrue(os.stat(copied).st_mode & stat.S_IWUSR)
+        self.assertNotEqual(os.stat(tree).st_ino, os.stat(copied).st_ino)
+        self.assertEqual(os.stat(tree).st_ino, os.stat(linked).st_ino)
+        # The second part didn't need the tarball.
+        commands = [result.args[1]
+                    for result in build['gitlinked'].recipe.runner.results]
+        self.assertFalse('archive' in commands)
+        from zerokspot.recipe.git.maintenance import find_entries
+        self.assertTrue(os.path.join('git-trees', sha) in
+                        [entry.name for entry in find_entries(self.tempcache)])
+
+    def testTrace(self):
+        """
+        Tests if the phases and git calls of every part are traced.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+git-trace = trace.json
+git-chrome-trace = chrome.json
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        import json
+        from zerokspot.recipe.git import trace
+        calls = []
+        def hook(part, spans):
+            calls.append((part, spans))
+        trace.add_hook(hook)
+        try:
+            self._buildout()
+            self._buildout()
+        finally:
+            trace.remove_hook(hook)
+        self.assertEqual(['gittest', 'gittest'], [call[0] for call in calls])
+        phases = [span['phase'] for span in calls[0][1]]
+        for phase in ('install', 'fetch', 'clone', 'git'):
+            self.assertTrue(phase in phases, phase)
+        clones = [span for span in calls[0][1]
+                  if span.get('command', '').startswith('clone')]
+        self.assertTrue(clones[0]['bytes'] > 0)
+        self.assertEqual(0, clones[0]['status'])
+        self.assertTrue(trace.object_bytes(self.temprepo) > 0)
+        # Not a repository yet, even though it is inside one.
+        os.mkdir(os.path.join(self.temprepo, 'empty'))
+        self.assertEqual(0, trace.object_bytes(os.path.join(self.temprepo,
+                                                            'empty')))
+        update = calls[1][1]
+        self.assertEqual('update', update[0]['phase'])
+        resolve = [span for span in update if span['phase'] == 'resolve']
+        self.assertEqual(False, resolve[0]['cache_hit'])
+        report = json.load(open(os.path.join(self.tempdir, 'trace.json')))
+        self.assertEqual(['gittest'], report['parts'].keys())
+        self.assertTrue(all(span['parent'] is None or span['parent'] < span['id']
+                            for span in report['spans']))
+        chrome = json.load(open(os.path.join(self.tempdir, 'chrome.json')))
+        self.assertTrue(any(event['ph'] == 'X' and event['cat'] == 'git'
+                            for event in chrome['traceEvents']))
+
+    def testMaintain(self):
+        """
+        Tests if the cache entry and the part get a commit-graph and a
+        multi-pack-index in the background with maintain = true.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+git-trace = trace.json
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+maintain = true
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        import json
+        from zerokspot.recipe.git.tasks import wait_background
+        from zerokspot.recipe.git.trace import has_commit_graph
+        # A multi-pack-index needs packs.
+        testing.system('cd %s && git repack -q -a -d' % self.temprepo)
+        self._buildout()
+        wait_background()
+        cache = os.path.join(self.tempcache, self.repo_name)
+        part = os.path.join(self.tempdir, 'parts', 'gittest')
+        for path in (cache, part):
+            self.assertTrue(has_commit_graph(path), path)
+            self.assertTrue(os.path.exists(os.path.join(path, '.git',
+                    'objects', 'pack', 'multi-pack-index')), path)
+            self.assertEqual('true', self._git_output(path,
+                    'config fetch.writeCommitGraph'))
+        report = json.load(open(os.path.join(self.tempdir, 'trace.json')))
+        self.assertEqual(False, report['spans'][0]['commit_graph'])
+        self.assertTrue('gittest' in report['background'])
+        # The part is flushed before its maintenance finishes.
+        maintained = [span for span in report['spans']
+                      if span['phase'] == 'maintain']
+        self.assertEqual(2, len(maintained))
+        self.assertTrue(all(span['duration'] is not None
+                            for span in maintained))
+        self.assertAlmostEqual(sum(span['duration'] for span in maintained),
+                               report['background']['gittest'])
+        # Parts clone from the entry under the lock it is maintained with.
+        install, = [span for span in report['spans']
+                    if span['phase'] == 'install']
+        entry, = [span for span in maintained if span['path'] == cache]
+        self.assertTrue(entry['start'] >= install['start']
+                                          + install['duration'])
+        self._buildout()
+        wait_background()
+        report = json.load(open(os.path.join(self.tempdir, 'trace.json')))
+        self.assertEqual('update', report['spans'][0]['phase'])
+        self.assertEqual(True, report['spans'][0]['commit_graph'])
+
+    def testFrozen(self):
+        """
+        Tests if parts are locked to commits and installed at exactly those
+        with frozen = true, whatever the case of their names.
+        """
+        config = """
+[buildout]
+parts = gittest GitTag
+download-cache = %(cache)s
+frozen = %(frozen)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+newest = true
+
+[GitTag]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+rev = v1
+cache-name = tagged
+        """
+        options = {'repo' : self.temprepo, 'cache': self.tempcache}
+        from zerokspot.recipe.git import versions
+        testing.system('cd %s && git tag v1' % self.temprepo)
+        testing.write(self.tempdir, 'buildout.cfg',
+                      config % dict(options, frozen='false'))
+        self.assertEqual(0, versions.main(['-c', 'buildout.cfg']))
+        path = os.path.join(self.tempdir, 'git-versions.cfg')
+        first = self._git_output(self.temprepo, 'rev-parse HEAD')
+        self.assertEqual({'gittest': first, 'GitTag': first},
+                         versions.read_versions(path))
+
+        testing.write(self.tempdir, 'buildout.cfg',
+                      config % dict(options, frozen='true'))
+        self._buildout()
+        part = os.path.join(self.tempdir, 'parts', 'gittest')
+        self.assertEqual(first, self._git_output(part, 'rev-parse HEAD'))
+        testing.write(self.temprepo, 'test.txt', 'CHANGED')
+        testing.system('cd %s && git commit -q -am "Change"' % self.temprepo)
+        build = self._buildout()
+        self.assertEqual(first, self._git_output(part, 'rev-parse HEAD'))
+        self.assertEqual([], build['gittest'].recipe.runner.results)
+
+        # The lockfile can be written while frozen.
+        self.assertEqual(0, versions.main(['-c', 'buildout.cfg']))
+        second = self._git_output(self.temprepo, 'rev-parse HEAD')
+        self.assertEqual(second, versions.read_versions(path)['gittest'])
+        self.assertEqual(first, versions.read_versions(path)['GitTag'])
+        build = self._buildout()
+        self.assertEqual(second, self._git_output(part, 'rev-parse HEAD'))
+        commands = [result.args[1]
+                    for result in build['gittest'].recipe.runner.results]
+        self.assertFalse('ls-remote' in commands)
+
+        versions.write_versions(path, {'gittest': second})
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+
+    def testProxy(self):
+        """
+        Tests if parts are served from the mirrors with git-proxy, with one
+        upstream fetch per mirror and run, and SSH set up for a master.
+        """
+        from zerokspot.recipe.git.benchmark import Daemon
+        from zerokspot.recipe.git.cache import mirror_name
+        from zerokspot.recipe.git import proxy
+        testing.system('git clone -q --bare %s %s' % (self.temprepo,
+                       os.path.join(self.temprepos, 'upstream.git')))
+        daemon = Daemon(self.temprepos)
+        daemon.start()
+        try:
+            url = daemon.url(os.path.join(self.temprepos, 'upstream.git'))
+            testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest gittest2
+download-cache = %(cache)s
+git-proxy = true
+newest = true
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(url)s
+
+[gittest2]
+recipe = zerokspot.recipe.git
+repository = %(url)s
+            """ % {'url': url, 'cache': self.tempcache})
+            build = self._buildout()
+            mirror = os.path.join(self.tempcache, 'git', mirror_name(url))
+            for part in ('gittest', 'gittest2'):
+                path = os.path.join(self.tempdir, 'parts', part)
+                self.assertEqual(mirror, self._git_output(path,
+                        'config remote.origin.url'))
+            env = build['gittest'].recipe.runner.env
+            self.assertTrue('ControlMaster=auto' in env['GIT_SSH_COMMAND'])
+            self.assertTrue(os.path.isdir(proxy.control_directory(
+                    self.tempcache)))
+            self.assertEqual([], proxy.masters(self.tempcache))
+
+            testing.write(self.temprepo, 'test.txt', 'CHANGED')
+            testing.system('cd %s && git commit -q -am "Change" && '
+                           'git push -q %s master' % (self.temprepo,
+                           os.path.join(self.temprepos, 'upstream.git')))
+            build = self._buildout()
+            upstream = [result for part in ('gittest', 'gittest2')
+                        for result in build[part].recipe.runner.results
+                        if result.cwd == mirror
+                        and result.args[1] in ('remote', 'fetch')]
+            self.assertEqual(1, len(upstream))
+            for part in ('gittest', 'gittest2'):
+                path = os.path.join(self.tempdir, 'parts', part)
+                self.assertEqual('CHANGED', open(os.path.join(path,
+                        'test.txt')).read())
+        finally:
+            daemon.stop()
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+git-proxy = true
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %s
+        """ % self.temprepo)
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+
+    def testSSHMultiplexing(self):
+        """
+        Tests if all SSH connections of all parts and buildouts go through
+        one master per host with git-proxy.
+        """
+        from zerokspot.recipe.git import proxy
+        upstream = os.path.join(self.temprepos, 'upstream.git')
+        testing.system('git clone -q --bare %s %s' % (self.temprepo,
+                                                       upstream))
+        # Stands in for OpenSSH: the master is a file at the ControlPath and
+        # the remote command runs locally.
+        log = os.path.join(self.tempdir, 'ssh.log')
+        ssh = os.path.join(self.tempdir, 'ssh')
+        testing.write(self.tempdir, 'ssh', """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+    -o) case "$2" in ControlPath=*) control="${2#ControlPath=}";; esac
+        shift 2;;
+    -O) operation="$2"; shift 2;;
+    -*) shift;;
+    *) break;;
+    esac
+done
+host="$1"
+shift
+socket=$(printf %%s "$control" | sed "s/%%C/$host/")
+case "$operation" in
+check) test -e "$socket"; exit;;
+exit) rm "$socket"; exit;;
+esac
+if [ -e "$socket" ]; then
+    echo "reuse $host" >> %(log)s
+else
+    touch "$socket"
+    echo "master $host" >> %(log)s
+fi
+exec sh -c "$*"
+""" % {'log': log})
+        os.chmod(ssh, 0755)
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest gittest2
+download-cache = %(cache)s
+git-proxy = true
+newest = true
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = ssh://upstream%(repo)s
+
+[gittest2]
+recipe = zerokspot.recipe.git
+repository = ssh://upstream%(repo)s
+        """ % {'repo': upstream, 'cache': self.tempcache})
+        os.environ['GIT_SSH_COMMAND'] = ssh
+        try:
+            self._buildout()
+            self.assertEqual(['master upstream'], open(log).read().splitlines()[:1])
+            testing.write(self.temprepo, 'test.txt', 'CHANGED')
+            testing.system('cd %s && git commit -q -am "Change" && '
+                           'git push -q %s master' % (self.temprepo,
+                                                      upstream))
+            self._buildout()
+            for part in ('gittest', 'gittest2'):
+                self.assertEqual('CHANGED', open(os.path.join(self.tempdir,
+                        'parts', part, 'test.txt')).read())
+            calls = open(log).read().splitlines()
+            self.assertTrue(len(calls) > 1)
+            self.assertEqual(['reuse upstream'] * (len(calls) - 1),
+                             calls[1:])
+            socket = os.path.join(proxy.control_directory(self.tempcache),
+                                  'upstream')
+            self.assertEqual([socket], proxy.masters(self.tempcache))
+            self.assertEqual([socket], proxy.stop(self.tempcache))
+            self.assertEqual([], proxy.masters(self.tempcache))
+        finally:
+            del os.environ['GIT_SSH_COMMAND']
+
+    def testPlan(self):
+        """
+        Tests if the planner tells which parts need the network, the cache
+        or nothing, without changing anything.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+newest = true
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        from zerokspot.recipe.git import plan
+        from zerokspot.recipe.git.versions import git_parts
+        config = os.path.join(self.tempdir, 'buildout.cfg')
+        entry, = plan.plan(git_parts(config))
+        self.assertEqual('install', entry['operation'])
+        self.assertEqual(['clone-upstream', 'clone-cache'], entry['steps'])
+        self.assertEqual('network', entry['source'])
+        self.assertEqual(self._git_output(self.temprepo, 'rev-parse HEAD'),
+                         entry['sha'])
+        # buildout itself creates dist in the download cache.
+        self.assertEqual(['dist'], os.listdir(self.tempcache))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                     'parts', 'gittest')))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                '.zerokspot.recipe.git.json')))
+
+        self._buildout()
+        entry, = plan.plan(git_parts(config))
+        self.assertEqual(('update', [], 'none'), (entry['operation'],
+                         entry['steps'], entry['source']))
+        self.assertTrue(entry['objects'] > 0)
+
+        testing.write(self.temprepo, 'test.txt', 'CHANGED')
+        testing.system('cd %s && git commit -q -am "Change"' % self.temprepo)
+        entry, = plan.plan(git_parts(config))
+        self.assertEqual(['fetch-cache', 'update-part'], entry['steps'])
+        self.assertEqual('network', entry['source'])
+        self.assertEqual(1, entry['changed_refs'])
+        recipe, = git_parts(config)
+        self.assertEqual(entry['steps'], recipe.plan()['steps'])
+        self.assertEqual(0, plan.main(['-c', config, '--json']))
+
+    def testResume(self):
+        """
+        Tests if failed transfers are retried, failed clones are continued
+        by the next run and failed installs leave no part behind.
+        """
+        config = """
+[buildout]
+parts = gittest
+%(cache)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+retries = 2
+retry-delay = 0
+%(rev)s
+        """
+        def write(repo=self.temprepo, cache='', rev=''):
+            testing.write(self.tempdir, 'buildout.cfg', config % {
+                    'repo': repo, 'cache': cache, 'rev': rev})
+        part = os.path.join(self.tempdir, 'parts', 'gittest')
+        partial = os.path.join(self.tempdir, 'parts', '.gittest.partial')
+
+        write(repo=os.path.join(self.temprepos, 'missing'))
+        build = zc.buildout.buildout.Buildout(
+                os.path.join(self.tempdir, 'buildout.cfg'), [])
+        recipe = build['gittest'].recipe
+        self.assertRaises(zc.buildout.UserError, recipe.install)
+        self.assertEqual(3, len([result for result in recipe.runner.results
+                                 if result.args[1:] == ['fetch', 'origin']]))
+        testing.rmdir(partial)
+
+        write(rev='rev = %s' % ('0' * 40))
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+        self.assertFalse(os.path.exists(part))
+        self.assertEqual(self._git_output(self.temprepo, 'rev-parse HEAD'),
+                         self._git_output(partial,
+                                          'rev-parse origin/master'))
+        # The next run continues in the same repository.
+        testing.system('cd %s && git config test.marker kept' % partial)
+        write()
+        self._buildout()
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual('kept', self._git_output(part,
+                                                  'config test.marker'))
+        self.assertTrue(os.path.exists(os.path.join(part, 'test.txt')))
+        self.assertEqual('refs/heads/master', self._git_output(part,
+                         'symbolic-ref HEAD'))
+
+        # What was fetched from another repository is thrown away.
+        other = os.path.join(self.temprepos, 'other')
+        testing.system('git clone -q %s %s && cd %s && '
+                       'git checkout -q -b other' % (self.temprepo, other,
+                                                     other))
+        testing.rmdir(part)
+        write(repo=other, rev='rev = %s' % ('0' * 40))
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+        self.assertNotEqual('', self._git_output(partial,
+                            'for-each-ref refs/remotes/origin/other'))
+        write()
+        self._buildout()
+        self.assertEqual('', self._git_output(part,
+                         'for-each-ref refs/remotes/origin/other'))
+        self.assertEqual(self.temprepo, self._git_output(part,
+                         'config remote.origin.url'))
+
+        cache = 'download-cache = %s' % self.tempcache
+        name = 'cache-name = %s' % self.repo_name
+        write(cache=cache, rev=name)
+        self._buildout()
+        # Cloning the part from the cache fails after the part was created.
+        write(cache=cache, rev='%s\nrev = %s' % (name, '0' * 40))
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+        self.assertFalse(os.path.exists(part))
+
+    def testSkipUnchanged(self):
+        """
+        Tests if updates skip pulling when the branch didn't move upstream.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        def operations(build):
+            return [result.args[1] for result in build['gittest'].recipe.runner.results]
+        self._buildout()
+        build = self._buildout()
+        self.assertFalse('pull' in operations(build))
+        build = self._buildout()
+        self.assertEqual(['ls-remote'], operations(build))
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        build = self._buildout()
+        self.assertTrue('pull' in operations(build))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest', 'test3.txt')))
+        build = self._buildout()
+        self.assertEqual(['ls-remote'], operations(build))
+
+    def testRefCache(self):
+        """
+        Tests if refs listed by another buildout are trusted for ref-cache-ttl.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+ref-cache-ttl = 3600
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        def operations(build):
+            return [result.args[1] for result in build['gittest'].recipe.runner.results]
+        self._buildout()
+        build = self._buildout()
+        self.assertEqual(['ls-remote'], operations(build))
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        build = self._buildout()
+        self.assertEqual([], operations(build))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest', 'test3.txt')))
+        from zerokspot.recipe.git.cache import RefCache
+        self.assertEqual([], RefCache(self.tempcache).refresh())
+        build = self._buildout()
+        self.assertTrue('pull' in operations(build))
+        self.assertFalse('ls-remote' in operations(build))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts', 'gittest', 'test3.txt')))
+
+    def testUpdateModes(self):
+        """
+        Tests the fetch-reset and fetch-only update modes.
+        """
+        rev = self._git_output(self.temprepo, 'rev-parse HEAD')
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = reset fetch pinned
+download-cache = %(cache)s
+newest = true
+
+[reset]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+update-mode = fetch-reset
+
+[fetch]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+update-mode = fetch-only
+
+[pinned]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+rev = %(rev)s
+update-mode = fetch-reset
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache, 'rev': rev})
+        self._buildout()
+        parts = os.path.join(self.tempdir, 'parts')
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        testing.system('cd %s && git checkout -q HEAD~1' % os.path.join(parts, 'pinned'))
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(parts, 'reset', 'test3.txt')))
+        self.assertFalse(os.path.exists(os.path.join(parts, 'fetch', 'test3.txt')))
+        self.assertEqual(self._git_output(self.temprepo, 'rev-parse HEAD'),
+                self._git_output(os.path.join(parts, 'fetch'), 'rev-parse origin/master'))
+        self.assertEqual(rev, self._git_output(os.path.join(parts, 'pinned'), 'rev-parse HEAD'))
+
+        testing.write(os.path.join(parts, 'reset'), 'test.txt', 'CHANGED')
+        testing.write(self.temprepo, 'test4.txt', 'TEST')
+        testing.system('cd %s && git add test4.txt && git commit -m "Update"' % self.temprepo)
+        self.assertRaises(zc.buildout.UserError, self._buildout)
+
+    def testPrefetch(self):
+        """
+        Tests if the fetches of several buildouts can run at the same time.
+        """
+        from zerokspot.recipe.git.tasks import prefetch, wait_all
+        recipes = []
+        for name in ('one', 'two'):
+            directory = os.path.join(self.tempdir, name)
+            os.mkdir(directory)
+            testing.write(directory, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+            """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+            build = zc.buildout.buildout.Buildout(
+                    os.path.join(directory, 'buildout.cfg'), [])
+            recipes.append(build['gittest'].recipe)
+        futures = prefetch(recipes, jobs=2)
+        self.assertTrue(futures[0] is futures[1])
+        wait_all(futures)
+        self.assertTrue(os.path.exists(os.path.join(recipes[0].cache_path, 'test.txt')))
+        wait_all([recipe.run_async('clone_cache') for recipe in recipes])
+        for recipe in recipes:
+            self.assertTrue(os.path.exists(os.path.join(recipe.options['location'], 'test.txt')))
+
+    def testThreads(self):
+        """
+        Tests if several recipes can be installed from threads at once.
+        """
+        import threading
+        parts = ['part%d' % i for i in range(4)]
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = %(parts)s
+download-cache = %(cache)s
+
+[part]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+recursive = true
+""" % {'repo' : self.temprepo, 'cache': self.tempcache,
+         'parts': ' '.join(parts)} + ''.join(
+        '[%s]\n<= part\n' % part for part in parts))
+        build = zc.buildout.buildout.Buildout(
+                os.path.join(self.tempdir, 'buildout.cfg'), [])
+        recipes = [build[part].recipe for part in parts]
+        cwd = os.getcwd()
+        errors = []
+        def install(recipe):
+            try:
+                recipe.install()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=install, args=(recipe, ))
+                   for recipe in recipes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(cwd, os.getcwd())
+        for recipe in recipes:
+            self.assertTrue(os.path.exists(os.path.join(
+                    recipe.options['location'], 'submodule', 'file')))
+
+    def testCacheGarbageCollection(self):
+        """
+        Tests if git-cache-max-age evicts entries no buildout used lately,
+        in the background.
+        """
+        import time
+        from zerokspot.recipe.git.cache import CacheUsage
+        stale = os.path.join(self.tempcache, 'stale')
+        testing.system('git clone -q %s %s' % (self.temprepo, stale))
+        os.utime(stale, (time.time() - 3 * 86400, ) * 2)
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+git-cache-max-age = 1d
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        import threading
+        import zerokspot.recipe.git
+        from zerokspot.recipe.git.tasks import wait_background
+        threads = []
+        collect_if_due = zerokspot.recipe.git.collect_if_due
+        def collect(*args):
+            threads.append(threading.currentThread())
+            return collect_if_due(*args)
+        zerokspot.recipe.git.collect_if_due = collect
+        try:
+            self._buildout()
+            wait_background()
+        finally:
+            zerokspot.recipe.git.collect_if_due = collect_if_due
+        # The parts don't wait for it.
+        self.assertEqual(1, len(threads))
+        self.assertNotEqual(threading.currentThread(), threads[0])
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(os.path.join(self.tempcache, 'testrepo')))
+        self.assertTrue('testrepo' in CacheUsage(self.tempcache).entries())
+
+    def testBundles(self):
+        """
+        Tests if the download cache can be exported as bundles and restored.
+        """
+        from zerokspot.recipe.git import bundle
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+newest = true
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        self._buildout()
+        mirror = os.path.join(self.tempcache, 'git', 'mirror')
+        testing.system('git clone -q --mirror %s %s' % (self.temprepo, mirror))
+        self.assertEqual(['testrepo'], bundle.used_entries(self.tempdir))
+        full = os.path.join(self.tempdir, 'full')
+        manifest = bundle.export(self.tempcache, full)
+        self.assertEqual(['git/mirror', 'testrepo'], sorted(manifest['entries']))
+        self.assertEqual([], manifest['entries']['testrepo']['prerequisites'])
+
+        testing.write(self.temprepo, 'test3.txt', 'TEST')
+        testing.system('cd %s && git add test3.txt && git commit -m "Update"' % self.temprepo)
+        self._buildout()
+        incremental = os.path.join(self.tempdir, 'incremental')
+        manifest = bundle.export(self.tempcache, incremental,
+                                 bundle.used_entries(self.tempdir), full)
+        self.assertEqual(['testrepo'], manifest['entries'].keys())
+        self.assertNotEqual([], manifest['entries']['testrepo']['prerequisites'])
+
+        seeded = os.path.join(self.tempdir, 'seeded')
+        self.assertEqual(['git/mirror', 'testrepo'],
+                         bundle.seed(seeded, [full, incremental]))
+        for name in ('testrepo', os.path.join('git', 'mirror')):
+            self.assertEqual(
+                    self._git_output(os.path.join(self.tempcache, name),
+                                     'for-each-ref'),
+                    self._git_output(os.path.join(seeded, name), 'for-each-ref'))
+        self.assertEqual(self.temprepo, self._git_output(
+                os.path.join(seeded, 'testrepo'), 'config remote.origin.url'))
+        self.assertTrue(os.path.exists(os.path.join(seeded, 'testrepo', 'test3.txt')))
+
+        offline = os.path.join(self.tempdir, 'offline')
+        os.mkdir(offline)
+        testing.write(offline, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+install-from-cache = true
+git-bundle-directory = %(full)s %(incremental)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'full': full,
+               'incremental': incremental,
+               'cache': os.path.join(self.tempdir, 'offline-cache')})
+        do_buildout(os.path.join(offline, 'buildout.cfg'))
+        self.assertTrue(os.path.exists(os.path.join(offline, 'parts',
+                                                    'gittest', 'test3.txt')))
+
+    def testSharedCache(self):
+        """
+        Tests if buildouts sharing a download cache clone upstream only once.
+        """
+        import threading
+        recipes = []
+        for name in ('a', 'b'):
+            directory = os.path.join(self.tempdir, name)
+            os.mkdir(directory)
+            testing.write(directory, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+cache-layout = mirror
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+            """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+            build = zc.buildout.buildout.Buildout(
+                    os.path.join(directory, 'buildout.cfg'), [])
+            recipes.append(build['gittest'].recipe)
+        errors = []
+        def install(recipe):
+            try:
+                recipe.install()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=install, args=(recipe, ))
+                   for recipe in recipes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        # Mirrors are fetched into a new repository, see _fetch_mirror.
+        clones = [result for recipe in recipes
+                  for result in recipe.runner.results
+                  if result.args[1:3] == ['config', 'remote.origin.url']
+                  and self.temprepo in result.args]
+        self.assertEqual(1, len(clones))
+        self.assertEqual(1, len([recipe for recipe in recipes
+                                 if recipe.cache_created]))
+        mirrors = os.path.join(self.tempcache, 'git')
+        self.assertEqual([], [name for name in os.listdir(mirrors)
+                              if name.startswith('.')])
+        for recipe in recipes:
+            self.assertTrue(os.path.exists(os.path.join(
+                    recipe.options['location'], 'test.txt')))
+
+    def testSingleEgg(self):
+        repo = 'git://github.com/zerok/zerokspot.gitrecipe.git'
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+as_egg = true
+        """ % {'repo': repo})
+        buildout = self._buildout()
+        installs = os.listdir(buildout['buildout']['develop-eggs-directory'])
+        self.assertTrue('zerokspot.recipe.git.egg-link' in installs)
+
+    def testRecursive(self):
+        """
+        Tests if install works for recursive clone
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+install-from-cache = false
+
+[gittest]
+recipe = zerokspot.recipe.git
+recursive = true
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        build = self._buildout()
+        from glob import glob
+        path = os.path.join(self.tempdir, 'parts', 'gittest', 'submodule', '.git')
+        self.assertTrue(os.path.exists(path), "%s does not exist" % repr(path))
+
+    def testRecursiveCache(self):
+        """
+        Tests if submodules are fetched from mirrors in the download cache.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+download-cache = %(cache)s
+
+[gittest]
+recipe = zerokspot.recipe.git
+recursive = true
+submodule-jobs = 2
+repository = %(repo)s
+        """ % {'repo' : self.temprepo, 'cache': self.tempcache})
+        from zerokspot.recipe.git.cache import mirror_name
+        self._buildout()
+        location = os.path.join(self.tempdir, 'parts', 'gittest')
+        mirror = os.path.join(self.tempcache, 'git',
+                mirror_name(os.path.join(self.temprepo, 'submodule_repo')))
+        self.assertTrue(os.path.exists(os.path.join(location, 'submodule', 'file')))
+        self.assertEqual(mirror, self._git_output(location,
+                'config submodule.submodule.url'))
+
+    def testRecursiveShallow(self):
+        """
+        Tests if submodules can be fetched in parallel without a cache.
+        """
+        testing.write(self.tempdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+
+[gittest]
+recipe = zerokspot.recipe.git
+recursive = true
+submodule-jobs = 2
+shallow-submodules = true
+repository = %(repo)s
+        """ % {'repo' : self.temprepo})
+        self._buildout()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'parts',
+                'gittest', 'submodule', 'file')))
+
+class MultiEggTests(unittest.TestCase):
+    def setUp(self):
+        self.projectdir = tempfile.mkdtemp()
+        self.temprepo = tempfile.mkdtemp()
+        os.chdir(self.projectdir)
+        for i in range(2):
+            base_dir = os.path.join(self.temprepo, 'project%d' % (i, ))
+            testing.mkdir(base_dir)
+            setup_py = '''from setuptools import setup
+setup(name='project%(num)d', version='1.0', py_modules=['test'])''' % {'num': i}
+            with open(os.path.join(base_dir, 'setup.py'), 'w+') as fp:
+                fp.write(setup_py)
+            with open(os.path.join(base_dir, 'test.py'), 'w+') as fp:
+                fp.write('# Dummy module')
+        testing.system('cd %s && git init && git add * && git commit -m "Test"' % self.temprepo)
+
+    def testBasic(self):
+        testing.write(self.projectdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+as_egg = true
+paths = 
+    project0
+    project1
+""" % {'repo': self.temprepo})
+        buildout = do_buildout(os.path.join(self.projectdir, 'buildout.cfg'))
+        installs = os.listdir(buildout['buildout']['develop-eggs-directory'])
+        self.assertTrue('project0.egg-link' in installs)
+        self.assertTrue('project1.egg-link' in installs)
+
+    def testIncremental(self):
+        """
+        Only paths whose packaging metadata or commit changed are developed
+        again.
+        """
+        testing.write(self.projectdir, 'buildout.cfg', """
+[buildout]
+parts = gittest
+
+[gittest]
+recipe = zerokspot.recipe.git
+repository = %(repo)s
+as_egg = true
+paths =
+    project0
+    project1
+""" % {'repo': self.temprepo})
+        buildout = do_buildout(os.path.join(self.projectdir, 'buildout.cfg'))
+        recipe = buildout['gittest'].recipe
+        developed = []
+        develop = zc.buildout.easy_install.develop
+        def record(path, target):
+            developed.append(os.path.basename(path))
+            return develop(path, target)
+        zc.buildout.easy_install.develop = record
+        try:
+            recipe._install_as_egg()
+            self.assertEqual([], developed)
+            location = recipe.options['location']
+            with open(os.path.join(location, 'project1', 'setup.cfg'), 'w') as fp:
+                fp.write('[egg_info]\n')
+            recipe._install_as_egg()
+            self.assertEqual(['project1'], developed)
+            os.remove(os.path.join(buildout['buildout']['develop-eggs-directory'],
+                                   'project0.egg-link'))
+            recipe._install_as_egg()
+            self.assertEqual(['project1', 'project0'], developed)
+        finally:
+            zc.buildout.easy_install.develop = develop
 
     def tearDown(self):
         testing.rmdir(self.temprepo)
@@ -254,6 +1842,11 @@ paths =
 
 all_tests = unittest.TestSuite([
     unittest.TestLoader().loadTestsFromTestCase(UtilsTests),
+    unittest.TestLoader().loadTestsFromTestCase(SchedulerTests),
+    unittest.TestLoader().loadTestsFromTestCase(TasksTests),
+    unittest.TestLoader().loadTestsFromTestCase(RunnerTests),
+    unittest.TestLoader().loadTestsFromTestCase(MaintenanceTests),
+    unittest.TestLoader().loadTestsFromTestCase(BenchmarkTests),
     unittest.TestLoader().loadTestsFromTestCase(RecipeTests),
     unittest.TestLoader().loadTestsFromTestCase(MultiEggTests),
     ])
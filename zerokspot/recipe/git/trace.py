@@ -0,0 +1,336 @@
+"""
+Timing of what the git parts of a buildout spend their time on.
+
+Every Recipe records spans for the phases of its install or update
+(resolving refs, fetching, cloning, checking out, submodules, developing
+eggs and the background maintenance of ``maintain = true``) and for each
+git call it makes, with the command, its duration, the bytes it added to
+the object store and whether a cache made it cheaper. Spans started in a
+phase are nested in it.
+
+After each part the spans collected so far are written to the files named
+by ``git-trace`` (JSON) and ``git-chrome-trace`` (Chrome trace event format,
+for chrome://tracing or Perfetto) in the ``[buildout]`` section, and passed
+to the hooks. The files are written again whenever background maintenance
+finishes. Hooks are callables added with add_hook() or named as
+``module:function`` in ``git-trace-hook``. A hook is called with the name
+of the part that finished and the list of that part's spans (as
+dictionaries).
+"""
+
+import functools
+import os
+import subprocess
+import threading
+import time
+import weakref
+
+import zc.buildout
+
+from zerokspot.recipe.git.runner import GitRunner
+from zerokspot.recipe.git.state import JSONFile
+
+
+# Maps id(buildout) to a weak reference to the buildout and its tracer, see
+# zerokspot.recipe.git.scheduler.
+_tracers = {}
+_tracers_lock = threading.Lock()
+
+_hooks = []
+
+# git commands that download objects into a repository.
+TRANSFER_COMMANDS = ('clone', 'fetch', 'pull', 'remote')
+
+# Phases that run in the background and don't add to the time of a part.
+BACKGROUND_PHASES = ('maintain', )
+
+
+def add_hook(func):
+    """
+    Call ``func(part, spans)`` whenever a part finished, in every buildout.
+    """
+    _hooks.append(func)
+
+
+def remove_hook(func):
+    _hooks.remove(func)
+
+
+def _load_hook(spec):
+    module, _, name = spec.partition(':')
+    if not name:
+        raise zc.buildout.UserError("git-trace-hook must look like "
+                                    "module:function, not %r" % spec)
+    try:
+        return getattr(__import__(module, {}, {}, [name]), name)
+    except (ImportError, AttributeError), e:
+        raise zc.buildout.UserError("Couldn't load git-trace-hook %s: %s"
+                                    % (spec, e))
+
+
+def get_tracer(buildout):
+    """
+    Return the tracer of the given buildout.
+    """
+    options = buildout['buildout']
+    _tracers_lock.acquire()
+    try:
+        key = id(buildout)
+        if key not in _tracers:
+            def forget(ref):
+                _tracers.pop(key, None)
+            paths = [options.get(name) for name in ('git-trace',
+                                                    'git-chrome-trace')]
+            paths = [path and os.path.join(options['directory'], path)
+                     for path in paths]
+            hook = options.get('git-trace-hook')
+            _tracers[key] = (weakref.ref(buildout, forget), Tracer(
+                    paths[0], paths[1], hook and [_load_hook(hook)] or []))
+        return _tracers[key][1]
+    finally:
+        _tracers_lock.release()
+
+
+class Span(object):
+    """
+    A phase of a part or a single git call.
+    """
+
+    def __init__(self, id, part, phase, parent, attributes):
+        self.id = id
+        self.part = part
+        self.phase = phase
+        self.parent = parent
+        self.attributes = attributes
+        self.thread = threading.currentThread().getName()
+        self.start = time.time()
+        self.duration = None
+
+    def as_dict(self):
+        data = dict(self.attributes)
+        data.update(id=self.id, part=self.part, phase=self.phase,
+                    parent=self.parent, thread=self.thread,
+                    start=self.start, duration=self.duration)
+        return data
+
+
+class Tracer(object):
+    """
+    Collects the spans of all parts of a buildout. ``path`` and
+    ``chrome_path`` are the files written by flush(), ``hooks`` are called
+    by it in addition to the ones added with add_hook().
+    """
+
+    def __init__(self, path=None, chrome_path=None, hooks=()):
+        self.path = path
+        self.chrome_path = chrome_path
+        self.hooks = list(hooks)
+        self.spans = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start(self, part, phase, **attributes):
+        """
+        Start a span in the current thread. It is nested in the span that
+        is running in this thread, if any.
+        """
+        stack = self._stack()
+        self._lock.acquire()
+        try:
+            span = Span(len(self.spans) + 1, part, phase,
+                        stack and stack[-1].id or None, attributes)
+            self.spans.append(span)
+        finally:
+            self._lock.release()
+        stack.append(span)
+        return span
+
+    def finish(self, span):
+        span.duration = time.time() - span.start
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+
+    def annotate(self, **attributes):
+        """
+        Add attributes (like ``cache_hit``) to the current span of this
+        thread.
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].attributes.update(attributes)
+
+    def report(self):
+        """
+        All spans, the total time of every part and the time every part
+        spent on background work.
+        """
+        spans = [span.as_dict() for span in list(self.spans)]
+        parts = {}
+        background = {}
+        for span in spans:
+            if span['parent'] is None and span['duration'] is not None:
+                if span['phase'] in BACKGROUND_PHASES:
+                    totals = background
+                else:
+                    totals = parts
+                totals[span['part']] = totals.get(span['part'], 0) \
+                        + span['duration']
+        return {'parts': parts, 'background': background, 'spans': spans}
+
+    def chrome_trace(self):
+        """
+        The spans in the Chrome trace event format.
+        """
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for span in list(self.spans):
+            if span.duration is None:
+                continue
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            args = dict(span.attributes)
+            args['part'] = span.part
+            events.append({
+                'name': '%s: %s' % (span.part, span.attributes.get(
+                        'command', span.phase)),
+                'cat': span.phase,
+                'ph': 'X',
+                'ts': int(span.start * 1000000),
+                'dur': int(span.duration * 1000000),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        for name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self):
+        """
+        Write the trace files with the spans collected so far. Background
+        threads write them too, the last report is always written last.
+        """
+        self._write_lock.acquire()
+        try:
+            if self.path:
+                JSONFile(self.path).write(self.report())
+            if self.chrome_path:
+                JSONFile(self.chrome_path).write(self.chrome_trace())
+        finally:
+            self._write_lock.release()
+
+    def flush(self, part):
+        """
+        Write the trace files and call the hooks for the part that just
+        finished.
+        """
+        self.write()
+        hooks = self.hooks + _hooks
+        if hooks:
+            spans = [span.as_dict() for span in list(self.spans)
+                     if span.part == part]
+            for hook in hooks:
+                hook(part, spans)
+
+
+def traced(phase):
+    """
+    Decorator for Recipe methods that records each call as a span of the
+    given phase.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            span = self.tracer.start(self.name, phase)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.tracer.finish(span)
+        return wrapper
+    return decorator
+
+
+def object_bytes(path):
+    """
+    Size of the object store of the repository at ``path``, as counted by
+    ``git count-objects`` (in KiB), which only looks at the sizes of the
+    packs and loose objects.
+    """
+    git_dir = os.path.join(path, '.git')
+    if not os.path.isdir(git_dir):
+        git_dir = path
+    if not os.path.isdir(os.path.join(git_dir, 'objects')):
+        return 0
+    process = subprocess.Popen(['git', '--git-dir', git_dir, 'count-objects',
+                                '-v'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return 0
+    counts = dict(line.split(': ', 1) for line in output.splitlines()
+                  if ': ' in line)
+    return 1024 * (int(counts.get('size', 0)) +
+                   int(counts.get('size-pack', 0)))
+
+
+def has_commit_graph(path):
+    """
+    True if the repository at ``path`` has a commit-graph.
+    """
+    git_dir = os.path.join(path, '.git')
+    if not os.path.isdir(git_dir):
+        git_dir = path
+    info = os.path.join(git_dir, 'objects', 'info')
+    return os.path.exists(os.path.join(info, 'commit-graph')) or \
+            os.path.isdir(os.path.join(info, 'commit-graphs'))
+
+
+class TracingRunner(GitRunner):
+    """
+    A GitRunner that records every call as a span of ``part``. For calls
+    that download objects, the growth of the repository's object store is
+    recorded as ``bytes``.
+    """
+
+    def __init__(self, tracer, part, **kwargs):
+        GitRunner.__init__(self, **kwargs)
+        self.tracer = tracer
+        self.part = part
+
+    def run(self, args, message=None, cwd=None, **kwargs):
+        args = list(args)
+        repository = self._repository(args, cwd)
+        before = repository and object_bytes(repository)
+        span = self.tracer.start(self.part, 'git', command=' '.join(args),
+                                 cwd=cwd)
+        try:
+            try:
+                result = GitRunner.run(self, args, message, cwd=cwd, **kwargs)
+            except zc.buildout.UserError:
+                span.attributes['status'] = 'error'
+                raise
+            span.attributes['status'] = result.status
+            return result
+        finally:
+            if repository:
+                span.attributes['bytes'] = max(0,
+                        object_bytes(repository) - before)
+            self.tracer.finish(span)
+
+    def _repository(self, args, cwd):
+        # The repository a transfer command downloads into.
+        operation = [arg for arg in args if not arg.startswith('-')]
+        if not operation or operation[0] not in TRANSFER_COMMANDS:
+            return None
+        if operation[0] == 'clone':
+            return os.path.join(cwd or '', operation[-1])
+        return cwd
@@ -0,0 +1,153 @@
+"""
+A store of unpacked trees in the download cache, one per exported commit,
+that parts are materialized from without unpacking anything.
+
+``<download-cache>/git-trees/<sha>`` holds the files of a commit as
+``checkout-mode = export`` unpacks them. The files in the store are made
+read-only and never change, so a part can be materialized from it in the
+cheapest way the file system allows:
+
+reflink
+    A copy-on-write clone of every file (``cp --reflink=always``), on file
+    systems that support it (e.g. btrfs or XFS). Nearly as fast as
+    hardlinks, and the part can be changed without touching the store.
+
+hardlink
+    Hardlinks to the files of the store. Only used for parts that are
+    declared read-only, as their files are the files of the store.
+
+copy
+    A plain copy, if the file system can't clone files.
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+
+from zerokspot.recipe.git.cache import TREE_DIRECTORY
+
+
+def tree_path(download_cache, sha):
+    return os.path.join(download_cache, TREE_DIRECTORY, sha)
+
+
+def store(download_cache, sha, archive):
+    """
+    Unpack the tarball ``archive`` of the commit ``sha`` into the store,
+    unless it is there already. Returns the path of the tree.
+    """
+    path = tree_path(download_cache, sha)
+    if os.path.exists(path):
+        return path
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    temp = tempfile.mkdtemp(dir=directory, prefix='.%s-' % sha)
+    try:
+        tar = tarfile.open(archive, 'r|')
+        try:
+            tar.extractall(temp)
+        finally:
+            tar.close()
+        _walk_files(temp, lambda path, mode: os.chmod(path,
+                mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)))
+        os.chmod(temp, 0755)
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # Someone else stored the same tree in the meantime.
+            if not os.path.exists(path):
+                raise
+            shutil.rmtree(temp, ignore_errors=True)
+    except:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+    return path
+
+
+def _walk_files(top, func):
+    # Call func(path, mode) for every regular file below top.
+    for root, dirs, files in os.walk(top):
+        for name in files:
+            path = os.path.join(root, name)
+            mode = os.lstat(path).st_mode
+            if stat.S_ISREG(mode):
+                func(path, stat.S_IMODE(mode))
+
+
+def _make_writable(top):
+    _walk_files(top, lambda path, mode: os.chmod(path, mode | stat.S_IWUSR))
+
+
+def _reflink(tree, destination):
+    process = subprocess.Popen(['cp', '-R', '-p', '--reflink=always',
+                                os.path.join(tree, '.'), destination],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+    return process.returncode == 0
+
+
+def _hardlink(tree, destination):
+    for root, dirs, files in os.walk(tree):
+        target = os.path.join(destination, os.path.relpath(root, tree))
+        for name in dirs:
+            source = os.path.join(root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, name))
+            else:
+                os.mkdir(os.path.join(target, name))
+        for name in files:
+            source = os.path.join(root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, name))
+            else:
+                os.link(source, os.path.join(target, name))
+
+
+def _copy(tree, destination):
+    for name in os.listdir(tree):
+        source = os.path.join(tree, name)
+        if os.path.isdir(source) and not os.path.islink(source):
+            shutil.copytree(source, os.path.join(destination, name),
+                            symlinks=True)
+        elif os.path.islink(source):
+            os.symlink(os.readlink(source), os.path.join(destination, name))
+        else:
+            shutil.copy2(source, destination)
+
+
+def _clear(directory):
+    # Remove what a failed attempt left in directory.
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def materialize(tree, destination, read_only=False):
+    """
+    Fill the empty directory ``destination`` with the files of ``tree``:
+    hardlinks if ``read_only`` (and the store is on the same file system),
+    otherwise reflinks or, if the file system doesn't support them, a copy.
+    Returns the method that was used.
+    """
+    if read_only:
+        try:
+            _hardlink(tree, destination)
+            return 'hardlink'
+        except OSError:
+            _clear(destination)
+    if _reflink(tree, destination):
+        method = 'reflink'
+    else:
+        _clear(destination)
+        _copy(tree, destination)
+        method = 'copy'
+    if not read_only:
+        _make_writable(destination)
+    return method
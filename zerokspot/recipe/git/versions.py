@@ -0,0 +1,151 @@
+"""
+Lockfiles that pin every git part of a buildout to a commit.
+
+``zerokspot-git-lock`` resolves the branch or rev of every
+zerokspot.recipe.git part of a buildout configuration to a SHA, with a
+single ``git ls-remote`` per repository, all of them at the same time, and
+writes them as the ``[git-versions]`` section of a lockfile::
+
+    zerokspot-git-lock -c buildout.cfg -o git-versions.cfg
+
+With ``frozen = true`` in the ``[buildout]`` section (or in a part), parts
+are installed at exactly the commits of the lockfile named by
+``git-versions`` (default: ``git-versions.cfg`` in the buildout directory)
+and refs are never listed.
+"""
+
+import ConfigParser
+import optparse
+import os
+import sys
+
+import zc.buildout
+import zc.buildout.buildout
+
+from zerokspot.recipe.git.cache import ls_remote_all, resolve_ref
+
+
+VERSIONS_FILE = 'git-versions.cfg'
+VERSIONS_SECTION = 'git-versions'
+RECIPE = 'zerokspot.recipe.git'
+
+
+def read_versions(path):
+    """
+    The commits of the lockfile at ``path`` as a dictionary mapping part
+    names to SHAs.
+    """
+    from zerokspot.recipe.git import SHA_RE
+    if not os.path.exists(path):
+        raise zc.buildout.UserError("No lockfile at %s, create it with "
+                                    "zerokspot-git-lock" % path)
+    parser = ConfigParser.RawConfigParser()
+    # Part names are case sensitive.
+    parser.optionxform = str
+    parser.read(path)
+    if not parser.has_section(VERSIONS_SECTION):
+        raise zc.buildout.UserError("%s has no [%s] section" % (
+                path, VERSIONS_SECTION))
+    versions = dict(parser.items(VERSIONS_SECTION))
+    for part, sha in versions.items():
+        if not SHA_RE.match(sha):
+            raise zc.buildout.UserError("%s pins %s to %r, which is not a "
+                                        "full SHA" % (path, part, sha))
+    return versions
+
+
+def write_versions(path, versions):
+    """
+    Write the commits of ``versions`` (part names to SHAs) to the lockfile
+    at ``path``.
+    """
+    fp = open(path, 'w')
+    try:
+        fp.write('# Written by zerokspot-git-lock, used with frozen = true.\n')
+        fp.write('[%s]\n' % VERSIONS_SECTION)
+        for part in sorted(versions):
+            fp.write('%s = %s\n' % (part, versions[part]))
+    finally:
+        fp.close()
+
+
+def git_parts(config, frozen=None):
+    """
+    The recipes of all zerokspot.recipe.git parts of the buildout
+    configuration at ``config``. If ``frozen`` is given, it replaces the
+    frozen setting of every part (e.g. False, so that the lockfile doesn't
+    have to exist yet).
+    """
+    overrides = []
+    if frozen is not None:
+        frozen = frozen and 'true' or 'false'
+        overrides.append(('buildout', 'frozen', frozen))
+    build = zc.buildout.buildout.Buildout(config, overrides)
+    # Only git parts are initialized, other recipes might have to be
+    # installed first.
+    names = [name for name, section in sorted(build._raw.items())
+             if section.get('recipe', '').split(':')[0].strip() == RECIPE]
+    recipes = []
+    for name in names:
+        if frozen is not None:
+            build._raw[name]['frozen'] = frozen
+        recipes.append(build[name].recipe)
+    return recipes
+
+
+def lock(recipes, runner=None):
+    """
+    Resolve the rev or branch of every recipe to a SHA, with one ls-remote
+    per repository, all at the same time. Returns a dictionary mapping
+    part names to SHAs.
+    """
+    from zerokspot.recipe.git import SHA_RE
+    listed = ls_remote_all([recipe.repository for recipe in recipes
+                            if not SHA_RE.match(recipe.requested_rev or
+                                                recipe.branch)], runner)
+    versions = {}
+    for recipe in recipes:
+        ref = recipe.requested_rev or recipe.branch
+        if SHA_RE.match(ref):
+            versions[recipe.name] = ref
+            continue
+        refs = listed[recipe.repository]
+        if refs is None:
+            raise zc.buildout.UserError("Couldn't list the refs of %s" %
+                                        recipe.repository)
+        sha = resolve_ref(refs, ref)
+        if sha is None:
+            raise zc.buildout.UserError("Couldn't resolve %s of %s for part "
+                    "%s, only branches, tags and full SHAs can be locked" % (
+                            ref, recipe.repository, recipe.name))
+        versions[recipe.name] = sha
+    return versions
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option('-c', '--config', default='buildout.cfg',
+            help="the buildout configuration (default: %default)")
+    parser.add_option('-o', '--output',
+            help="the lockfile to write (default: %s next to the "
+                 "configuration)" % VERSIONS_FILE)
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error("Unexpected arguments: %s" % ' '.join(args))
+    config = os.path.abspath(options.config)
+    output = options.output or os.path.join(os.path.dirname(config),
+                                            VERSIONS_FILE)
+    try:
+        versions = lock(git_parts(config, frozen=False))
+    except zc.buildout.UserError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    write_versions(output, versions)
+    for part in sorted(versions):
+        print '%s = %s' % (part, versions[part])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())